@@ -1,23 +1,68 @@
 import saliweb.backend
 import os
-from . import run_foxs
+from . import run_foxs, validate, summary, jmoltable, compress
 
 
 class LogError(Exception):
     pass
 
 
+class Config(saliweb.backend.Config):
+    """Service configuration, including FoXS-specific settings from the
+       [foxs] section of the configuration file"""
+
+    def populate(self, config):
+        saliweb.backend.Config.populate(self, config)
+        self.batch_shard_size = config.getint('foxs', 'batch_shard_size',
+                                              fallback=100)
+        self.profile_store = config.get('foxs', 'profile_store',
+                                        fallback=None)
+        self.profile_library = config.get('foxs', 'profile_library',
+                                          fallback=None)
+        self.batch_pool_size = config.getint('foxs', 'batch_pool_size',
+                                             fallback=100)
+        self.multifoxs_shard_size = config.getint(
+            'foxs', 'multifoxs_shard_size', fallback=0)
+        self.scratch = config.get('foxs', 'scratch', fallback=None)
+
+
 class Job(saliweb.backend.Job):
 
     runnercls = saliweb.backend.LocalRunner
 
+    def preprocess(self):
+        # If the frontend deferred checking of the user's inputs, do it now
+        if os.path.exists(validate.REQUEST_FILE):
+            if not validate.validate_job():
+                # Return user errors to the user for inspection
+                self.skip_run()
+
     def run(self):
         # Simply run the run_foxs Python file in the job directory
         foxs_path = os.path.abspath(run_foxs.__file__)
-        cmd = ['/usr/bin/python3', foxs_path]
+        cmd = ['/usr/bin/python3', foxs_path] + self._get_run_options()
         return self.runnercls(cmd)
 
+    def _get_run_options(self):
+        """Pass FoXS-specific settings from our configuration to run_foxs"""
+        opts = []
+        for name in ('batch_shard_size', 'batch_pool_size', 'profile_store',
+                     'profile_library', 'multifoxs_shard_size', 'scratch'):
+            value = getattr(self.config, name, None)
+            if value is not None:
+                opts.extend(('--' + name.replace('_', '-'), str(value)))
+        return opts
+
     def postprocess(self):
+        # Do the job-independent rewriting of the Jmol table once, here
+        jmoltable.write_template()
+        # Summarize results so the frontend doesn't need to parse them
+        summary.write_summary()
+        # Precompress large outputs so the frontend can serve them quickly
+        compress.write_gzip_sidecars()
+        # Inputs failed validation, so FoXS was never run
+        if os.path.exists(validate.ERROR_FILE):
+            return
         # Check for errors in foxs.log
         with open('foxs.log') as fh:
             for line in fh:
@@ -32,5 +77,5 @@ class Job(saliweb.backend.Job):
 
 def get_web_service(config_file):
     db = saliweb.backend.Database(Job)
-    config = saliweb.backend.Config(config_file)
+    config = Config(config_file)
     return saliweb.backend.WebService(config, db)
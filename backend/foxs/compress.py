@@ -0,0 +1,67 @@
+"""Compressed copies of large text outputs.
+
+   At postprocess time a gzip-compressed copy (with an extra .gz
+   extension) is made of each large text result file in the job
+   directory, so that the frontend can send it to clients that accept
+   compressed responses without compressing on every request (see
+   frontend/foxs/http_cache.py). The original files are kept, for clients
+   that don't accept gzip and for byte-range requests. Uploaded inputs
+   are not compressed, as the results pages rarely serve them and they
+   can be large."""
+
+import os
+import gzip
+import shutil
+
+
+# Suffix of compressed copies (should match that in
+# frontend/foxs/http_cache.py)
+GZIP_SUFFIX = '.gz'
+
+# Text outputs served by the results pages (profiles, fits, summaries
+# and logs) that are worth compressing
+RESULT_SUFFIXES = ('.dat', '.fit', '.json', '.txt', '.log')
+
+# Smaller files are not worth compressing
+MIN_SIZE = 4096
+
+
+def get_uploaded_profiles(topdir='.'):
+    """Get the names of the experimental profiles uploaded for the job
+       in `topdir`, relative to that directory"""
+    profiles = set()
+    fname = os.path.join(topdir, 'data.txt')
+    if os.path.exists(fname):
+        with open(fname) as fh:
+            fields = fh.readline().split()
+        if len(fields) > 1 and fields[1] != '-':
+            profiles.add(fields[1])
+    # More than one profile can be given, in multi-profile mode
+    fname = os.path.join(topdir, 'profiles.txt')
+    if os.path.exists(fname):
+        with open(fname) as fh:
+            profiles.update(line.strip() for line in fh)
+    return profiles
+
+
+def write_gzip_sidecars(topdir='.', min_size=MIN_SIZE):
+    """Make a compressed copy of each large text result file under
+       `topdir`"""
+    uploaded = get_uploaded_profiles(topdir)
+    for dirpath, dirnames, filenames in os.walk(topdir):
+        for fname in filenames:
+            if not fname.endswith(RESULT_SUFFIXES):
+                continue
+            fname = os.path.join(dirpath, fname)
+            if (os.path.relpath(fname, topdir) not in uploaded
+                    and os.stat(fname).st_size >= min_size):
+                _write_gzip(fname)
+
+
+def _write_gzip(fname):
+    tmp = fname + GZIP_SUFFIX + '.tmp'
+    with open(fname, 'rb') as fh_in:
+        # Don't store the time in the header, so output is reproducible
+        with gzip.GzipFile(tmp, 'wb', mtime=0) as fh_out:
+            shutil.copyfileobj(fh_in, fh_out)
+    os.rename(tmp, fname + GZIP_SUFFIX)
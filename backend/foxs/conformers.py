@@ -0,0 +1,135 @@
+"""Removal of near-identical conformers before MultiFoXS.
+
+   Ensembles from MD simulations often contain many conformers that are
+   almost identical, each of which adds to the size of MultiFoXS's
+   search. Conformers within a given RMSD (after optimal superposition)
+   of an earlier conformer are represented by that conformer, and only
+   the representatives are given to MultiFoXS. RMSDs are computed on
+   CA (or, for nucleic acids, P) atoms, and only between structures with
+   the same number of such atoms."""
+
+import collections
+import numpy
+import ihm.format
+
+
+def _read_pdb_coordinates(fh, first_model_only):
+    names = []
+    coords = []
+    for line in fh:
+        if line.startswith('ATOM'):
+            names.append(line[12:16].strip())
+            coords.append((float(line[30:38]), float(line[38:46]),
+                           float(line[46:54])))
+        elif line.startswith('ENDMDL') and first_model_only:
+            break
+    return names, coords
+
+
+class _AtomSiteCoordinateHandler:
+    """Read atom names and coordinates from the _atom_site table"""
+
+    not_in_file = omitted = None
+    unknown = ihm.unknown
+
+    def __init__(self, first_model_only):
+        self.first_model_only = first_model_only
+        self.model = None
+        self.names = []
+        self.coords = []
+
+    def __call__(self, group_pdb, label_atom_id, cartn_x, cartn_y, cartn_z,
+                 pdbx_pdb_model_num):
+        if self.model is None:
+            self.model = pdbx_pdb_model_num
+        if ((self.first_model_only and pdbx_pdb_model_num != self.model)
+                or group_pdb != 'ATOM'):
+            return
+        self.names.append(label_atom_id)
+        self.coords.append((float(cartn_x), float(cartn_y), float(cartn_z)))
+
+
+def _read_cif_coordinates(fh, first_model_only):
+    h = _AtomSiteCoordinateHandler(first_model_only)
+    c = ihm.format.CifReader(fh, category_handler={'_atom_site': h})
+    c.read_file()  # read first block
+    return h.names, h.coords
+
+
+def read_coordinates(fname, first_model_only=False, fh=None):
+    """Get the coordinates of the CA or P atoms in a PDB or mmCIF file (or
+       of all atoms, if there are none of these) as an (N, 3) array.
+       If `fh` is given, the structure is read from it rather than from
+       `fname` (which is then only used to tell PDB from mmCIF)."""
+    if fh is None:
+        with open(fname, encoding='latin1') as fh:
+            return read_coordinates(fname, first_model_only, fh)
+    if fname.endswith('.cif'):
+        names, coords = _read_cif_coordinates(fh, first_model_only)
+    else:
+        names, coords = _read_pdb_coordinates(fh, first_model_only)
+    backbone = [xyz for name, xyz in zip(names, coords)
+                if name in ('CA', 'P')]
+    return numpy.array(backbone or coords,
+                       dtype=numpy.float64).reshape((-1, 3))
+
+
+def superposed_rmsd(ref, coords):
+    """Get the RMSD between `ref`, an (N, 3) array, and each of `coords`,
+       an (M, N, 3) array, after optimal superposition. The superpositions
+       (Kabsch) are all done at once."""
+    ref = ref - ref.mean(axis=0)
+    coords = coords - coords.mean(axis=1)[:, numpy.newaxis, :]
+    # Singular values of the covariance matrices give the best rotations
+    h = numpy.einsum('ki,mkj->mij', ref, coords)
+    s = numpy.linalg.svd(h, compute_uv=False)
+    # Don't allow reflections
+    s[:, 2] *= numpy.where(numpy.linalg.det(h) < 0., -1., 1.)
+    sq = (numpy.sum(ref * ref) + numpy.sum(coords * coords, axis=(1, 2))
+          - 2. * numpy.sum(s, axis=1))
+    return numpy.sqrt(numpy.maximum(sq, 0.) / max(len(ref), 1))
+
+
+def find_representatives(structures, threshold, first_model_only=False,
+                         coords=None):
+    """Group structures that are within `threshold` RMSD of an earlier
+       structure. Return a list of (representative, members) pairs, where
+       members includes the representative, in the original order.
+       The coordinates of each structure (from read_coordinates) can be
+       given as `coords` if they were already read."""
+    if coords is None:
+        coords = [read_coordinates(s, first_model_only) for s in structures]
+    by_size = collections.defaultdict(list)
+    for i, c in enumerate(coords):
+        by_size[len(c)].append(i)
+    stacks = dict((n, numpy.array([coords[i] for i in ind]))
+                  for n, ind in by_size.items() if n > 0)
+    rep_of = [None] * len(structures)
+    reps = []
+    for i, c in enumerate(coords):
+        if rep_of[i] is not None:
+            continue
+        rep_of[i] = i
+        reps.append(i)
+        if len(c) == 0:
+            continue
+        # Compare with all structures of this size that are not yet grouped
+        ind = numpy.array(by_size[len(c)])
+        free = numpy.array([rep_of[j] is None for j in ind], dtype=bool)
+        if not numpy.any(free):
+            continue
+        rmsd = superposed_rmsd(c, stacks[len(c)][free])
+        for j in ind[free][rmsd < threshold]:
+            rep_of[j] = i
+    return [(structures[i], [s for s, r in zip(structures, rep_of) if r == i])
+            for i in reps]
+
+
+def write_groups(fname, groups, threshold):
+    """Write groups from find_representatives to a file, one per line
+       (representative first)"""
+    with open(fname, 'w') as fh:
+        fh.write("# RMSD threshold %.2f\n" % threshold)
+        for rep, members in groups:
+            fh.write(" ".join([rep] + [m for m in members if m != rep])
+                     + "\n")
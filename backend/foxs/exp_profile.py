@@ -0,0 +1,71 @@
+"""Canonical binary form of an experimental profile.
+
+   An uploaded profile is parsed once, and its q, intensity and error
+   columns are stored as a NumPy array next to the original file (with an
+   extra .npy extension). Python code reads this array (memory-mapped)
+   rather than parsing the text again; the text file itself is kept, with
+   only its line endings normalized, for FoXS, MultiFoXS and gnuplot.
+   This module is used by both the frontend and the backend
+   (frontend/foxs/exp_profile.py is a link to it), so it should need
+   nothing but NumPy."""
+
+import os
+import numpy
+
+
+def _parse_line(line):
+    """Get the q, intensity and error (NaN if not given) from a line of a
+       profile, or None if FoXS would not read the line: comments, lines
+       without between 2 and 5 columns, and lines whose first two columns
+       are not numbers."""
+    if line.startswith('#'):
+        return None
+    spl = line.split()
+    if not 2 <= len(spl) <= 5 or spl[0][0] not in '0123456789':
+        return None
+    try:
+        q, intensity = float(spl[0]), float(spl[1])
+    except ValueError:
+        return None
+    try:
+        error = float(spl[2]) if len(spl) > 2 else numpy.nan
+    except ValueError:
+        error = numpy.nan
+    return q, intensity, error
+
+
+def parse_profile(fname):
+    """Parse a text profile and return an (N, 3) array of q, intensity and
+       error (NaN if not given), with a row for each line that FoXS would
+       read"""
+    with open(fname, encoding='latin1') as fh:
+        rows = [row for row in (_parse_line(line) for line in fh)
+                if row is not None]
+    return numpy.array(rows, dtype=numpy.float64).reshape((len(rows), 3))
+
+
+def write_profile(fname, profile):
+    """Write the canonical binary form of a profile. Also, FoXS doesn't
+       like some weird line endings (e.g. old Mac style) so take this
+       opportunity to use Python's universal line ending support to get
+       rid of them in the text file. Both files are replaced rather than
+       written in place, as they may be hard linked from another job."""
+    tmp = fname + '.tmp'
+    with open(tmp, 'wb') as fh:
+        numpy.save(fh, profile)
+    os.rename(tmp, fname + '.npy')
+    with open(fname, encoding='latin1') as fhin:
+        with open(tmp, 'w', encoding='latin1') as fhout:
+            for line in fhin:
+                fhout.write(line)
+    os.rename(tmp, fname)
+
+
+def load_profile(fname):
+    """Get the q, intensity and error columns of a profile. The binary form
+       is memory-mapped if available; otherwise the text file is parsed."""
+    npy = fname + '.npy'
+    if os.path.exists(npy):
+        return numpy.load(npy, mmap_mode='r')
+    else:
+        return parse_profile(fname)
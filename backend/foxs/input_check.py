@@ -0,0 +1,139 @@
+"""Checks of uploaded structures and profiles.
+
+   Uploads are normally checked by the frontend when a job is submitted,
+   but in fast-accept (deferred validation) mode the same checks are done
+   by the backend instead (see validate.py). This module is used by both
+   (frontend/foxs/input_check.py is a link to it), so the checks and
+   their user-facing error messages are the same either way. Errors are
+   raised as InputError, which the frontend reports as an
+   InputValidationError. The frontend checks structures with
+   saliweb.frontend.check_pdb_or_mmcif; the backend cannot import that,
+   so uses check_structure instead."""
+
+import os
+import zipfile
+import numpy
+import ihm.format
+from werkzeug.utils import secure_filename
+from . import exp_profile
+
+
+class InputError(Exception):
+    """An error in the user-provided inputs"""
+    pass
+
+
+def handle_structures(fname, show_filename, directory, local,
+                      max_structures=100, check=None):
+    """Handle an uploaded PDB, mmCIF or zip file `fname` in `directory`.
+       Return a list of structure file names, relative to `directory`.
+       Each structure is checked with `check` (by default,
+       check_structure)."""
+    try:
+        return handle_zipfile(fname, directory, local, max_structures,
+                              check)
+    except zipfile.BadZipfile:
+        (check or check_structure)(os.path.join(directory, fname),
+                                   show_filename=show_filename)
+        return [fname]
+
+
+def handle_zipfile(zfname, directory, local, max_structures=100,
+                   check=None):
+    """Extract PDB files from the given zip file in `directory`, checking
+       each with `check` (by default, check_structure)"""
+    check = check or check_structure
+    exclude = frozenset((zfname, 'inputFiles.txt'))
+    pdbs = []
+    with zipfile.ZipFile(os.path.join(directory, zfname)) as fh:
+        for zi in fh.infolist():
+            if zi.is_dir():
+                continue
+            subdir, fname = os.path.split(zi.filename)
+            # Exclude hidden files, e.g. __MACOSX/.something.pdb
+            if fname.startswith('.'):
+                continue
+            fname = secure_filename(fname)
+            subdir = secure_filename(subdir)
+            full_fname = os.path.join(subdir, fname)
+            if full_fname not in exclude:
+                if subdir not in ('', '.'):
+                    full_subdir = os.path.join(directory, subdir)
+                    if not os.path.exists(full_subdir):
+                        os.mkdir(full_subdir)
+                with open(os.path.join(directory, full_fname),
+                          'wb') as out_fh:
+                    out_fh.write(fh.read(zi))
+                if not fname.endswith('.pdb') and not fname.endswith('.cif'):
+                    raise InputError(
+                        "zip file should contain ONLY files with the .pdb or "
+                        ".cif extension (first invalid file %r)" % full_fname)
+                check(os.path.join(directory, full_fname),
+                      show_filename=zi.filename)
+                pdbs.append(full_fname)
+                if len(pdbs) > max_structures and not local:
+                    raise InputError(
+                        "Only %d PDB/mmCIF files can run on the server. "
+                        "Please use download version for more"
+                        % max_structures)
+    if len(pdbs) == 0:
+        raise InputError("The uploaded zip file contains no PDB/mmCIFs")
+    return pdbs
+
+
+class _AtomSiteCounter:
+    """Count the number of rows in an mmCIF file's _atom_site table"""
+    not_in_file = omitted = unknown = None
+
+    def __init__(self):
+        self.num_atoms = 0
+
+    def __call__(self, cartn_x):
+        self.num_atoms += 1
+
+
+def check_structure(fname, show_filename=None):
+    """Check that a PDB or mmCIF file contains at least one atom, as
+       saliweb.frontend.check_pdb_or_mmcif does. This is only used for
+       deferred validation in the backend; the frontend calls saliweb's
+       check directly."""
+    show_filename = show_filename or os.path.basename(fname)
+    if fname.endswith('.cif'):
+        ash = _AtomSiteCounter()
+        with open(fname, encoding='latin1') as fh:
+            c = ihm.format.CifReader(fh, category_handler={'_atom_site': ash})
+            c.read_file()  # read first block
+        if ash.num_atoms == 0:
+            raise InputError(
+                "mmCIF file %s contains no atom_site records" % show_filename)
+    else:
+        with open(fname, encoding='latin1') as fh:
+            for line in fh:
+                if line.startswith('ATOM') or line.startswith('HETATM'):
+                    return
+        raise InputError(
+            "PDB file %s contains no ATOM or HETATM records" % show_filename)
+
+
+def check_profile(fname):
+    """Check that the profile contains at least one valid line, and
+       store it in canonical form (see exp_profile)"""
+    profile = check_valid_profile(fname)
+    exp_profile.write_profile(fname, profile)
+
+
+def check_valid_profile(fname):
+    """Check the given profile, and return it as an array"""
+    help_text = ("Profiles should be text files with each "
+                 "line containing a q value and measured scattering, "
+                 "which should be non-zero and positive")
+
+    if fname.endswith('.pdb') or fname.endswith('.cif'):
+        raise InputError(
+                "PDB or mmCIF file uploaded where a profile was expected. "
+                + help_text)
+
+    profile = exp_profile.parse_profile(fname)
+    if not numpy.any(profile[:, 1] > 1e-15):
+        raise InputError("Invalid profile uploaded. " + help_text)
+    return profile
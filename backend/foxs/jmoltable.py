@@ -0,0 +1,54 @@
+"""Conversion of the Jmol table written by FoXS into a template.
+
+   The jmoltable.html file contains relative links to job files and
+   hard-coded links to the help pages on the old server, and needs some
+   fixes for our copy of JSmol. These rewrites are done once here, at
+   postprocess time, rather than every time the results page is viewed.
+   Links are replaced with {{file:NAME}} and {{help:ANCHOR}} placeholders,
+   which the frontend fills in with a single substitution pass (see
+   JMolTableReader in frontend/foxs/results_page.py)."""
+
+import os
+import re
+
+
+# Input file written by FoXS
+JMOL_TABLE_FILE = 'jmoltable.html'
+
+# Template file read by the frontend
+# (should match that in frontend/foxs/results_page.py)
+TEMPLATE_FILE = 'jmoltable.tmpl'
+
+
+def make_template_contents(contents):
+    """Return template contents for the given jmoltable.html contents"""
+    # Link to per-job PDB or mmCIF file
+    contents = contents.replace('load jmoltable.pdb',
+                                'load "{{file:jmoltable.pdb}}"')
+    contents = contents.replace('load jmoltable.cif',
+                                'load "{{file:jmoltable.cif}}"')
+    # Fix URL for our copy of JSmol
+    contents = contents.replace('/foxs/jsmol', '/jsmol')
+    # Fix bug with show all/hide all checkbox
+    contents = re.sub(r'jmolSetCheckboxGroup\(0,([^)]+)\)',
+                      r'Jmol.setCheckboxGroup(0,[\1])', contents)
+    # Add an ID to the info table so we can style it with CSS
+    contents = contents.replace('<table ', '<table id="plotcontrol" ')
+    # Hard-coded links to help page
+    contents = re.sub(r'https:\/\/modbase\.compbio\.ucsf\.edu\/'
+                      r'foxs\/help\.html#(\w+)', r'{{help:\1}}', contents)
+    # Links to job results files
+    return re.sub('dirname/([^"]+)', r'{{file:\1}}', contents)
+
+
+def write_template():
+    """Make the template from jmoltable.html in the current directory,
+       if it exists"""
+    if not os.path.exists(JMOL_TABLE_FILE):
+        return
+    with open(JMOL_TABLE_FILE) as fh:
+        contents = make_template_contents(fh.read())
+    tmp = TEMPLATE_FILE + '.tmp'
+    with open(tmp, 'w') as fh:
+        fh.write(contents)
+    os.rename(tmp, TEMPLATE_FILE)
@@ -0,0 +1,408 @@
+"""Fitting of experimental profiles using FoXS partial profiles.
+
+   When run with -p, FoXS writes, for each structure, partial profiles
+   from which the profile for any excluded volume (c1) and hydration
+   layer (c2) parameters can be quickly computed, without going back to
+   the structure. This lets us fit a structure to several experimental
+   profiles, or refit with different parameters, without rerunning FoXS.
+   The profile and fit are computed as in FoXS (IMP.saxs.Profile and
+   ProfileFitter), including its recursive search for the best c1 and c2.
+   Chi^2 landscapes and ensemble refits instead use a fixed grid of c1
+   and c2 (see get_grid), so their best c1 and c2 are only as precise as
+   the grid step (C1_STEP, C2_STEP) and may differ from FoXS's. The
+   partial profiles do not record the average atomic radius that FoXS
+   uses for the excluded volume, so it is computed here from the
+   structure. The frontend uses this module too
+   (frontend/foxs/partial_profile.py is a link to it) to fit ensembles."""
+
+import collections
+import math
+import numpy
+import ihm.format
+try:
+    from . import exp_profile
+except ImportError:  # run_foxs is run as a script, not as part of a package
+    import exp_profile
+
+
+# FoXS's default ranges for c1 and c2 (should match those in
+# frontend/foxs/templates/help.html)
+C1_RANGE = (0.99, 1.05)
+C2_RANGE = (-2.0, 4.0)
+
+# Step sizes of the fixed grid used for landscapes and ensemble refits
+C1_STEP = 0.005
+C2_STEP = 0.1
+
+# Number of cells each range is divided into by the first, and later,
+# rounds of FoXS's search, which stops when chi^2 changes by less than
+# SEARCH_CHI2_TOLERANCE or the cells are smaller than SEARCH_MIN_C1_CELL
+# and SEARCH_MIN_C2_CELL (as in IMP.saxs.ProfileFitter)
+SEARCH_CELLS = (10, 5)
+SEARCH_CHI2_TOLERANCE = 1e-4
+SEARCH_MIN_C1_CELL = 1e-4
+SEARCH_MIN_C2_CELL = 1e-3
+
+# Ranges of the fixed c1 and c2 values that users can ask for (should match
+# those in frontend/foxs/submit_page.py)
+FIXED_C1_RANGE = (0.95, 1.05)
+FIXED_C2_RANGE = (-1.0, 4.0)
+
+# Ranges scanned for chi^2 landscapes, covering both of the above
+SCAN_C1_RANGE = (min(C1_RANGE[0], FIXED_C1_RANGE[0]),
+                 max(C1_RANGE[1], FIXED_C1_RANGE[1]))
+SCAN_C2_RANGE = (min(C2_RANGE[0], FIXED_C2_RANGE[0]),
+                 max(C2_RANGE[1], FIXED_C2_RANGE[1]))
+
+# Average atomic radius used by FoXS if it is not known (e.g. for profiles
+# read from a file)
+AVERAGE_RADIUS = 1.58
+
+# Displaced volumes of atoms, in cubic angstroms (Fraser et al., 1978), as
+# used by FoXS for the excluded volume
+ATOM_VOLUMES = {'H': 5.15, 'C': 16.44, 'N': 2.49, 'O': 9.13, 'S': 19.86,
+                'P': 5.73}
+
+# Number of hydrogens bonded to each heavy atom of the standard amino
+# acids; unless hydrogens are given explicitly, FoXS treats each heavy atom
+# and its hydrogens as a single group
+_BACKBONE_HYDROGENS = {'N': 1, 'CA': 1, 'C': 0, 'O': 0}
+_SIDE_CHAIN_HYDROGENS = {
+    'ALA': {'CB': 3},
+    'ARG': {'CB': 2, 'CG': 2, 'CD': 2, 'NE': 1, 'CZ': 0, 'NH1': 2, 'NH2': 2},
+    'ASN': {'CB': 2, 'CG': 0, 'OD1': 0, 'ND2': 2},
+    'ASP': {'CB': 2, 'CG': 0, 'OD1': 0, 'OD2': 0},
+    'CYS': {'CB': 2, 'SG': 1},
+    'GLN': {'CB': 2, 'CG': 2, 'CD': 0, 'OE1': 0, 'NE2': 2},
+    'GLU': {'CB': 2, 'CG': 2, 'CD': 0, 'OE1': 0, 'OE2': 0},
+    'GLY': {'CA': 2},
+    'HIS': {'CB': 2, 'CG': 0, 'ND1': 1, 'CD2': 1, 'CE1': 1, 'NE2': 0},
+    'ILE': {'CB': 1, 'CG1': 2, 'CG2': 3, 'CD1': 3},
+    'LEU': {'CB': 2, 'CG': 1, 'CD1': 3, 'CD2': 3},
+    'LYS': {'CB': 2, 'CG': 2, 'CD': 2, 'CE': 2, 'NZ': 3},
+    'MET': {'CB': 2, 'CG': 2, 'SD': 0, 'CE': 3},
+    'PHE': {'CB': 2, 'CG': 0, 'CD1': 1, 'CD2': 1, 'CE1': 1, 'CE2': 1,
+            'CZ': 1},
+    'PRO': {'N': 0, 'CB': 2, 'CG': 2, 'CD': 2},
+    'SER': {'CB': 2, 'OG': 1},
+    'THR': {'CB': 1, 'OG1': 1, 'CG2': 3},
+    'TRP': {'CB': 2, 'CG': 0, 'CD1': 1, 'CD2': 0, 'NE1': 1, 'CE2': 0,
+            'CE3': 1, 'CZ2': 1, 'CZ3': 1, 'CH2': 1},
+    'TYR': {'CB': 2, 'CG': 0, 'CD1': 1, 'CD2': 1, 'CE1': 1, 'CE2': 1,
+            'CZ': 0, 'OH': 1},
+    'VAL': {'CB': 1, 'CG1': 3, 'CG2': 3},
+}
+_RESIDUE_HYDROGENS = dict((res, dict(_BACKBONE_HYDROGENS, **side_chain))
+                          for res, side_chain in _SIDE_CHAIN_HYDROGENS.items())
+
+
+def _read_pdb_atoms(fh, first_model_only):
+    atoms = []
+    for line in fh:
+        if line.startswith('ATOM'):
+            atoms.append((line[17:20].strip(), line[12:16].strip(),
+                          line[76:78].strip()))
+        elif line.startswith('ENDMDL') and first_model_only:
+            break
+    return atoms
+
+
+class _AtomSiteAtomHandler:
+    """Read residue and atom names and elements from the _atom_site table"""
+
+    not_in_file = omitted = unknown = None
+
+    def __init__(self, first_model_only):
+        self.first_model_only = first_model_only
+        self.model = None
+        self.atoms = []
+
+    def __call__(self, group_pdb, label_comp_id, label_atom_id, type_symbol,
+                 pdbx_pdb_model_num):
+        if self.model is None:
+            self.model = pdbx_pdb_model_num
+        if ((self.first_model_only and pdbx_pdb_model_num != self.model)
+                or group_pdb != 'ATOM'):
+            return
+        self.atoms.append((label_comp_id, label_atom_id, type_symbol or ''))
+
+
+def _read_cif_atoms(fh, first_model_only):
+    h = _AtomSiteAtomHandler(first_model_only)
+    c = ihm.format.CifReader(fh, category_handler={'_atom_site': h})
+    c.read_file()  # read first block
+    return h.atoms
+
+
+def _get_radius(volume):
+    return math.pow(0.75 * volume / math.pi, 1. / 3.)
+
+
+def _get_residue_volume(residue):
+    return sum(ATOM_VOLUMES[name[0]] + hydrogens * ATOM_VOLUMES['H']
+               for name, hydrogens in _RESIDUE_HYDROGENS[residue].items())
+
+
+def average_radius(fname, first_model_only=False, explicit_hydrogens=False,
+                   residue=False, fh=None):
+    """Get the average atomic radius that FoXS uses for the excluded volume
+       of a PDB or mmCIF file, from the displaced volume of each atom it
+       reads (or, for residue-level profiles, of each residue). Options are
+       as for the FoXS run that computed the partial profiles; in
+       particular, `explicit_hydrogens` corresponds to FoXS -h (the web
+       service's default is implicit hydrogens). If `fh` is given, the
+       structure is read from it rather than from `fname` (which is then
+       only used to tell PDB from mmCIF). Return AVERAGE_RADIUS if the
+       file has no atoms."""
+    if fh is None:
+        with open(fname, encoding='latin1') as fh:
+            return average_radius(fname, first_model_only,
+                                  explicit_hydrogens, residue, fh)
+    if fname.endswith('.cif'):
+        atoms = _read_cif_atoms(fh, first_model_only)
+    else:
+        atoms = _read_pdb_atoms(fh, first_model_only)
+    radii = []
+    for res, name, element in atoms:
+        element = element.upper() or name.lstrip('0123456789')[:1]
+        if residue:
+            if name == 'CA' and res in _RESIDUE_HYDROGENS:
+                radii.append(_get_radius(_get_residue_volume(res)))
+        elif element in ('H', 'D'):
+            if explicit_hydrogens:
+                radii.append(_get_radius(ATOM_VOLUMES['H']))
+        elif element:
+            volume = ATOM_VOLUMES.get(element, ATOM_VOLUMES['C'])
+            if not explicit_hydrogens:
+                volume += (ATOM_VOLUMES['H']
+                           * _RESIDUE_HYDROGENS.get(res, {}).get(name, 0))
+            radii.append(_get_radius(volume))
+    return sum(radii) / len(radii) if radii else AVERAGE_RADIUS
+
+
+FitResult = collections.namedtuple(
+    'FitResult', ['chi2', 'c1', 'c2', 'scale', 'offset', 'default_chi2',
+                  'q', 'intensity', 'error', 'fit'])
+
+
+def read_partial_profile(fname):
+    """Read a partial profile file written by FoXS -p. Return the q values
+       and an (N, 3) or (N, 6) array of partial profiles (3 if the
+       hydration layer was not computed)."""
+    rows = []
+    with open(fname, encoding='latin1') as fh:
+        for line in fh:
+            if line.startswith('#'):
+                continue
+            spl = line.split()
+            if len(spl) in (4, 7):
+                rows.append([float(x) for x in spl])
+    if not rows or any(len(row) != len(rows[0]) for row in rows):
+        raise ValueError("%s is not a FoXS partial profile" % fname)
+    data = numpy.array(rows, dtype=numpy.float64)
+    return data[:, 0], data[:, 1:]
+
+
+def excluded_volume_factor(q, c1, radius=AVERAGE_RADIUS):
+    """Get the excluded volume form factor adjustment for the given c1
+       (which may be an array; the last axis of the result is q)"""
+    c1 = numpy.asarray(c1, dtype=numpy.float64)[..., numpy.newaxis]
+    # As in CRYSOL and FoXS
+    coeff = (-math.pow(4. * math.pi / 3., 1.5) * radius * radius
+             * (c1 * c1 - 1.) / (4. * math.pi))
+    return c1 ** 3 * numpy.exp(coeff * q * q)
+
+
+def combine_partial_profiles(partials, g, c2):
+    """Get the profile from partial profiles (the last axis of `partials`),
+       given the excluded volume factor `g` (see excluded_volume_factor)
+       and c2. All three are broadcast against each other, to get many
+       profiles at once; the last axis of the result is q."""
+    intensity = (partials[..., 0] + g * g * partials[..., 1]
+                 - 2. * g * partials[..., 2])
+    if partials.shape[-1] > 3:
+        intensity = (intensity + c2 * c2 * partials[..., 3]
+                     + 2. * c2 * partials[..., 4]
+                     - 2. * g * c2 * partials[..., 5])
+    return intensity
+
+
+def sum_partial_profiles(q, partials, c1, c2, radius=AVERAGE_RADIUS):
+    """Get the profile for the given c1 and c2 (which may be arrays, to
+       get many profiles at once; the last axis of the result is q)"""
+    g = excluded_volume_factor(q, c1, radius)
+    c2 = numpy.asarray(c2, dtype=numpy.float64)[..., numpy.newaxis]
+    return combine_partial_profiles(partials, g, c2)
+
+
+def _grid(rng, step):
+    lo, hi = rng
+    n = int(round((hi - lo) / step)) + 1
+    return numpy.linspace(lo, hi, max(n, 1))
+
+
+def _fit_scale(intensity, model, weights, offset):
+    """Get the best scale (and offset, if requested) to fit `model` to
+       `intensity`, and the resulting chi^2. The last axis is q."""
+    if offset:
+        sw = numpy.sum(weights)
+        sm = numpy.sum(weights * model, axis=-1)
+        si = numpy.sum(weights * intensity)
+        smm = numpy.sum(weights * model * model, axis=-1)
+        smi = numpy.sum(weights * model * intensity, axis=-1)
+        det = smm * sw - sm * sm
+        det = numpy.where(det == 0., 1e-300, det)
+        scale = (smi * sw - sm * si) / det
+        off = (smm * si - sm * smi) / det
+    else:
+        smm = numpy.sum(weights * model * model, axis=-1)
+        smm = numpy.where(smm == 0., 1e-300, smm)
+        scale = numpy.sum(weights * model * intensity, axis=-1) / smm
+        off = numpy.zeros_like(scale)
+    resid = (intensity - scale[..., numpy.newaxis] * model
+             - off[..., numpy.newaxis])
+    chi2 = numpy.sum(weights * resid * resid, axis=-1) / intensity.shape[-1]
+    return chi2, scale, off
+
+
+def prepare_exp_profile(profile, q_max, units=1):
+    """Get q, intensity and error arrays for an experimental profile (as
+       returned by exp_profile.load_profile), restricted to q <= q_max.
+       Units are as for FoXS -u: 1 (guess from the q range), 2 (1/A) or
+       3 (1/nm). Missing errors are estimated as 5% of the intensity."""
+    q = numpy.array(profile[:, 0])
+    if units == 3 or (units == 1 and len(q) > 0 and q.max() > 1.0):
+        q = q / 10.
+    intensity = numpy.array(profile[:, 1])
+    error = numpy.array(profile[:, 2])
+    error = numpy.where(numpy.isnan(error) | (error <= 0.),
+                        numpy.abs(intensity) * 0.05, error)
+    keep = (q <= q_max + 1e-6) & (error > 0.)
+    return q[keep], intensity[keep], error[keep]
+
+
+def interpolate_partials(exp_q, q, partials):
+    """Interpolate partial profiles onto the given q values. Profiles are
+       linear in the partials, so this is the same as interpolating the
+       profile itself."""
+    return numpy.column_stack([numpy.interp(exp_q, q, partials[:, i])
+                               for i in range(partials.shape[1])])
+
+
+def get_grid(c1_range, c2_range, nprofiles=6):
+    """Get the c1 and c2 values scanned over the given ranges (min, max)
+       for partial profiles with `nprofiles` columns"""
+    return (_grid(c1_range, C1_STEP),
+            _grid(c2_range, C2_STEP) if nprofiles > 3 else numpy.zeros(1))
+
+
+def _scan(exp, q, partials, c1_range, c2_range, offset, radius):
+    exp_q, exp_i, exp_err = exp
+    if len(exp_q) == 0:
+        raise ValueError("No experimental points within the profile q range")
+    ip = interpolate_partials(exp_q, q, partials)
+    weights = 1. / (exp_err * exp_err)
+    c1s, c2s = get_grid(c1_range, c2_range, ip.shape[1])
+    c1g, c2g = numpy.meshgrid(c1s, c2s, indexing='ij')
+    models = sum_partial_profiles(exp_q, ip, c1g, c2g, radius)
+    chi2, _, _ = _fit_scale(exp_i, models, weights, offset)
+    return c1s, c2s, chi2
+
+
+def scan_profile(exp, q, partials, c1_range=SCAN_C1_RANGE,
+                 c2_range=SCAN_C2_RANGE, offset=False, radius=AVERAGE_RADIUS):
+    """Fit the experimental profile `exp` (q, intensity, error arrays from
+       prepare_exp_profile) with the given partial profiles at every point
+       of a grid of c1 and c2 values over the given ranges (min, max).
+       `radius` is the structure's average_radius.
+       Return the c1 values, the c2 values, and a (len(c1), len(c2)) array
+       of the chi^2 of each fit."""
+    return _scan(exp, q, partials, c1_range, c2_range, offset, radius)
+
+
+def _search_cells(lo, hi, ncells, min_cell):
+    """Get the values of one parameter for a round of _search, and the
+       cell size, and whether the cells are as small as they can be"""
+    delta = (hi - lo) / ncells
+    if delta < min_cell:
+        ncells, delta = 1, hi - lo
+    return lo + delta * numpy.arange(ncells + 1), delta, delta == hi - lo
+
+
+def _search(exp_q, exp_i, weights, ip, c1_range, c2_range, offset, radius):
+    """Find the c1 and c2 that give the lowest chi^2, as FoXS does
+       (ProfileFitter::search_fit_parameters): each round fits every point
+       of a grid over the current ranges, then narrows the ranges to one
+       cell either side of the best point, until chi^2 stops changing"""
+    (min_c1, max_c1), (min_c2, max_c2) = c1_range, c2_range
+    ncells = SEARCH_CELLS[0]
+    old_chi2 = None
+    while True:
+        c1s, delta_c1, last_c1 = _search_cells(min_c1, max_c1, ncells,
+                                               SEARCH_MIN_C1_CELL)
+        c2s, delta_c2, last_c2 = _search_cells(min_c2, max_c2, ncells,
+                                               SEARCH_MIN_C2_CELL)
+        c1g, c2g = numpy.meshgrid(c1s, c2s, indexing='ij')
+        chi2 = _fit_scale(exp_i, sum_partial_profiles(exp_q, ip, c1g, c2g,
+                                                      radius),
+                          weights, offset)[0]
+        i, j = numpy.unravel_index(numpy.argmin(chi2), chi2.shape)
+        best_chi2, best_c1, best_c2 = chi2[i, j], c1s[i], c2s[j]
+        if ((old_chi2 is not None
+             and abs(best_chi2 - old_chi2) <= SEARCH_CHI2_TOLERANCE)
+                or (last_c1 and last_c2)):
+            return best_c1, best_c2
+        min_c1 = max(best_c1 - delta_c1, min_c1)
+        max_c1 = min(best_c1 + delta_c1, max_c1)
+        min_c2 = max(best_c2 - delta_c2, min_c2)
+        max_c2 = min(best_c2 + delta_c2, max_c2)
+        ncells = SEARCH_CELLS[1]
+        old_chi2 = best_chi2
+
+
+def fit_profile(exp, q, partials, c1_range=C1_RANGE, c2_range=C2_RANGE,
+                offset=False, radius=AVERAGE_RADIUS):
+    """Fit the experimental profile `exp` (q, intensity, error arrays from
+       prepare_exp_profile) with the given partial profiles, searching
+       c1 and c2 over the given ranges (min, max) as FoXS does, and return
+       a FitResult. Use the same value for min and max to fix a parameter.
+       `radius` is the structure's average_radius."""
+    exp_q, exp_i, exp_err = exp
+    if len(exp_q) == 0:
+        raise ValueError("No experimental points within the profile q range")
+    ip = interpolate_partials(exp_q, q, partials)
+    weights = 1. / (exp_err * exp_err)
+    if ip.shape[1] <= 3:
+        # No hydration layer, so c2 has no effect
+        c2_range = (0., 0.)
+    c1, c2 = _search(exp_q, exp_i, weights, ip, c1_range, c2_range, offset,
+                     radius)
+    model = sum_partial_profiles(exp_q, ip, c1, c2, radius)
+    chi2, scale, off = _fit_scale(exp_i, model, weights, offset)
+    default_chi2, _, _ = _fit_scale(
+        exp_i, sum_partial_profiles(exp_q, ip, 1.0, 0.0, radius), weights,
+        offset)
+    return FitResult(chi2=float(chi2), c1=float(c1), c2=float(c2),
+                     scale=float(scale), offset=float(off),
+                     default_chi2=float(default_chi2), q=exp_q,
+                     intensity=exp_i, error=exp_err, fit=scale * model + off)
+
+
+def fit_files(exp_profile_file, partial_profile_file, units=1, **kwargs):
+    """Fit an experimental profile file with a partial profile file"""
+    q, partials = read_partial_profile(partial_profile_file)
+    exp = prepare_exp_profile(exp_profile.load_profile(exp_profile_file),
+                              q[-1], units)
+    return fit_profile(exp, q, partials, **kwargs)
+
+
+def write_fit_file(fname, fit):
+    """Write a fit in the same format as FoXS (q, experimental intensity,
+       error, fitted intensity)"""
+    with open(fname, 'w') as fh:
+        fh.write("# chi^2 = %.6g c1 = %.4g c2 = %.4g scale = %.6g "
+                 "offset = %.6g\n" % (fit.chi2, fit.c1, fit.c2, fit.scale,
+                                      fit.offset))
+        fh.write("#  q  exp_intensity  error  model_intensity\n")
+        for row in zip(fit.q, fit.intensity, fit.error, fit.fit):
+            fh.write("%.8f %.8e %.8e %.8e\n" % row)
@@ -0,0 +1,113 @@
+"""Clustering of computed profiles before MultiFoXS.
+
+   The time taken by MultiFoXS grows rapidly with the number of profiles
+   it is given. Profiles that are similar contribute little to the search,
+   so the profiles are clustered (k-medoids) and only the medoid of each
+   cluster is given to MultiFoXS. The profiles given to MultiFoXS are the
+   partial profiles written by FoXS -p; each is clustered using its
+   profile with the default excluded volume and hydration layer
+   parameters. The distance between two profiles is the RMS difference of
+   their log intensities, after each is shifted to zero mean (so that
+   profiles differing only by a scale factor are identical)."""
+
+import numpy
+try:
+    from . import partial_profile
+except ImportError:  # run as a script, not as part of a package
+    import partial_profile
+
+
+# Number of rows of the distance matrix computed at once
+_CHUNK_SIZE = 256
+
+
+def load_profiles(dat_files):
+    """Load the intensities of a set of partial profiles, with the default
+       c1 and c2, into a single (N, M) array of centered log intensities,
+       one row per profile. All profiles are interpolated onto the q values
+       of the first."""
+    q = None
+    rows = []
+    for dat_file in dat_files:
+        pq, partials = partial_profile.read_partial_profile(dat_file)
+        if q is None:
+            q = pq
+        if not (len(pq) == len(q) and numpy.array_equal(pq, q)):
+            partials = partial_profile.interpolate_partials(q, pq, partials)
+        intensity = partial_profile.sum_partial_profiles(q, partials,
+                                                         1.0, 0.0)
+        rows.append(numpy.log(numpy.maximum(intensity, 1e-30)))
+    m = numpy.array(rows)
+    return m - m.mean(axis=1)[:, numpy.newaxis]
+
+
+def _distances(x, y):
+    """Get the (len(x), len(y)) matrix of profile distances"""
+    sq = (numpy.sum(x * x, axis=1)[:, numpy.newaxis]
+          + numpy.sum(y * y, axis=1)[numpy.newaxis, :] - 2. * x.dot(y.T))
+    return numpy.sqrt(numpy.maximum(sq, 0.) / x.shape[1])
+
+
+def _medoid(x):
+    """Get the index of the row of x with the smallest summed distance to
+       all other rows; the distance matrix is built a chunk at a time"""
+    total = numpy.empty(len(x))
+    for start in range(0, len(x), _CHUNK_SIZE):
+        total[start:start + _CHUNK_SIZE] = numpy.sum(
+            _distances(x[start:start + _CHUNK_SIZE], x), axis=1)
+    return int(numpy.argmin(total))
+
+
+def kmedoids(x, k, max_iter=50):
+    """Cluster the rows of x into k clusters by alternating assignment to
+       the nearest medoid and update of each medoid. Medoids are initialized
+       deterministically (farthest-first, starting from the row nearest the
+       mean). Return the indices of the medoids and the cluster index of
+       each row."""
+    k = min(k, len(x))
+    center = x.mean(axis=0)[numpy.newaxis, :]
+    medoids = [int(numpy.argmin(_distances(x, center)))]
+    nearest = _distances(x, x[medoids])[:, 0]
+    while len(medoids) < k:
+        i = int(numpy.argmax(nearest))
+        if nearest[i] == 0.:  # fewer than k distinct profiles
+            break
+        medoids.append(i)
+        nearest = numpy.minimum(nearest, _distances(x, x[i:i + 1])[:, 0])
+    medoids = numpy.array(medoids)
+    k = len(medoids)
+    for _ in range(max_iter):
+        labels = numpy.argmin(_distances(x, x[medoids]), axis=1)
+        # Each medoid is always in its own cluster
+        labels[medoids] = numpy.arange(k)
+        new_medoids = medoids.copy()
+        for c in range(k):
+            members = numpy.flatnonzero(labels == c)
+            new_medoids[c] = members[_medoid(x[members])]
+        if numpy.array_equal(new_medoids, medoids):
+            break
+        medoids = new_medoids
+    return medoids, labels
+
+
+def cluster_profiles(dat_files, k):
+    """Cluster profiles into (at most) k clusters. Return a list of
+       (medoid, members) pairs, where members includes the medoid, in the
+       order the medoids first appear in dat_files."""
+    medoids, labels = kmedoids(load_profiles(dat_files), k)
+    order = sorted(range(len(medoids)), key=lambda c: medoids[c])
+    return [(dat_files[medoids[c]],
+             [d for d, label in zip(dat_files, labels) if label == c])
+            for c in order]
+
+
+def write_clusters(fname, clusters, refine):
+    """Write clusters from cluster_profiles to a file, one per line
+       (medoid first). `refine` is True if the members of selected clusters
+       were searched again."""
+    with open(fname, 'w') as fh:
+        fh.write("# k-medoids clusters %d refine %d\n"
+                 % (len(clusters), 1 if refine else 0))
+        for medoid, members in clusters:
+            fh.write(" ".join([medoid] + [m for m in members if m != medoid])
+                     + "\n")
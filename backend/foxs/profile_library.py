@@ -0,0 +1,159 @@
+"""Library of precomputed profiles of popular structures.
+
+   Many jobs fit well-known PDB entries with the default options. For
+   jobs whose fits are done from partial profiles (those from batch
+   submissions, which share profiles, and multi-profile jobs), the
+   partial profiles of such structures can be computed in advance, for a
+   set of option presets, with this script, e.g.
+   `python3 profile_library.py --presets presets.conf LIBRARY FILE...`.
+   The structure files should be the same files that jobs get (e.g. those
+   in the frontend's PDB cache, filled with `flask warm-pdb-cache`), as
+   profiles are looked up by a hash of the file contents and options, as
+   for the profile store (see profile_store.py). The library is read-only
+   for jobs; run_foxs.py takes any partial profiles it needs from it
+   before running FoXS. An index of the library's profiles is kept in
+   INDEX_FILE."""
+
+import argparse
+import configparser
+import os
+import shutil
+import subprocess
+import tempfile
+try:
+    from . import profile_store
+except ImportError:  # run as a script, not as part of a package
+    import profile_store
+
+
+# Index of the profiles in the library: one line per profile, with the
+# key, the preset name and the name of the structure file
+INDEX_FILE = 'index.txt'
+
+
+def read_index(directory):
+    """Read the index of a library, as a dict of key: (preset, structure).
+       A library that has not been built yet is empty."""
+    index = {}
+    try:
+        with open(os.path.join(directory, INDEX_FILE)) as fh:
+            for line in fh:
+                key, preset, structure = line.rstrip('\r\n').split(' ', 2)
+                index[key] = (preset, structure)
+    except FileNotFoundError:
+        pass
+    return index
+
+
+def write_index(directory, index):
+    fname = os.path.join(directory, INDEX_FILE)
+    with open(fname + '.tmp', 'w') as fh:
+        for key in sorted(index):
+            fh.write("%s %s %s\n" % ((key,) + index[key]))
+    os.rename(fname + '.tmp', fname)
+
+
+class ProfileLibrary(object):
+    """Read-only access to a library of precomputed profiles"""
+    def __init__(self, directory):
+        self.store = profile_store.ProfileStore(directory)
+        self.index = read_index(directory)
+
+    def fetch(self, fname, options, dest):
+        """Put the precomputed profile of structure `fname` with the given
+           FoXS options, if any, at `dest`. Return True iff it was found."""
+        if not self.index:
+            return False
+        key = self.store.get_key(fname, options)
+        return key in self.index and self.store.fetch(key, dest)
+
+
+def read_presets(fname):
+    """Read option presets from a configuration file, one section per
+       preset. Return a list of (name, FoXS options) pairs."""
+    config = configparser.ConfigParser()
+    with open(fname) as fh:
+        config.read_file(fh)
+    presets = []
+    for name in config.sections():
+        section = config[name]
+        model_option = section.getint('model_option', 3)
+        if model_option == 2:
+            # Submodels are not known until the job runs
+            raise ValueError("Preset %s: profiles of multi-model files "
+                             "cannot be precomputed" % name)
+        presets.append((name, profile_store.get_profile_options(
+            model_option=model_option, q=section.getfloat('q', 0.5),
+            psize=section.getint('psize', 500),
+            ihydrogens=section.getboolean('ihydrogens', True),
+            residue=section.getboolean('residue', False))))
+    return presets
+
+
+def compute_profiles(structures, options, cwd):
+    """Compute partial profiles for structures in directory `cwd`"""
+    subprocess.check_call(['foxs'] + options + ['-p', '--'] + structures,
+                          cwd=cwd)
+
+
+def build(directory, presets, structures):
+    """Add profiles of the given structure files, for each (name, options)
+       preset, to the library in `directory`. Profiles already in the
+       library are not computed again. Return the number added."""
+    os.makedirs(directory, exist_ok=True)
+    store = profile_store.ProfileStore(directory)
+    index = read_index(directory)
+    nadded = 0
+    for name, options in presets:
+        keys = {}
+        for structure in structures:
+            key = store.get_key(structure, options)
+            if key not in index:
+                keys[key] = structure
+        if not keys:
+            continue
+        tmpdir = tempfile.mkdtemp(dir=directory)
+        try:
+            # Copy each structure, under its own name, to a subdirectory
+            # (names may not be unique)
+            work = []
+            for i, (key, structure) in enumerate(keys.items()):
+                os.mkdir(os.path.join(tmpdir, str(i)))
+                work.append((key, structure, os.path.join(
+                    str(i), os.path.basename(structure))))
+                shutil.copyfile(structure, os.path.join(tmpdir, work[-1][2]))
+            compute_profiles([w[2] for w in work], options, tmpdir)
+            for key, structure, copy in work:
+                store.put(key, os.path.join(tmpdir, copy + '.dat'))
+                index[key] = (name, os.path.basename(structure))
+                nadded += 1
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            write_index(directory, index)
+    return nadded
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Add precomputed profiles to a FoXS profile library",
+        fromfile_prefix_chars='@')
+    parser.add_argument('--presets', required=True,
+                        help="Configuration file of FoXS option presets, "
+                             "one section per preset, with any of q, "
+                             "psize, ihydrogens, residue and model_option")
+    parser.add_argument('library', help="Library directory")
+    parser.add_argument('structures', nargs='+',
+                        help="PDB or mmCIF files (or @FILE to read a list "
+                             "of files, one per line, from FILE)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    nadded = build(args.library, read_presets(args.presets),
+                   args.structures)
+    print("Added %d profiles to library %s" % (nadded, args.library))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""Sharing of computed structure profiles between jobs.
+
+   Partial profiles computed by FoXS are kept in a directory shared by all
+   jobs, keyed by a hash of the structure file and of the FoXS options that
+   affect the profile, so that jobs fitting the same structures (e.g. those
+   from a batch submission) compute each profile only once. A job that
+   starts computing a profile claims it with a lock file; other jobs that
+   need the same profile wait for it rather than computing it again."""
+
+import errno
+import hashlib
+import os
+import shutil
+import time
+
+
+# Change this if the way profiles are computed changes, so that profiles
+# in existing stores are not reused
+STORE_VERSION = 1
+
+
+def get_profile_options(model_option, q, psize, ihydrogens, residue):
+    """Get the FoXS options that affect the computed profiles (but not the
+       fit), and so are part of the key"""
+    opts = ['-m', str(model_option), '-q', str(q), '-s', str(psize)]
+    if not ihydrogens:
+        opts.append('-h')
+    if residue:
+        opts.append('-r')
+    return opts
+
+
+class ProfileStore(object):
+    def __init__(self, directory, wait_time=3600, poll_interval=5):
+        self.directory = directory
+        # Maximum time to wait for another job's profile, in seconds;
+        # locks older than this are assumed to be left over from failed jobs
+        self.wait_time = wait_time
+        self.poll_interval = poll_interval
+
+    def get_key(self, fname, options):
+        """Get the key for a structure file profiled with FoXS options"""
+        h = hashlib.sha256()
+        h.update(("%d %s\n" % (STORE_VERSION, " ".join(options))).encode(
+            'utf-8'))
+        with open(fname, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(1024 * 1024), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def _get_path(self, key, ext):
+        return os.path.join(self.directory, key[:2], key + ext)
+
+    def fetch(self, key, dest):
+        """Put the stored profile for `key`, if any, at `dest`.
+           Return True iff it was found."""
+        src = self._get_path(key, '.dat')
+        if not os.path.exists(src):
+            return False
+        try:
+            os.link(src, dest)
+        except OSError:
+            shutil.copyfile(src, dest)
+        return True
+
+    def claim(self, key):
+        """Try to claim the profile for `key`, to compute it. Return False
+           if another job is already computing it."""
+        lock = self._get_path(key, '.lock')
+        os.makedirs(os.path.dirname(lock), exist_ok=True)
+        for attempt in range(2):
+            try:
+                os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return True
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+            try:
+                if time.time() - os.stat(lock).st_mtime < self.wait_time:
+                    return False
+                os.unlink(lock)
+            except FileNotFoundError:
+                pass
+        return False
+
+    def release(self, key):
+        """Release a claim made with claim()"""
+        try:
+            os.unlink(self._get_path(key, '.lock'))
+        except FileNotFoundError:
+            pass
+
+    def put(self, key, src):
+        """Add the profile `src` to the store, and release our claim"""
+        dest = self._get_path(key, '.dat')
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp = dest + '.%d.tmp' % os.getpid()
+        shutil.copyfile(src, tmp)
+        os.rename(tmp, dest)
+        self.release(key)
+
+    def wait_fetch(self, key, dest):
+        """Wait for another job to compute the profile for `key`, then put
+           it at `dest`. Return False if it was not computed, i.e. the other
+           job failed or took too long."""
+        deadline = time.time() + self.wait_time
+        while True:
+            if self.fetch(key, dest):
+                return True
+            if (not os.path.exists(self._get_path(key, '.lock'))
+                    or time.time() > deadline):
+                # Check once more in case the profile was added just now
+                return self.fetch(key, dest)
+            time.sleep(self.poll_interval)
@@ -2,20 +2,65 @@ from __future__ import print_function
 import sys
 import os
 import contextlib
+import io
 import subprocess
 import glob
+import shutil
+import heapq
+import re
+import argparse
+import fnmatch
+import tempfile
 import traceback
+import json
+import concurrent.futures
+import numpy
 import ihm.format
+try:
+    from . import conformers, exp_profile, partial_profile, profile_store
+    from . import profile_clusters, profile_library
+except ImportError:  # run as a script, not as part of a package
+    import conformers
+    import exp_profile
+    import partial_profile
+    import profile_store
+    import profile_clusters
+    import profile_library
+
+
+# Name of the original job, for a refit
+# (should match that in frontend/foxs/refit.py)
+REFIT_FILE = 'refit-from.txt'
+
+# Name of the original job and the new maximum ensemble size, to continue
+# an ensemble search (should match that in frontend/foxs/continue_search.py)
+CONTINUE_FILE = 'continue-from.txt'
+
+# Largest ensemble size MultiFoXS is normally run with, and the largest
+# shown in the results (the latter should match that in
+# frontend/foxs/continue_search.py)
+MAX_SUBSET_SIZE = 5
+MAX_STATES = 4
 
 
 class JobParameters(object):
     """Store job parameters read from files created by the frontend"""
-    def __init__(self):
+    def __init__(self, batch_shard_size=100, batch_pool_size=100,
+                 profile_store=None, multifoxs_shard_size=0,
+                 profile_library=None):
         with open('data.txt') as fh:
             line = fh.readline().rstrip('\r\n')
+        # Fields after the first 15 were added later, so are optional
+        fields = line.split()
         (prot_file_name, self.profile_file_name, email, q, psize, hlayer,
          exvolume, ihydrogens, residue, offset, background, hlayer_value,
-         exvolume_value, model_option, unit_option) = line.split()
+         exvolume_value, model_option, unit_option) = fields[:15]
+        batch = fields[15] if len(fields) > 15 else "0"
+        share = fields[16] if len(fields) > 16 else "0"
+        scan = fields[17] if len(fields) > 17 else "0"
+        dedup_rmsd = fields[18] if len(fields) > 18 else "0"
+        nclusters = fields[19] if len(fields) > 19 else "0"
+        cluster_refine = fields[20] if len(fields) > 20 else "0"
         if self.profile_file_name == '-':
             self.profile_file_name = None
         self.q = float(q)
@@ -30,8 +75,34 @@ class JobParameters(object):
         self.exvolume_value = float(exvolume_value)
         self.model_option = int(model_option)
         self.unit_option = int(unit_option)
+        self.batch = batch == "1"
+        self.batch_shard_size = batch_shard_size
+        self.batch_pool_size = batch_pool_size
+        self.share = share == "1"
+        self.scan = scan == "1"
+        self.dedup_rmsd = float(dedup_rmsd)
+        self.profile_clusters = int(nclusters)
+        self.cluster_refine = cluster_refine == "1"
+        self.profile_store = profile_store
+        self.profile_library = profile_library
+        self.multifoxs_shard_size = multifoxs_shard_size
         with open('inputFiles.txt') as fh:
             self.pdb_file_names = [f.strip() for f in fh]
+        # More than one profile can be given, in multi-profile mode
+        if os.path.exists('profiles.txt'):
+            with open('profiles.txt') as fh:
+                self.profile_file_names = [f.strip() for f in fh]
+        elif self.profile_file_name:
+            self.profile_file_names = [self.profile_file_name]
+        else:
+            self.profile_file_names = []
+        # Refits reuse the partial profiles of an earlier job
+        self.refit = os.path.exists(REFIT_FILE)
+        # Continued ensemble searches reuse all profiles of an earlier job
+        self.continue_size = None
+        if os.path.exists(CONTINUE_FILE):
+            with open(CONTINUE_FILE) as fh:
+                self.continue_size = int(fh.readline().split()[1])
 
 
 def set_job_state(state):
@@ -92,26 +163,41 @@ def get_command_options(p):
     return foxs_opts, mf_opts
 
 
+# Byte ranges of the submodels of multi-model PDB files, which are only
+# written to their own files when needed (should match that in
+# frontend/foxs/submodels.py)
+SUBMODEL_INDEX_FILE = 'submodel-ranges.txt'
+
+
 def setup_multimodel(params):
-    """If we're using multi-model PDBs, make PDBs for each submodel"""
+    """If we're using multi-model files, list their submodels. FoXS reads
+       the multi-model files itself. Submodels of mmCIF files are written to
+       their own files now, but those of PDB files are only recorded as byte
+       ranges of the original file (see write_submodels)."""
     if params.model_option != 2:
         return
     mmpdbs = []
+    ranges = []
     for pdb in params.pdb_file_names:
-        mmpdbs.extend(make_multimodel_pdb_or_cif(pdb))
+        if pdb.endswith('.cif'):
+            mmpdbs.extend(make_multimodel_cif(pdb))
+        else:
+            submodels = find_pdb_submodels(pdb)
+            ranges.extend(submodels)
+            mmpdbs.extend([s[0] for s in submodels] or [pdb])
     with open('multi-model-files.txt', 'w') as fh:
         fh.write("\n".join(mmpdbs))
+    if ranges:
+        with open(SUBMODEL_INDEX_FILE, 'w') as fh:
+            for submodel in ranges:
+                fh.write("%s %s %d %d\n" % submodel)
 
 
-def make_multimodel_pdb_or_cif(fname):
-    """If the given file is a multimodel PDB or mmCIF, make PDB/mmCIF files for
-       each submodel and return them. Mimic FoXS itself; i.e. number the
-       models sequentially (ignore the number on the MODEL line) and skip
-       any model that contains no atoms."""
-    if fname.endswith('.cif'):
-        submodels = _make_multimodel_cif(fname)
-    else:
-        submodels = _make_multimodel_pdb(fname)
+def make_multimodel_cif(fname):
+    """If the given file is a multimodel mmCIF, make mmCIF files for each
+       submodel and return them. Mimic FoXS itself; i.e. skip any model
+       that contains no atoms."""
+    submodels = _make_multimodel_cif(fname)
     # If only one model, FoXS just uses the original file
     if len(submodels) == 1:
         os.unlink(submodels[0])
@@ -119,6 +205,73 @@ def make_multimodel_pdb_or_cif(fname):
     return submodels or [fname]
 
 
+def find_pdb_submodels(pdb):
+    """Find the submodels of a multimodel PDB file. Mimic FoXS itself; i.e.
+       number the models sequentially (ignore the number on the MODEL line)
+       and skip any model that contains no atoms. Return a list of
+       (submodel file name, pdb, start, end) tuples, where start and end
+       are the byte range of the submodel in the file, or an empty list if
+       the file does not contain more than one model."""
+    stem = os.path.splitext(pdb)[0]
+    models = []  # [start, end, number of atoms]
+    offset = 0
+    with open(pdb, 'rb') as fh:
+        for line in fh:
+            if line.startswith(b'MODEL '):
+                if models:
+                    models[-1][1] = offset
+                models.append([offset + len(line), None, 0])
+            elif models and line.startswith((b'ATOM', b'HETATM')):
+                models[-1][2] += 1
+            offset += len(line)
+    if models:
+        models[-1][1] = offset
+    ranges = [(start, end) for start, end, natom in models if natom > 0]
+    if len(ranges) == 1:
+        return []
+    return [("%s_m%d.pdb" % (stem, i + 1), pdb, start, end)
+            for i, (start, end) in enumerate(ranges)]
+
+
+def read_submodel(pdb, start, end):
+    """Get the contents of a submodel of a PDB file, given its byte range"""
+    with open(pdb, 'rb') as fh:
+        fh.seek(start)
+        data = fh.read(end - start)
+    return b"".join(line for line in data.splitlines(True)
+                    if not line.startswith(b'ENDMDL'))
+
+
+def read_submodel_ranges():
+    """Get a dict of (pdb, start, end) byte ranges of the submodels of
+       multi-model PDB files, keyed by submodel file name"""
+    if not os.path.exists(SUBMODEL_INDEX_FILE):
+        return {}
+    with open(SUBMODEL_INDEX_FILE) as fh:
+        return dict((s[0], (s[1], int(s[2]), int(s[3])))
+                    for s in (line.split() for line in fh))
+
+
+def open_structure(name, ranges):
+    """Open a structure file for reading. A submodel of a PDB file that
+       was not written out is read from its byte range (see
+       read_submodel_ranges) in the original file instead."""
+    if name in ranges and not os.path.exists(name):
+        return io.StringIO(read_submodel(*ranges[name]).decode('latin1'))
+    return open(name, encoding='latin1')
+
+
+def write_submodels(names):
+    """Make sure that files exist for the given structures, writing any
+       submodels of PDB files that were not yet written out"""
+    ranges = read_submodel_ranges()
+    for name in names:
+        if name in ranges and not os.path.exists(name):
+            with open(name + '.tmp', 'wb') as fh:
+                fh.write(read_submodel(*ranges[name]))
+            os.rename(name + '.tmp', name)
+
+
 class _AtomSiteSplitHandler:
     """Read the _atom_site table from an mmCIF file, and split it between
        multiple output files, one for each unique pdbx_pdb_model_num"""
@@ -176,40 +329,13 @@ def _make_multimodel_cif(fname):
         return ash.submodels
 
 
-def _make_multimodel_pdb(pdb):
-    nmodel = 0
-    natom = 0
-    fname, ext = os.path.splitext(pdb)
-    subpdbs = []
-    outfh = None
-    with open(pdb) as fh:
-        for line in fh:
-            if line.startswith('MODEL '):
-                if outfh is not None:
-                    outfh.close()
-                    if natom == 0:
-                        del subpdbs[-1]
-                        nmodel -= 1
-                natom = 0
-                nmodel += 1
-                modelfn = "%s_m%d.pdb" % (fname, nmodel)
-                subpdbs.append(modelfn)
-                outfh = open(modelfn, 'w')
-            elif line.startswith('ENDMDL'):
-                continue
-            elif outfh is not None:
-                if line.startswith('ATOM') or line.startswith('HETATM'):
-                    natom += 1
-                outfh.write(line)
-    if outfh is not None:
-        outfh.close()
-        if natom == 0:
-            os.unlink(subpdbs[-1])
-            del subpdbs[-1]
-    return subpdbs
-
-
 def run_job(params):
+    if params.continue_size:
+        run_continue(params)
+        return
+    if params.refit:
+        run_refit(params)
+        return
     setup_multimodel(params)
 
     print("Start profile computation analysis")
@@ -220,14 +346,28 @@ def run_job(params):
                       + glob.glob('**/*.png', recursive=True)
                       + glob.glob('**/*.dat', recursive=True)):
         os.unlink(old_fname)
+    if params.batch:
+        run_batch(params, foxs_opts, multi_foxs_opts)
+        return
+    if len(params.profile_file_names) > 1:
+        run_multi_profile(params, multi_foxs_opts)
+        return
+    if use_profile_store(params) or use_profile_library(params):
+        run_shared(params, multi_foxs_opts, fetch_library_profiles(params))
+        return
     # Run FoXS
     run_subprocess(['foxs'] + foxs_opts)
-    # Make plots
-    run_subprocess(['gnuplot'] + glob.glob('**/*.plt', recursive=True))
+    # Make plots. Interactive plots are drawn in the browser from the
+    # profiles, so we don't need the gnuplot canvas output
+    run_subprocess(['gnuplot'] + [plt for plt in
+                                  glob.glob('**/*.plt', recursive=True)
+                                  if not is_canvas_script(plt)])
 
     png_files = glob.glob("**/*.png", recursive=True)
     if len(png_files) == 0:
         raise RuntimeError("No plot pngs produced")
+    if params.scan:
+        write_chi_landscape(params)
 
     # Run MultiFoXS if necessary
     dat_files = (glob.glob("**/*.pdb.dat", recursive=True)
@@ -237,73 +377,700 @@ def run_job(params):
         run_multifoxs(params, multi_foxs_opts)
 
 
-def run_multifoxs(params, mf_opts):
+def run_batch(params, foxs_opts, mf_opts):
+    """Run FoXS on a large number of structures, in shards of
+       params.batch_shard_size input files, writing a summary of the fit
+       of every structure to batch-summary.txt. Only the profiles of the
+       params.batch_pool_size best-fitting structures are kept, and these
+       are given to MultiFoXS."""
+    if not params.profile_file_name:
+        raise RuntimeError("Batch mode requires an experimental profile")
+    # Don't make per-structure plots or Jmol tables
+    foxs_opts = [o for o in foxs_opts[:foxs_opts.index('--')]
+                 if o not in ('-j', '-g')]
+    profile_stem = os.path.splitext(params.profile_file_name)[0]
+    pool = []  # heap of (-chi, structure name) for the best structures
+    with open('batch-summary.txt', 'w') as summary:
+        for start in range(0, len(params.pdb_file_names),
+                           params.batch_shard_size):
+            shard = params.pdb_file_names[start:start
+                                          + params.batch_shard_size]
+            with open('batch-shard.log', 'w') as fh:
+                run_subprocess(['foxs'] + foxs_opts + ['--'] + shard
+                               + [params.profile_file_name], stdout=fh)
+            with open('batch-shard.log') as fh:
+                shard_log = fh.read()
+            # Keep the FoXS output in our own log
+            sys.stdout.write(shard_log)
+            for name, chi, c1, c2 in parse_fit_lines(shard_log):
+                summary.write("%s %s %s %s\n" % (name, chi, c1, c2))
+                heapq.heappush(pool, (-float(chi), name))
+                if len(pool) > params.batch_pool_size:
+                    _, worst = heapq.heappop(pool)
+                    _remove_batch_outputs(worst, profile_stem)
+            summary.flush()
+    os.unlink('batch-shard.log')
+    write_batch_index('batch-summary.txt', 'batch-summary.idx')
+
+    # Best-fitting structures first
+    pool_names = [name for _, name in sorted(pool, reverse=True)]
+    if len(pool_names) > 1:
+        run_multifoxs(params, mf_opts,
+                      dat_files=[name + '.dat' for name in pool_names],
+                      rg_file_names=pool_names)
+
+
+def can_use_partial_profiles(params):
+    """Return True iff this job can be fit using partial profiles computed
+       separately from the fit. Profiles of multi-model files cannot be
+       (the submodels are not known until the job runs) and background
+       adjustment of the experimental profile is only done by FoXS
+       itself."""
+    return bool(params.profile_file_name and params.model_option != 2
+                and not params.background)
+
+
+def use_profile_store(params):
+    """Return True iff this job can share structure profiles with other
+       jobs"""
+    return bool(params.share and params.profile_store
+                and can_use_partial_profiles(params))
+
+
+def use_profile_library(params):
+    """Return True iff this job can use precomputed profiles from the
+       profile library. Only jobs that are fit here from partial profiles
+       anyway (those sharing profiles with other jobs, and multi-profile
+       jobs) use it; other jobs need FoXS itself to do the fit and make
+       the Jmol table."""
+    return bool(params.profile_library and not params.refit
+                and can_use_partial_profiles(params)
+                and (params.share or len(params.profile_file_names) > 1))
+
+
+def fetch_library_profiles(params):
+    """Put the partial profiles of any of this job's structures that are
+       in the profile library at <structure>.dat. Return the structures
+       that were not found."""
+    if not use_profile_library(params):
+        return params.pdb_file_names
+    library = profile_library.ProfileLibrary(params.profile_library)
+    opts = get_profile_options(params)
+    missing = [pdb for pdb in params.pdb_file_names
+               if not library.fetch(pdb, opts, pdb + '.dat')]
+    if len(missing) < len(params.pdb_file_names):
+        print("Using %d precomputed profiles from the profile library"
+              % (len(params.pdb_file_names) - len(missing)))
+    return missing
+
+
+def get_profile_options(p):
+    """Get the FoXS options that affect the computed profiles
+       (but not the fit)"""
+    return profile_store.get_profile_options(
+        model_option=p.model_option, q=p.q, psize=p.psize,
+        ihydrogens=p.ihydrogens, residue=p.residue)
+
+
+def run_shared(params, mf_opts, pdbs=None):
+    """Fit the experimental profile using partial profiles for each
+       structure. Profiles of `pdbs` (by default, all structures; the
+       others were taken from the profile library) are taken from the
+       profile store shared with other jobs where possible; only the
+       others are computed with FoXS (and added to the store). The fits
+       are then done here."""
+    get_partial_profiles(
+        params, profile_store.ProfileStore(params.profile_store)
+        if use_profile_store(params) else None, pdbs)
+    fit_partial_profiles(params)
+    if params.scan:
+        write_chi_landscape(params)
+    if len(params.pdb_file_names) > 1:
+        run_multifoxs(params, mf_opts)
+
+
+def run_refit(params):
+    """Redo only the fit of an earlier job with new fit parameters. The
+       structures, profiles and partial profiles were copied from that job
+       by the frontend (multi-model files were already split into their
+       submodels, though submodels of PDB files may not have been written
+       out yet), so FoXS itself is not needed."""
+    with open(REFIT_FILE) as fh:
+        print("Refit using partial profiles from job %s" % fh.read().strip())
+    # Structure files are needed for Rg and conformer RMSD
+    write_submodels(params.pdb_file_names)
+    _, mf_opts = get_command_options(params)
+    if len(params.profile_file_names) > 1:
+        run_multi_profile(params, mf_opts)
+        return
+    fit_partial_profiles(params)
+    if params.scan:
+        write_chi_landscape(params)
+    if len(params.pdb_file_names) > 1:
+        run_multifoxs(params, mf_opts)
+
+
+def get_partial_profiles(params, store=None, pdbs=None):
+    """Get partial profiles for the given structures (by default, all),
+       using the given ProfileStore (if any) for profiles already computed
+       by other jobs"""
+    if params.refit:
+        # Copied from the original job
+        return
+    if pdbs is None:
+        pdbs = params.pdb_file_names
+    opts = get_profile_options(params)
+    if store is None:
+        compute_partial_profiles(pdbs, opts)
+        return
+    keys = dict((pdb, store.get_key(pdb, opts)) for pdb in pdbs)
+    claimed = []
+    waiting = []
+    for pdb in pdbs:
+        if store.fetch(keys[pdb], pdb + '.dat'):
+            continue
+        elif store.claim(keys[pdb]):
+            claimed.append(pdb)
+        else:
+            waiting.append(pdb)
+    try:
+        compute_partial_profiles(claimed, opts)
+        for pdb in claimed:
+            store.put(keys[pdb], pdb + '.dat')
+    finally:
+        for pdb in claimed:
+            store.release(keys[pdb])
+    # Compute ourselves any profiles that another job failed to finish
+    compute_partial_profiles(
+        [pdb for pdb in waiting
+         if not store.wait_fetch(keys[pdb], pdb + '.dat')], opts)
+
+
+def compute_partial_profiles(pdbs, opts):
+    """Compute partial profiles for the given structures with FoXS"""
+    if pdbs:
+        run_subprocess(['foxs'] + opts + ['-p', '--'] + pdbs)
+
+
+def get_fit_ranges(params):
+    """Get the ranges (min, max) of c1 and c2 used for fits"""
+    c1_range = (partial_profile.C1_RANGE if params.exvolume
+                else (params.exvolume_value, params.exvolume_value))
+    c2_range = (partial_profile.C2_RANGE if params.hlayer
+                else (params.hlayer_value, params.hlayer_value))
+    return c1_range, c2_range
+
+
+def get_average_radii(params, structures):
+    """Get the average atomic radius that FoXS used for the excluded volume
+       when it computed each of the given structures' partial profiles.
+       Submodels of multi-model PDB files need not have been written out."""
+    ranges = read_submodel_ranges()
+    radii = []
+    for structure in structures:
+        with open_structure(structure, ranges) as fh:
+            radii.append(partial_profile.average_radius(
+                structure, first_model_only=params.model_option == 1,
+                explicit_hydrogens=not params.ihydrogens,
+                residue=params.residue, fh=fh))
+    return radii
+
+
+def fit_partial_profile(params, profile, structure, radius):
+    """Fit the partial profile for the given structure, with the given
+       average radius (see get_average_radii), to an experimental
+       profile, write the fit in the same form as FoXS, and return the fit
+       and its FoXS-style log line"""
+    c1_range, c2_range = get_fit_ranges(params)
+    fit = partial_profile.fit_files(
+        profile, structure + '.dat', units=params.unit_option,
+        c1_range=c1_range, c2_range=c2_range, offset=params.offset,
+        radius=radius)
+    fit_file = get_fit_file_name(structure, profile)
+    partial_profile.write_fit_file(fit_file, fit)
+    log = ("%s %s Chi^2 = %f c1 = %f c2 = %f default chi^2 = %f"
+           % (structure, profile, fit.chi2, fit.c1, fit.c2,
+              fit.default_chi2))
+    return fit, log
+
+
+def get_fit_file_name(structure, profile):
+    """Get the name of the file FoXS writes for a fit"""
+    return "%s_%s.dat" % (os.path.splitext(structure)[0],
+                          os.path.splitext(profile)[0])
+
+
+def fit_partial_profiles(params):
+    """Fit each structure's partial profile to the experimental profile,
+       writing the fits and log in the same form as FoXS, plus plots"""
+    fit_files = []
+    radii = get_average_radii(params, params.pdb_file_names)
+    for pdb, radius in zip(params.pdb_file_names, radii):
+        fit, log = fit_partial_profile(params, params.profile_file_name, pdb,
+                                       radius)
+        fit_files.append(get_fit_file_name(pdb, params.profile_file_name))
+        print(log)
+    write_fit_plots(params.pdb_file_names, fit_files, 'shared_plots.plt')
+    run_subprocess(['gnuplot', 'shared_plots.plt'])
+
+
+# Fit of every structure over the full c1 x c2 grid
+# (should match that in frontend/foxs/landscape.py)
+CHI_LANDSCAPE_FILE = 'chi-landscape.npz'
+
+
+def write_chi_landscape(params):
+    """Fit the experimental profile with each structure's partial profile
+       at every point of a c1 x c2 grid covering FoXS's own ranges and any
+       fixed c1 or c2 that could be used for the fit, to show how sensitive
+       the fit is to these parameters. The chi^2 values are written as a
+       (structures, c1, c2) array, plus the c1 and c2 values and the
+       structure (profile) names."""
+    exp = exp_profile.load_profile(params.profile_file_name)
+    structures = [dat_file[:-4] for pdb in params.pdb_file_names
+                  for dat_file in dat_files_for_pdb(pdb)]
+    chi2 = []
+    radii = get_average_radii(params, structures)
+    for structure, radius in zip(structures, radii):
+        q, partials = partial_profile.read_partial_profile(structure + '.dat')
+        c1s, c2s, chi = partial_profile.scan_profile(
+            partial_profile.prepare_exp_profile(exp, q[-1],
+                                                params.unit_option),
+            q, partials, offset=params.offset, radius=radius)
+        chi2.append(chi)
+    if not chi2:
+        raise RuntimeError("No partial profiles to scan")
+    if any(c.shape != chi2[0].shape for c in chi2):
+        raise RuntimeError("Inconsistent partial profiles; cannot scan")
+    tmp = CHI_LANDSCAPE_FILE + '.tmp'
+    with open(tmp, 'wb') as fh:
+        numpy.savez(fh, c1=c1s, c2=c2s, chi2=numpy.array(chi2),
+                    structures=numpy.array(structures))
+    os.rename(tmp, CHI_LANDSCAPE_FILE)
+
+
+def write_fit_plots(pdbs, fit_files, plt_file):
+    """Write a gnuplot script to plot each profile and fit, plus all of
+       them together if there is more than one, with the same file names
+       as FoXS's own plots"""
+    # The profile at c1=1, c2=0 from the partial profiles
+    profile_expr = "1:($2+$3-2*$4)"
+    with open(plt_file, 'w') as fh:
+        fh.write("set terminal png enhanced\nset logscale y\n"
+                 "set xlabel 'q'\nset ylabel 'intensity (log-scale)'\n")
+        for pdb, fit_file in zip(pdbs, fit_files):
+            fh.write("set output '%s.png'\n" % os.path.splitext(pdb)[0])
+            fh.write("plot '%s.dat' u %s t '%s' w lines lw 2\n"
+                     % (pdb, profile_expr, pdb))
+            fh.write("set output '%s.png'\n" % os.path.splitext(fit_file)[0])
+            fh.write("plot '%s' u 1:2 t 'experimental' w points pt 7 ps 0.5,"
+                     " '' u 1:4 t '%s' w lines lw 2\n" % (fit_file, pdb))
+        if len(pdbs) > 1:
+            fh.write("set output 'profiles.png'\nplot "
+                     + ", ".join("'%s.dat' u %s t '%s' w lines lw 2"
+                                 % (pdb, profile_expr, pdb) for pdb in pdbs)
+                     + "\n")
+            fh.write("set output 'fit.png'\nplot '%s' u 1:2 t 'experimental'"
+                     " w points pt 7 ps 0.5, " % fit_files[0]
+                     + ", ".join("'%s' u 1:4 t '%s' w lines lw 2"
+                                 % (fit_file, pdb)
+                                 for pdb, fit_file in zip(pdbs, fit_files))
+                     + "\n")
+
+
+def run_multi_profile(params, mf_opts):
+    """Fit each of several experimental profiles (e.g. a SAXS time series)
+       to every structure. Structure profiles are computed only once; each
+       profile is then fit (and, if there are several structures, given to
+       MultiFoXS) in parallel. All fits are summarized in CHI_MATRIX_FILE."""
+    get_partial_profiles(
+        params, profile_store.ProfileStore(params.profile_store)
+        if use_profile_store(params) else None,
+        fetch_library_profiles(params))
+    dat_files = [dat_file for pdb in params.pdb_file_names
+                 for dat_file in dat_files_for_pdb(pdb)]
+    structures = [dat_file[:-4] for dat_file in dat_files]
+    radii = get_average_radii(params, structures)
+    mf_dat_files, _ = select_profiles(
+        params, select_conformers(params, dat_files), refine=False)
+
+    def fit_profile(profile):
+        fits = [fit_partial_profile(params, profile, s, radius)
+                for s, radius in zip(structures, radii)]
+        if len(structures) > 1:
+            scores = run_profile_multifoxs(params, profile, mf_dat_files,
+                                           mf_opts)
+        else:
+            scores = None
+        return fits, scores
+
+    nworkers = min(len(params.profile_file_names), os.cpu_count() or 1)
+    with concurrent.futures.ThreadPoolExecutor(nworkers) as executor:
+        results = list(executor.map(fit_profile, params.profile_file_names))
+
+    for fits, _ in results:
+        for _, log in fits:
+            print(log)
+    write_chi_matrix(params.profile_file_names, structures, results)
+
+
+# Summary of the fits of a multi-profile job, and the directory for the
+# MultiFoXS run for each profile (should match those in
+# frontend/foxs/results_page.py)
+CHI_MATRIX_FILE = 'chi-matrix.json'
+MULTIFOXS_DIR_SUFFIX = '_multifoxs'
+
+
+def get_multifoxs_dir(profile):
+    """Get the directory used to run MultiFoXS for one of several profiles"""
+    return os.path.splitext(profile)[0] + MULTIFOXS_DIR_SUFFIX
+
+
+def run_profile_multifoxs(params, profile, dat_files, mf_opts):
+    """Run MultiFoXS for one of several experimental profiles, in its own
+       directory, and return the best score for each ensemble size"""
+    subdir = get_multifoxs_dir(profile)
+    os.makedirs(subdir, exist_ok=True)
+    sub_profile = os.path.join(subdir, profile)
+    if not os.path.exists(sub_profile):
+        os.link(profile, sub_profile)
+    with open(os.path.join(subdir, 'filenames2.txt'), 'w') as fh:
+        for dat_file in dat_files:
+            fh.write(os.path.join('..', dat_file) + '\n')
+    with open(os.path.join(subdir, 'multifoxs.log'), 'w') as log:
+        run_subprocess(['validate_profile', profile, '-q', str(params.q)],
+                       stdout=log, cwd=subdir)
+        run_subprocess(['multi_foxs', os.path.splitext(profile)[0] + '_v.dat',
+                        'filenames2.txt',
+                        '-s', str(min(MAX_SUBSET_SIZE, len(dat_files)))]
+                       + mf_opts, stdout=log, cwd=subdir)
+    scores = {}
+    for size in range(1, MAX_SUBSET_SIZE + 1):
+        ensemble_file = os.path.join(subdir, 'ensembles_size_%d.txt' % size)
+        if os.path.exists(ensemble_file):
+            scores[size] = get_min_max_score(ensemble_file, 1)[1]
+    return scores
+
+
+def write_chi_matrix(profiles, structures, results):
+    """Write a summary of the fit of every profile to every structure, and
+       of the MultiFoXS ensembles for each profile"""
+    matrix = {'profiles': profiles, 'structures': structures,
+              'fits': [[[fit.chi2, fit.c1, fit.c2] for fit, _ in fits]
+                       for fits, _ in results],
+              'ensembles': [scores for _, scores in results]}
+    tmp = CHI_MATRIX_FILE + '.tmp'
+    with open(tmp, 'w') as fh:
+        json.dump(matrix, fh)
+    os.rename(tmp, CHI_MATRIX_FILE)
+
+
+def _remove_batch_outputs(name, profile_stem):
+    """Remove the profile and fit files for a structure that did not make
+       it into the pool of best-fitting structures"""
+    for fname in (name + '.dat',
+                  "%s_%s.dat" % (os.path.splitext(name)[0], profile_stem)):
+        if os.path.exists(fname):
+            os.unlink(fname)
+
+
+def parse_fit_lines(log):
+    """Yield (structure name, chi, c1, c2) for each fit in FoXS output"""
+    for line in log.split('\n'):
+        if 'Chi^2' in line:
+            s = line.split()
+            yield s[0], s[4], s[7], s[10]
+
+
+def write_batch_index(summary_file, index_file):
+    """Write an index of the given summary file, containing the offset
+       of each line in order of increasing chi. Each index entry is the
+       same length, so that any part of the sorted summary can be read
+       without reading the whole file (the entry size should match that
+       in frontend/foxs/results_page.py)."""
+    entries = []
+    offset = 0
+    with open(summary_file, 'rb') as fh:
+        for line in fh:
+            entries.append((float(line.split()[1]), offset))
+            offset += len(line)
+    entries.sort()
+    with open(index_file, 'w') as fh:
+        for _, offset in entries:
+            fh.write("%012d\n" % offset)
+
+
+def run_multifoxs(params, mf_opts, dat_files=None, rg_file_names=None):
     # validate exp. profile, add error if needed
     run_subprocess(['validate_profile', params.profile_file_name,
                     '-q', str(params.q)])
-    validated_profile_name = (os.path.splitext(params.profile_file_name)[0]
-                              + '_v.dat')
 
-    file_counter = 0
-    with open('filenames2.txt', 'w') as fh:
-        for pdb in params.pdb_file_names:
-            for dat_file in dat_files_for_pdb(pdb):
-                fh.write(dat_file + '\n')
-                file_counter += 1
+    if dat_files is None:
+        dat_files = [dat_file for pdb in params.pdb_file_names
+                     for dat_file in dat_files_for_pdb(pdb)]
+    all_dat_files = dat_files
+    dat_files = select_conformers(params, dat_files)
+    dat_files, clusters = select_profiles(params, dat_files,
+                                          refine=params.cluster_refine)
+    write_multifoxs_input(dat_files)
     # determine maximal subset size
-    max_subset_size = min(5, file_counter)
+    max_subset_size = min(MAX_SUBSET_SIZE, len(dat_files))
 
     print("Start Ensemble computation")
-    run_subprocess(['multi_foxs', validated_profile_name, 'filenames2.txt',
-                    '-s', str(max_subset_size)] + mf_opts)
-    if not os.path.exists('ensembles_size_1.txt'):
-        raise RuntimeError("No MultiFoXS ensembles produced")
-    make_multifoxs_plots(params.profile_file_name)
+    run_ensemble_search(params, mf_opts, max_subset_size)
+    if clusters and params.cluster_refine:
+        refine_ensemble_search(params, mf_opts, clusters, max_subset_size)
+    make_multifoxs_plots()
+    write_ensemble_profiles(params, all_dat_files)
 
     print("Calculate Rg")
     with open('rg', 'w') as fh:
         run_subprocess(['compute_rg', '-m', str(params.model_option)]
-                       + params.pdb_file_names, stdout=fh)
+                       + (rg_file_names or params.pdb_file_names), stdout=fh)
+
+
+# Profiles of the MultiFoXS pool, for fitting of user-chosen ensembles
+# (should match that in frontend/foxs/reweight.py)
+ENSEMBLE_PROFILES_FILE = 'ensemble-profiles.npz'
+
+
+def write_ensemble_profiles(params, dat_files):
+    """Write everything needed to quickly fit any ensemble of the given
+       profiles: their partial profiles interpolated onto the experimental
+       q values, the experimental profile, the c1 and c2 values to scan,
+       and each structure's excluded volume factor at each c1. The fit
+       itself is done by the frontend."""
+    exp = exp_profile.load_profile(params.profile_file_name)
+    structures = [d[:-4] for d in dat_files]
+    c1_range, c2_range = get_fit_ranges(params)
+    partials = []
+    try:
+        for dat_file in dat_files:
+            q, p = partial_profile.read_partial_profile(dat_file)
+            if not partials:
+                exp_q, exp_i, exp_err = partial_profile.prepare_exp_profile(
+                    exp, q[-1], params.unit_option)
+                c1s, c2s = partial_profile.get_grid(c1_range, c2_range,
+                                                    p.shape[1])
+            partials.append(partial_profile.interpolate_partials(exp_q, q, p))
+    except ValueError as err:
+        print("Ensembles cannot be refit: %s" % err)
+        return
+    if any(p.shape != partials[0].shape for p in partials):
+        print("Ensembles cannot be refit: inconsistent partial profiles")
+        return
+    tmp = ENSEMBLE_PROFILES_FILE + '.tmp'
+    with open(tmp, 'wb') as fh:
+        numpy.savez(fh, structures=numpy.array(structures),
+                    partials=numpy.array(partials), q=exp_q,
+                    intensity=exp_i, error=exp_err, c1=c1s, c2=c2s,
+                    g=numpy.array([partial_profile.excluded_volume_factor(
+                        exp_q, c1s, radius)
+                        for radius in get_average_radii(params, structures)]),
+                    offset=bool(params.offset))
+    os.rename(tmp, ENSEMBLE_PROFILES_FILE)
+
+
+# Groups of near-identical conformers (should match that in
+# frontend/foxs/ensemble.py)
+CONFORMER_GROUPS_FILE = 'conformer-groups.txt'
+
+
+def select_conformers(params, dat_files):
+    """If requested, give MultiFoXS only one of each group of conformers
+       within params.dedup_rmsd of each other, and record the groups"""
+    if not params.dedup_rmsd or len(dat_files) < 2:
+        return dat_files
+    structures = [dat_file[:-4] for dat_file in dat_files]
+    # Submodels of multi-model PDB files need not have been written out
+    ranges = read_submodel_ranges()
+    coords = []
+    for structure in structures:
+        with open_structure(structure, ranges) as fh:
+            coords.append(conformers.read_coordinates(
+                structure, first_model_only=params.model_option == 1, fh=fh))
+    groups = conformers.find_representatives(structures, params.dedup_rmsd,
+                                             coords=coords)
+    conformers.write_groups(CONFORMER_GROUPS_FILE, groups, params.dedup_rmsd)
+    print("%d of %d conformers are more than %.2f A RMSD from each other"
+          % (len(groups), len(dat_files), params.dedup_rmsd))
+    return [rep + '.dat' for rep, _ in groups]
+
+
+# Clusters of similar profiles, each given to MultiFoXS as its medoid
+# (should match that in frontend/foxs/ensemble.py)
+PROFILE_CLUSTERS_FILE = 'profile-clusters.txt'
+
+
+def select_profiles(params, dat_files, refine):
+    """If requested, cluster the profiles and give MultiFoXS only the medoid
+       of each cluster. Return the profiles to use and the clusters (or
+       None if there was no clustering)."""
+    if (not params.profile_clusters
+            or len(dat_files) <= params.profile_clusters):
+        return dat_files, None
+    clusters = profile_clusters.cluster_profiles(dat_files,
+                                                 params.profile_clusters)
+    profile_clusters.write_clusters(PROFILE_CLUSTERS_FILE, clusters, refine)
+    print("Clustered %d profiles into %d clusters"
+          % (len(dat_files), len(clusters)))
+    return [medoid for medoid, _ in clusters], clusters
+
+
+def write_multifoxs_input(dat_files):
+    """Write the list of profiles to be given to MultiFoXS"""
+    with open('filenames2.txt', 'w') as fh:
+        for dat_file in dat_files:
+            fh.write(dat_file + '\n')
+
+
+def get_ensemble_profiles(max_states, max_models, directory='.'):
+    """Get the names of all profiles used by the best max_models ensembles
+       of each size, up to max_states, found by MultiFoXS in the given
+       directory. Names are relative to the current directory."""
+    dat_files = set()
+    for i in range(1, max_states + 1):
+        ensemble_file = os.path.join(directory, "ensembles_size_%d.txt" % i)
+        if not os.path.exists(ensemble_file):
+            continue
+        model_num = 0
+        with open(ensemble_file) as fh:
+            for line in fh:
+                spl = line.rstrip('\r\n').split('|')
+                if " x1 " in line:
+                    if spl[0].strip().isdigit():
+                        model_num = int(spl[0])
+                        if model_num > max_models:
+                            break
+                elif model_num > 0 and len(spl) == 3:
+                    dat_files.add(os.path.normpath(
+                        os.path.join(directory, spl[2].split()[0])))
+    return dat_files
+
+
+def refine_ensemble_search(params, mf_opts, clusters, max_subset_size,
+                           max_models=10):
+    """Second level of a clustered search: run MultiFoXS again using every
+       member of the clusters whose medoids are in the best ensembles
+       found using only the medoids. The results of this search replace
+       those of the first."""
+    selected = get_ensemble_profiles(max_subset_size, max_models)
+    dat_files = [member for medoid, members in clusters if medoid in selected
+                 for member in members]
+    if len(dat_files) <= len(selected):
+        return  # the selected clusters have no other members
+    print("Refine ensemble search using the %d profiles in %d clusters"
+          % (len(dat_files), len(selected)))
+    write_multifoxs_input(dat_files)
+    run_ensemble_search(params, mf_opts, max_subset_size)
 
 
-def make_multifoxs_plots(profile_file_name):
-    max_states = 4
+# Profiles left after screening in shards, and the directory in which
+# each shard is searched
+MERGED_POOL_FILE = 'filenames-merged.txt'
+MULTIFOXS_SHARD_DIR = 'multifoxs-shard%d'
+
+
+def run_ensemble_search(params, mf_opts, max_subset_size):
+    """Run MultiFoXS on the profiles listed in filenames2.txt, using the
+       experimental profile already validated by validate_profile. If
+       there are more than params.multifoxs_shard_size profiles, they are
+       first screened in shards (see screen_ensemble_shards)."""
+    validated_profile_name = (os.path.splitext(params.profile_file_name)[0]
+                              + '_v.dat')
+    input_file = 'filenames2.txt'
+    if params.multifoxs_shard_size:
+        with open(input_file) as fh:
+            dat_files = [line.strip() for line in fh if line.strip()]
+        pool = screen_ensemble_shards(params, validated_profile_name,
+                                      mf_opts, dat_files, max_subset_size)
+        if len(pool) < len(dat_files):
+            input_file = MERGED_POOL_FILE
+            with open(input_file, 'w') as fh:
+                for dat_file in pool:
+                    fh.write(dat_file + '\n')
+    run_subprocess(['multi_foxs', validated_profile_name, input_file,
+                    '-s', str(max_subset_size)] + mf_opts)
+    if not os.path.exists('ensembles_size_1.txt'):
+        raise RuntimeError("No MultiFoXS ensembles produced")
+
+
+def screen_ensemble_shards(params, profile, mf_opts, dat_files,
+                           max_subset_size, max_models=10):
+    """Reduce a large pool of profiles by searching shards of at most
+       params.multifoxs_shard_size profiles in parallel, and keeping only
+       the profiles in the best max_models ensembles of any shard. This is
+       repeated until the pool can be searched all at once (or no longer
+       shrinks). Return the remaining profiles, in their original order."""
+    shard_size = params.multifoxs_shard_size
+    while len(dat_files) > shard_size:
+        nshards = -(-len(dat_files) // shard_size)
+        # Interleave profiles, so that each shard samples the whole pool
+        shards = [dat_files[i::nshards] for i in range(nshards)]
+        print("Screen %d profiles for ensembles in %d shards"
+              % (len(dat_files), nshards))
+
+        def search_shard(i):
+            return _search_shard(MULTIFOXS_SHARD_DIR % i, profile, mf_opts,
+                                 shards[i], max_subset_size, max_models)
+
+        nworkers = min(nshards, os.cpu_count() or 1)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(nworkers) as executor:
+                selected = set().union(*executor.map(search_shard,
+                                                     range(nshards)))
+        finally:
+            for i in range(nshards):
+                shutil.rmtree(MULTIFOXS_SHARD_DIR % i, ignore_errors=True)
+        if not selected or len(selected) >= len(dat_files):
+            break
+        dat_files = [d for d in dat_files if d in selected]
+    return dat_files
+
+
+def _search_shard(subdir, profile, mf_opts, dat_files, max_subset_size,
+                  max_models):
+    """Run MultiFoXS on one shard of the pool of profiles, in its own
+       directory, and return the profiles in its best ensembles"""
+    os.mkdir(subdir)
+    with open(os.path.join(subdir, 'filenames2.txt'), 'w') as fh:
+        for dat_file in dat_files:
+            fh.write(os.path.join('..', dat_file) + '\n')
+    max_states = min(max_subset_size, len(dat_files))
+    with open(os.path.join(subdir, 'multifoxs.log'), 'w') as log:
+        run_subprocess(['multi_foxs', os.path.join('..', profile),
+                        'filenames2.txt', '-s', str(max_states)] + mf_opts,
+                       stdout=log, cwd=subdir)
+    return get_ensemble_profiles(max_states, max_models, subdir)
+
+
+def run_continue(params):
+    """Search for larger ensembles than an earlier job did. The profiles,
+       validated experimental profile, filenames2.txt and Rg values were
+       copied from that job by the frontend (but not its MultiFoXS
+       outputs), so only MultiFoXS is rerun. MultiFoXS cannot start from
+       the ensembles of a given size, so smaller ensembles are searched
+       again, but this is fast compared to computing the profiles."""
+    with open(CONTINUE_FILE) as fh:
+        print("Continue ensemble search of job %s up to %d states"
+              % (fh.readline().split()[0], params.continue_size))
+    _, mf_opts = get_command_options(params)
+    with open('filenames2.txt') as fh:
+        ndat = len([line for line in fh if line.strip()])
+    max_subset_size = min(params.continue_size, ndat)
+    run_ensemble_search(params, mf_opts, max_subset_size)
+    make_multifoxs_plots(max_subset_size)
+
+
+def make_multifoxs_plots(max_states=MAX_STATES):
     plot_states_histogram(max_states=max_states, max_models=10)
-    make_gnuplot_canvas_plot(max_states, profile_file_name)
-
-
-def make_gnuplot_canvas_plot(max_states, profile):
-    """Prepare gnuplot canvas plot for profiles"""
-    colors = ("#1a9850",  # green
-              "#e26261",  # red
-              "#3288bd",  # blue
-              "#00FFFF",
-              "#A6CEE3")
-    with open('canvas_ensemble.plt', 'w') as fh:
-        fh.write('set terminal canvas solid butt size 300,250 fsize 10 '
-                 'lw 1.5 fontscale 1 name "jsoutput_3" jsdir "."\n')
-        fh.write("set output 'jsoutput.3.js'; set multiplot; set origin 0,0;"
-                 "set size 1,0.3; set tmargin 0;set xlabel 'q';"
-                 "set ylabel ' ' offset 1;set format y '';set xtics nomirror;"
-                 "set ytics nomirror;unset key;set border 3;"
-                 "set style line 11 lc rgb '#808080' lt 1;"
-                 "set border 3 back ls 11;f(x)=1\n")
-        residuals = ["plot f(x) lc rgb '#333333'"]
-        plots = ["plot '%s' u 1:2 lc rgb '#333333' pt 6 ps 0.8" % profile]
-        for state_num in range(max_states):
-            out_file = "multi_state_model_%d_1_1.fit" % (state_num + 1)
-            residuals.append("'%s' u 1:(($2-$4)/$3) w lines lw 2.5 lc rgb '%s'"
-                             % (out_file, colors[state_num]))
-            plots.append("'%s' u 1:4 w lines lw 2.5 lc rgb '%s'"
-                         % (out_file, colors[state_num]))
-        fh.write(", ".join(residuals) + '\n')
-        fh.write("set origin 0,0.3;set size 1,0.69; set bmargin 0;"
-                 "set xlabel ''; set format x ''; "
-                 "set ylabel 'intensity (log-scale)' offset 1; set log y\n")
-        fh.write(", ".join(plots) + '\n')
-        fh.write("unset multiplot\n")
-
-    run_subprocess(['gnuplot', 'canvas_ensemble.plt'])
+
+
+def is_canvas_script(fname):
+    """Return True iff the given gnuplot script uses the canvas terminal"""
+    with open(fname, encoding='latin1') as fh:
+        return any(line.lstrip().startswith('set terminal canvas')
+                   for line in fh)
 
 
 def plot_states_histogram(max_states, max_models):
@@ -338,10 +1105,10 @@ set style fill solid 1.0 border rgb '#596E98'
 bs = 0.2
 
 set yrange [0:%f];set ylabel 'x^2' offset 1;
-set xrange [0.5:4.5]; set xlabel '# of states'
+set xrange [0.5:%d.5]; set xlabel '# of states'
 set xtics 1
 plot 'chis' u 1:2:3 notitle w yerrorb ls 1, '' u 1:2:(bs) notitle w boxes ls 2
-""" % yrange)
+""" % (yrange, max_states))
     run_subprocess(['gnuplot', 'plotbar3.plt'])
 
 
@@ -374,30 +1141,136 @@ def dat_files_for_pdb(pdb):
         yield dat_file
     else:  # multi model file
         pdb_code = os.path.splitext(pdb)[0]
-        for i in range(1, 101):
-            for ext in ('pdb', 'cif'):
-                dat_file = "%s_m%d.%s.dat" % (pdb_code, i, ext)
-                if os.path.exists(dat_file):
-                    yield dat_file
+        r = re.compile(re.escape(pdb_code) + r'_m(\d+)\.(pdb|cif)\.dat$')
+        submodels = []
+        for dat_file in glob.glob(glob.escape(pdb_code) + '_m*.dat'):
+            m = r.match(dat_file)
+            if m:
+                submodels.append((int(m.group(1)), m.group(2), dat_file))
+        for _, _, dat_file in sorted(submodels):
+            yield dat_file
 
 
-def run_subprocess(cmd, stdout=None):
+def run_subprocess(cmd, stdout=None, cwd=None):
     """Run and log a subprocess"""
     if stdout is None:
         stdout = sys.stdout
     # Ensure that output from subprocess shows up in the right place in the log
     sys.stdout.flush()
-    subprocess.check_call(cmd, stdout=stdout, stderr=sys.stderr)
+    subprocess.check_call(cmd, stdout=stdout, stderr=sys.stderr, cwd=cwd)
 
 
-def main():
-    set_job_state('STARTED')
+def parse_args(argv=None):
+    """Parse command line options, set by the backend from the service
+       configuration"""
+    parser = argparse.ArgumentParser(description="Run a FoXS job")
+    parser.add_argument('--batch-shard-size', type=int, default=100,
+                        help="Number of input files given to each FoXS "
+                             "run in batch mode")
+    parser.add_argument('--batch-pool-size', type=int, default=100,
+                        help="Number of best-fitting structures given to "
+                             "MultiFoXS in batch mode")
+    parser.add_argument('--profile-store',
+                        help="Directory of structure profiles shared "
+                             "between jobs")
+    parser.add_argument('--profile-library',
+                        help="Directory of precomputed structure profiles "
+                             "(see profile_library.py)")
+    parser.add_argument('--multifoxs-shard-size', type=int, default=0,
+                        help="If nonzero, largest number of profiles given "
+                             "to a single MultiFoXS run; larger pools are "
+                             "first screened in shards of this size")
+    parser.add_argument('--scratch',
+                        help="If given, run the job in a copy of the job "
+                             "directory in this (node-local) directory, "
+                             "and copy back only the outputs")
+    return parser.parse_args(argv)
+
+
+# Intermediate files that are not copied back from scratch
+_SCRATCH_ONLY = ('*.tmp', '*.plt', 'batch-shard.log', 'multifoxs-shard*')
+
+
+def _is_scratch_only(fname):
+    return any(fnmatch.fnmatch(fname, pat) for pat in _SCRATCH_ONLY)
+
+
+def _snapshot(topdir):
+    """Get the size and modification time of every file under topdir"""
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(topdir):
+        for fname in filenames:
+            path = os.path.join(dirpath, fname)
+            st = os.stat(path)
+            files[os.path.relpath(path, topdir)] = (st.st_size,
+                                                    st.st_mtime_ns)
+    return files
+
+
+def stage_out(workdir, jobdir, staged):
+    """Copy new or changed files (except intermediates) from the scratch
+       copy of a job back to the job directory, and remove any inputs that
+       were deleted. Files are replaced rather than overwritten, as inputs
+       may be hard links to another job's files."""
+    for rel, stamp in _snapshot(workdir).items():
+        if (staged.get(rel) == stamp
+                or any(_is_scratch_only(p) for p in rel.split(os.sep))):
+            continue
+        dest = os.path.join(jobdir, rel)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp = dest + '.stage'
+        shutil.copy2(os.path.join(workdir, rel), tmp)
+        os.replace(tmp, dest)
+    for rel in staged:
+        if (not os.path.exists(os.path.join(workdir, rel))
+                and os.path.exists(os.path.join(jobdir, rel))):
+            os.unlink(os.path.join(jobdir, rel))
+
+
+@contextlib.contextmanager
+def scratch_directory(scratch):
+    """Run in a copy of the job directory under the given (node-local)
+       scratch directory, so that intermediate files are not written to
+       shared storage. Outputs are copied back on exit, even on error. If
+       scratch is None, just run in the job directory."""
+    if not scratch:
+        yield
+        return
+    jobdir = os.getcwd()
+    tmpdir = tempfile.mkdtemp(prefix='foxs-', dir=scratch)
+    try:
+        workdir = os.path.join(tmpdir, 'job')
+        shutil.copytree(jobdir, workdir, symlinks=True)
+        staged = _snapshot(workdir)
+        os.chdir(workdir)
+        try:
+            yield
+        finally:
+            os.chdir(jobdir)
+            stage_out(workdir, jobdir, staged)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def run_logged(args):
+    """Run the job, sending our own error/output to foxs.log. The log is
+       always written directly to the job directory, even when the job runs
+       in scratch, so that progress can be followed while the job runs and
+       any failure to set up or stage out of scratch is logged."""
+    # A continued ensemble search adds to the log of the job it continues,
+    # which has the fits
+    log = open('foxs.log', 'a' if os.path.exists(CONTINUE_FILE) else 'w')
+    sys.stdout = sys.stderr = log
     try:
-        # Send our own error/output to a log file
-        sys.stdout = sys.stderr = open('foxs.log', 'w')
-        setup_environment()
-        params = JobParameters()
-        run_job(params)
+        with scratch_directory(args.scratch):
+            setup_environment()
+            params = JobParameters(
+                batch_shard_size=args.batch_shard_size,
+                batch_pool_size=args.batch_pool_size,
+                profile_store=args.profile_store,
+                profile_library=args.profile_library,
+                multifoxs_shard_size=args.multifoxs_shard_size)
+            run_job(params)
     except Exception:
         # Don't exit non-zero on exception, as this will automatically fail
         # the job (and some exceptions are caused by user inputs, which they
@@ -405,6 +1278,15 @@ def main():
         # postprocess can determine whether or not to return the error to
         # the user.
         traceback.print_exc()
+    finally:
+        log.flush()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    set_job_state('STARTED')
+    try:
+        run_logged(args)
     finally:
         set_job_state('DONE')
 
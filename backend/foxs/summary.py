@@ -0,0 +1,74 @@
+"""Compact summary of a completed job's results.
+
+   This is written when the job is postprocessed, so that the frontend
+   does not need to parse foxs.log and the other output files every time
+   the results page is viewed. The frontend uses this module (through a
+   link, frontend/foxs/summary.py) to make the same summary itself for
+   older jobs, and to get a job's PDB files."""
+
+import os
+import glob
+import json
+
+
+SUMMARY_FILE = 'summary.json'
+
+
+def parse_log(directory='.', profile=None):
+    """Get a dict of [chi, c1, c2] values for PDB-file keys. If `profile`
+       is given, only fits to that experimental profile are included
+       (the log of a multi-profile job has a fit for every structure and
+       profile)."""
+    results = {}
+    fname = os.path.join(directory, 'foxs.log')
+    if os.path.exists(fname):
+        with open(fname, encoding='latin1') as fh:
+            for line in fh:
+                if 'Chi^2' in line:
+                    s = line.split()
+                    if profile is None or s[1] == profile:
+                        results[s[0]] = [s[4], s[7], s[10]]
+    return results
+
+
+def get_pdb_files(directory='.'):
+    """Get the PDB files used by the job"""
+    fname = os.path.join(directory, 'multi-model-files.txt')
+    if not os.path.exists(fname):
+        fname = os.path.join(directory, 'inputFiles.txt')
+    if not os.path.exists(fname):
+        return []
+    with open(fname) as fh:
+        return [line.rstrip('\r\n') for line in fh]
+
+
+def make_summary(directory='.'):
+    """Summarize the results of the job in the given directory"""
+    pdb = profile = None
+    data_file = os.path.join(directory, 'data.txt')
+    if os.path.exists(data_file):
+        with open(data_file) as fh:
+            pdb, profile = fh.readline().split()[:2]
+    error = None
+    error_file = os.path.join(directory, 'validation-error.txt')
+    if os.path.exists(error_file):
+        with open(error_file) as fh:
+            error = fh.read().strip()
+    pngs = [os.path.relpath(png, directory) for png in
+            glob.glob(os.path.join(directory, '**/*.png'), recursive=True)]
+    # Show the fits to the first profile of a multi-profile job (the fits
+    # to all profiles are in the chi matrix)
+    multi_profile = os.path.exists(os.path.join(directory, 'profiles.txt'))
+    return {'pdb': pdb, 'profile': profile, 'error': error,
+            'pdb_files': get_pdb_files(directory),
+            'fits': parse_log(directory, profile if multi_profile else None),
+            'pngs': sorted(pngs)}
+
+
+def write_summary():
+    """Write a summary of the job in the current directory"""
+    summary = make_summary()
+    tmp = SUMMARY_FILE + '.tmp'
+    with open(tmp, 'w') as fh:
+        json.dump(summary, fh)
+    os.rename(tmp, SUMMARY_FILE)
@@ -0,0 +1,44 @@
+"""Validation of job inputs that the frontend saved without checking.
+
+   When the frontend runs in fast-accept (deferred validation) mode, it
+   saves the raw uploads and writes a request file describing them; the
+   checks that the frontend would otherwise have done are then done here,
+   as part of the backend's preprocessing step, using the same code as
+   the frontend (see input_check.py). User errors are written to a file
+   in the job directory so that the frontend can show them on the
+   results page."""
+
+import json
+from .input_check import InputError as ValidationError
+from .input_check import handle_structures, check_profile
+
+
+# File, written by the frontend, listing the inputs that need checking
+REQUEST_FILE = 'validate.json'
+
+# File to which any user error is written
+ERROR_FILE = 'validation-error.txt'
+
+
+def validate_job():
+    """Check the inputs listed in the request file in the current
+       directory. Update inputFiles.txt if a zip file was extracted.
+       Return True if all inputs were OK, or write the error to ERROR_FILE
+       and return False otherwise."""
+    with open(REQUEST_FILE) as fh:
+        req = json.load(fh)
+    try:
+        if req.get('structures'):
+            pdbs = handle_structures(req['structures'],
+                                     req.get('show_filename'), '.',
+                                     req.get('local', False),
+                                     req.get('max_structures', 100))
+            with open('inputFiles.txt', 'w') as fh:
+                fh.write("\n".join(pdbs))
+        if req.get('profile'):
+            check_profile(req['profile'])
+    except ValidationError as err:
+        with open(ERROR_FILE, 'w') as fh:
+            fh.write(str(err) + '\n')
+        return False
+    return True
@@ -1,7 +1,13 @@
-from flask import render_template, request, send_from_directory
+from flask import render_template, request, abort, make_response, jsonify
+from werkzeug.security import safe_join
+import click
 import saliweb.frontend
+import os
 from saliweb.frontend import get_completed_job, Parameter, FileParameter
-from . import submit_page, results_page
+from saliweb.frontend import InputValidationError
+from . import submit_page, results_page, http_cache, plot_data, results_api
+from . import batch_submit, refit, landscape, continue_search, reweight
+from . import pdb_cache, submodels
 
 
 parameters = [Parameter("jobname", "Job name", optional=True),
@@ -34,7 +40,24 @@ parameters = [Parameter("jobname", "Job name", optional=True),
               Parameter("modelread",
                         "Determine how to read PDB files with MODEL records",
                         optional=True),
-              Parameter("units", "Experimental profile units", optional=True)]
+              Parameter("units", "Experimental profile units", optional=True),
+              Parameter("batch",
+                        "Large ensemble batch mode (requires a profile)",
+                        optional=True),
+              Parameter("scan",
+                        "Scan c1 and c2 and show the chi^2 landscape "
+                        "(requires a profile)", optional=True),
+              Parameter("dedup_rmsd",
+                        "RMSD (in angstroms) below which conformers are "
+                        "represented by a single conformer in MultiFoXS",
+                        optional=True),
+              Parameter("profile_clusters",
+                        "Number of clusters of similar profiles, each "
+                        "represented by its medoid in MultiFoXS",
+                        optional=True),
+              Parameter("cluster_refine",
+                        "Search again using all members of the best "
+                        "profile clusters", optional=True)]
 app = saliweb.frontend.make_application(__name__, parameters)
 
 
@@ -81,26 +104,122 @@ def job():
         return submit_page.handle_new_job()
 
 
+@app.route('/batch', methods=['POST'])
+def batch():
+    try:
+        return batch_submit.handle_batch_submission()
+    except InputValidationError as err:
+        # Batch submission is only used programmatically, so report errors
+        # as JSON rather than as a web page
+        return jsonify({'error': str(err)}), 400
+
+
 @app.route('/job/<name>')
 def results(name):
     job = get_completed_job(name, request.args.get('passwd'),
                             still_running_template='running.html')
-    return results_page.show_results(job, interactive=True)
+    return http_cache.conditional_page(
+        job, lambda: results_page.show_results(job, interactive=True))
 
 
 @app.route('/job/<name>/old')
 def results_old(name):
     job = get_completed_job(name, request.args.get('passwd'))
-    return results_page.show_results(job, interactive=False)
+    return http_cache.conditional_page(
+        job, lambda: results_page.show_results(job, interactive=False))
 
 
 @app.route('/job/<name>/ensemble')
 def ensemble(name):
     job = get_completed_job(name, request.args.get('passwd'))
-    return results_page.show_ensemble(job)
+    return http_cache.conditional_page(
+        job, lambda: results_page.show_ensemble(job))
+
+
+@app.route('/job/<name>/ensemble/fit')
+def ensemble_fit(name):
+    job = get_completed_job(name, request.args.get('passwd'))
+    try:
+        return jsonify(reweight.fit_ensemble(
+            job, request.args.getlist('structure')))
+    except InputValidationError as err:
+        # Fits are requested by scripts on the ensemble page, so report
+        # errors as JSON rather than as a web page
+        return jsonify({'error': str(err)}), 400
+
+
+@app.route('/job/<name>/refit', methods=['POST'])
+def results_refit(name):
+    job = get_completed_job(name, request.args.get('passwd'))
+    return refit.handle_refit(job)
+
+
+@app.route('/job/<name>/continue', methods=['POST'])
+def results_continue(name):
+    job = get_completed_job(name, request.args.get('passwd'))
+    return continue_search.handle_continue(job)
+
+
+@app.route('/job/<name>/results.json')
+def results_json(name):
+    job = get_completed_job(name, request.args.get('passwd'))
+    return http_cache.conditional_page(job,
+                                       lambda: results_api.get_json(job))
+
+
+@app.route('/job/<name>/results.ndjson')
+def results_ndjson(name):
+    job = get_completed_job(name, request.args.get('passwd'))
+    return http_cache.conditional_page(job,
+                                       lambda: results_api.get_ndjson(job))
+
+
+@app.route('/job/<name>/plotdata/<path:fp>')
+def results_plot_data(name, fp):
+    job = get_completed_job(name, request.args.get('passwd'))
+    fname = safe_join(job.directory, fp)
+    if (fname is None or not fp.endswith(('.dat', '.fit'))
+            or not os.path.isfile(fname)):
+        abort(404)
+    payload = plot_data.get_payload(
+        fname, request.args.get('points', plot_data.DEFAULT_POINTS, type=int))
+    resp = make_response(payload)
+    resp.mimetype = 'application/octet-stream'
+    return http_cache.set_immutable(resp)
+
+
+@app.route('/job/<name>/landscape/<int:index>')
+def results_landscape(name, index):
+    job = get_completed_job(name, request.args.get('passwd'))
+    payload = landscape.get_payload(job, index)
+    if payload is None:
+        abort(404)
+    resp = make_response(payload)
+    resp.mimetype = 'application/octet-stream'
+    return http_cache.set_immutable(resp)
 
 
 @app.route('/job/<name>/<path:fp>')
 def results_file(name, fp):
     job = get_completed_job(name, request.args.get('passwd'))
-    return send_from_directory(job.directory, fp)
+    resp = submodels.send_submodel(job, fp)
+    if resp is None:
+        resp = http_cache.send_job_file(job, fp)
+    return resp
+
+
+@app.cli.command('warm-pdb-cache')
+@click.argument('codes_file', type=click.File('r'))
+def warm_pdb_cache(codes_file):
+    """Add the PDB codes (with optional chains, e.g. 1abc:A) listed one
+       per line in CODES_FILE to the PDB cache"""
+    codes = [line.strip() for line in codes_file
+             if line.strip() and not line.startswith('#')]
+    try:
+        failed = pdb_cache.warm(codes)
+    except ValueError as exc:
+        raise click.ClickException(str(exc))
+    for code, error in failed:
+        click.echo("Could not fetch %s: %s" % (code, error), err=True)
+    click.echo("Cached %d of %d PDB codes" % (len(codes) - len(failed),
+                                              len(codes)))
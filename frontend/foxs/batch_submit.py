@@ -0,0 +1,113 @@
+"""Submission of many jobs in a single request.
+
+   A batch is either one set of structures (a PDB code or an uploaded
+   PDB/mmCIF/zip file) to be fit against many experimental profiles, or
+   many sets of structures each fit against the same profile; one job is
+   made for each. All inputs are checked before any job is submitted, so
+   either every job in the batch is submitted or none are. Jobs are
+   flagged so that the backend computes each structure's profile only
+   once and shares it between them (see backend/foxs/profile_store.py).
+   Inputs shared by several jobs are uploaded and checked only once."""
+
+from flask import request, jsonify
+import saliweb.frontend
+from saliweb.frontend import InputValidationError
+import os
+import shutil
+from .config import get_config
+from . import submit_page
+
+
+def handle_batch_submission():
+    email = request.form.get("email")
+    saliweb.frontend.check_email(email, required=False)
+    jobname = request.form.get('jobname')
+    opts = submit_page.get_job_options()
+    pool = submit_page.get_pool_options()
+
+    # Each structure set is a (PDB code, uploaded file) pair
+    structure_sets = ([(code, None) for code in request.form.getlist('pdb')
+                       if code]
+                      + [(None, fh) for fh in request.files.getlist('pdbfile')
+                         if fh])
+    profiles = [fh for fh in request.files.getlist('profile') if fh]
+    if not structure_sets:
+        raise InputValidationError("Error in protein input: please specify "
+                                   "PDB code or upload PDB/mmCIF file")
+    if not profiles:
+        raise InputValidationError(
+            "Batch submission requires at least one experimental profile")
+    if len(structure_sets) > 1 and len(profiles) > 1:
+        raise InputValidationError(
+            "Please submit either one set of structures with many "
+            "profiles, or many sets of structures with one profile")
+    njobs = max(len(structure_sets), len(profiles))
+    max_jobs = get_config('batch_submit_max_jobs', 100)
+    if njobs > max_jobs and not submit_page.local_connection():
+        raise InputValidationError(
+            "Only %d jobs can be submitted in a single batch" % max_jobs)
+    max_structures = submit_page.get_max_structures(False)
+
+    jobs = []
+    try:
+        for i in range(njobs):
+            jobs.append(saliweb.frontend.IncomingJob(
+                "%s_%d" % (jobname, i + 1) if jobname else None))
+        _setup_jobs(jobs, structure_sets, profiles, opts, max_structures,
+                    pool)
+    except Exception:
+        for job in jobs:
+            shutil.rmtree(job.directory, ignore_errors=True)
+        raise
+
+    for job in jobs:
+        job.submit(email)
+    return jsonify({'jobs': [{'name': job.name,
+                              'results_url': job.results_url}
+                             for job in jobs]})
+
+
+def _setup_jobs(jobs, structure_sets, profiles, opts, max_structures,
+                pool):
+    """Save and check the inputs for every job, and write their
+       parameter files"""
+    structures = []
+    for job, (code, fh) in zip(jobs, structure_sets):
+        structures.append(submit_page.handle_pdb(
+            code, fh, job, max_structures=max_structures))
+    profile_file_names = [
+        submit_page.save_job_nonempty_file(fh, job, "profile",
+                                           submit_page.check_profile)
+        for job, fh in zip(jobs, profiles)]
+
+    # Copy the single structure set or profile to the other jobs
+    for job in jobs[1:]:
+        if len(structures) == 1:
+            prot_file_names, archive = structures[0]
+            copy_job_files(jobs[0], job, set(prot_file_names) | {archive})
+        else:
+            copy_job_files(jobs[0], job, [profile_file_names[0],
+                                          profile_file_names[0] + '.npy'])
+
+    for i, job in enumerate(jobs):
+        prot_file_names, archive = structures[min(i, len(structures) - 1)]
+        profile_file_name = profile_file_names[
+            min(i, len(profile_file_names) - 1)]
+        submit_page.write_job_files(job, prot_file_names, archive,
+                                    profile_file_name, opts, batch=0,
+                                    share=1, pool=pool)
+
+
+def copy_job_files(src_job, dest_job, fnames):
+    """Copy the named files (which may be in subdirectories) from one
+       job directory to another, using hard links where possible"""
+    for fname in fnames:
+        src = src_job.get_path(fname)
+        dest = dest_job.get_path(fname)
+        if not os.path.exists(src):
+            continue
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        try:
+            os.link(src, dest)
+        except OSError:
+            shutil.copyfile(src, dest)
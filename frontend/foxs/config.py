@@ -0,0 +1,14 @@
+from flask import current_app
+
+
+def get_config(name, default):
+    """Get a FoXS-specific setting from the [foxs] section of the service's
+       configuration file, or `default` if it is not set. The value is
+       converted to the same type as `default`."""
+    value = current_app.config.get('FOXS_' + name.upper())
+    if value is None:
+        return default
+    elif isinstance(default, bool) and isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    else:
+        return type(default)(value)
@@ -0,0 +1,110 @@
+"""Continuing the MultiFoXS ensemble search of a completed job.
+
+   MultiFoXS normally searches for ensembles of up to 5 structures. To
+   look for larger ensembles, the user can continue the search: this makes
+   a new job with all of the original job's outputs except those of
+   MultiFoXS, plus the new maximum ensemble size. The backend then only
+   reruns MultiFoXS, reusing the profiles already computed (see
+   run_continue in backend/foxs/run_foxs.py)."""
+
+from flask import request
+import saliweb.frontend
+from saliweb.frontend import InputValidationError
+import os
+import re
+import shutil
+from .batch_submit import copy_job_files
+from .config import get_config
+from .ensemble import CHI_PLOT_CACHE_FILE
+from .http_cache import GZIP_SUFFIX
+from .refit import REFIT_FILE
+
+
+# Name of the original job and the new maximum ensemble size, and the
+# largest ensemble size normally shown (should match those in
+# backend/foxs/run_foxs.py)
+CONTINUE_FILE = 'continue-from.txt'
+MAX_STATES = 4
+
+# Files written by MultiFoXS (or made from its outputs), which are not
+# copied to the new job. As files are hard linked, the backend must not
+# write to any file it was given.
+_MULTIFOXS_OUTPUT = re.compile(
+    r'(ensembles_size_\d+\.txt|multi_state_model_.*|cluster.*|chis|chis\.png'
+    r'|plotbar3\.plt|filenames-merged\.txt|' + re.escape(CHI_PLOT_CACHE_FILE)
+    + ')$')
+
+# Other files not linked: job markers, outputs of the validation step, and
+# files the backend writes to (which are copied instead)
+_WRITTEN = ('foxs.log', 'job-state')
+_NOT_LINKED = frozenset((CONTINUE_FILE, REFIT_FILE, 'validate.json',
+                         'validation-error.txt') + _WRITTEN)
+
+
+def get_max_states(job):
+    """Get the largest ensemble size shown for a job"""
+    fname = job.get_path(CONTINUE_FILE)
+    if os.path.exists(fname):
+        with open(fname) as fh:
+            return int(fh.readline().split()[1])
+    return MAX_STATES
+
+
+def get_ensemble_size(job):
+    """Get the largest ensemble size searched for by a job"""
+    sizere = re.compile(r'ensembles_size_(\d+)\.txt$')
+    sizes = [int(m.group(1))
+             for m in map(sizere.match, os.listdir(job.directory)) if m]
+    return max(sizes) if sizes else 0
+
+
+def get_max_ensemble_size(job):
+    """Get the largest ensemble size that can be searched for by a job"""
+    fname = job.get_path('filenames2.txt')
+    if not os.path.exists(fname):
+        return 0
+    with open(fname) as fh:
+        nprofiles = len([line for line in fh if line.strip()])
+    return min(nprofiles, get_config('max_ensemble_size', 10))
+
+
+def _get_linked_files(job):
+    for dirpath, dirnames, filenames in os.walk(job.directory):
+        reldir = os.path.relpath(dirpath, job.directory)
+        for fname in filenames:
+            if reldir == '.' and (fname in _NOT_LINKED
+                                  or _MULTIFOXS_OUTPUT.match(fname)):
+                continue
+            if fname.endswith(GZIP_SUFFIX):
+                continue
+            yield os.path.normpath(os.path.join(reldir, fname))
+
+
+def handle_continue(job):
+    current_size = get_ensemble_size(job)
+    if (current_size == 0
+            or not os.path.exists(job.get_path('filenames2.txt'))):
+        raise InputValidationError(
+            "This job has no MultiFoXS ensembles to continue")
+    max_size = get_max_ensemble_size(job)
+    size = request.form.get('size', 0, type=int)
+    if size <= current_size:
+        raise InputValidationError(
+            "Ensembles of up to %d structures were already searched for; "
+            "please give a larger size" % current_size)
+    if size > max_size:
+        raise InputValidationError(
+            "Ensembles of at most %d structures can be searched for"
+            % max_size)
+
+    newjob = saliweb.frontend.IncomingJob(job.name + '_continue')
+    try:
+        copy_job_files(job, newjob, _get_linked_files(job))
+        shutil.copyfile(job.get_path('foxs.log'), newjob.get_path('foxs.log'))
+        with open(newjob.get_path(CONTINUE_FILE), 'w') as fh:
+            fh.write("%s %d\n" % (job.name, size))
+    except Exception:
+        shutil.rmtree(newjob.directory, ignore_errors=True)
+        raise
+    newjob.submit(job.email)
+    return saliweb.frontend.redirect_to_results_page(newjob)
@@ -1,17 +1,36 @@
 import os
 import re
+import json
+import functools
 import collections
-import bokeh
-import bokeh.resources
-import bokeh.embed
-import bokeh.plotting
-from bokeh.models.tools import HoverTool
-from bokeh.models.ranges import Range1d
+# Bokeh is slow to import, so it is only imported by the functions that
+# need it; the other pages (and worker startup) don't pay for it
+
+
+# File in the job directory that caches the rendered chi plot
+CHI_PLOT_CACHE_FILE = 'chiplot.json'
+
+
+# Groups of near-identical conformers, each given to MultiFoXS as a single
+# conformer (should match that in backend/foxs/run_foxs.py)
+CONFORMER_GROUPS_FILE = 'conformer-groups.txt'
+
+# Clusters of similar profiles, each given to MultiFoXS as its medoid
+# (should match that in backend/foxs/run_foxs.py)
+PROFILE_CLUSTERS_FILE = 'profile-clusters.txt'
 
 
 PDB = collections.namedtuple('PDB', ['filename', 'rg', 'weight', 'num'])
 
 
+ConformerGroups = collections.namedtuple(
+    'ConformerGroups', ['threshold', 'nconformers', 'groups'])
+
+
+ProfileClusters = collections.namedtuple(
+    'ProfileClusters', ['nprofiles', 'refine', 'clusters'])
+
+
 class MultiStateModel(object):
     def __init__(self, job, state_num, model_num, ensemble_filename,
                  color, rg):
@@ -68,23 +87,73 @@ def get_multi_state_models(job, max_state):
     for size in range(2, max_state + 1):
         fn = job.get_path("ensembles_size_%d.txt" % size)
         if os.path.exists(fn):
-            yield MultiStateModel(job, size, 1, fn, colors[size-1], rg)
+            yield MultiStateModel(job, size, 1, fn,
+                                  colors[(size - 1) % len(colors)], rg)
+
+
+def get_conformer_groups(job):
+    """Get the groups of conformers that were represented by a single
+       conformer in MultiFoXS, as (representative, [other members]) pairs,
+       or None if all conformers were used"""
+    fname = job.get_path(CONFORMER_GROUPS_FILE)
+    if not os.path.exists(fname):
+        return None
+    header, groups = _read_groups(fname)
+    return ConformerGroups(threshold=float(header[-1]),
+                           nconformers=sum(len(g) for g in groups),
+                           groups=[(g[0], g[1:]) for g in groups
+                                   if len(g) > 1])
+
+
+def get_profile_clusters(job):
+    """Get the clusters of similar profiles, each represented by its medoid
+       in MultiFoXS, as (medoid, [other members]) pairs, or None if the
+       profiles were not clustered"""
+    fname = job.get_path(PROFILE_CLUSTERS_FILE)
+    if not os.path.exists(fname):
+        return None
+    header, clusters = _read_groups(fname)
+    # Show structure names rather than those of their profiles
+    clusters = [[re.sub(r'\.dat$', '', m) for m in c] for c in clusters]
+    return ProfileClusters(nprofiles=sum(len(c) for c in clusters),
+                           refine=header[-1] == '1',
+                           clusters=[(c[0], c[1:]) for c in clusters])
+
+
+def _read_groups(fname):
+    """Read a file of groups written by the backend. Return the words of
+       the header line, and each group (representative first)."""
+    header = []
+    groups = []
+    with open(fname) as fh:
+        for line in fh:
+            spl = line.split()
+            if line.startswith('#'):
+                header = spl
+            elif spl:
+                groups.append(spl)
+    return header, groups
 
 
+@functools.lru_cache(maxsize=None)
 def get_bokeh():
-    """Return info for getting BokehJS from its CDN"""
+    """Return info for getting BokehJS from its CDN. This does not change
+       while the process is running, so is computed only once."""
+    import bokeh
+    import bokeh.resources
     js = 'bokeh-%s.min.js' % bokeh.__version__
     jshash = bokeh.resources.get_sri_hashes_for_version(bokeh.__version__)[js]
     return {'js': js, 'hash': jshash}
 
 
-def get_chi_plot_source(job):
+def get_chi_plot_source(chis_file):
     """Read the chis file and return a bokeh data source"""
+    import bokeh.plotting
     nstate = []
     val = []
     valerr = []
     desc = []
-    with open(job.get_path('chis')) as fh:
+    with open(chis_file) as fh:
         for line in fh:
             s = line.split()
             if len(s) != 3:
@@ -99,8 +168,44 @@ def get_chi_plot_source(job):
 
 
 def get_chi_plot(job):
+    """Get the chi vs #state plot. Rendered plots are cached, both in the
+       job directory and in memory, keyed by the modification time of the
+       chis file and the Bokeh version. The returned dict should not be
+       modified."""
+    chis_file = job.get_path('chis')
+    return _get_cached_chi_plot(chis_file, os.stat(chis_file).st_mtime,
+                                job.get_path(CHI_PLOT_CACHE_FILE))
+
+
+@functools.lru_cache(maxsize=256)
+def _get_cached_chi_plot(chis_file, chis_mtime, cache_file):
+    import bokeh
+    key = {'chis_mtime': chis_mtime, 'bokeh': bokeh.__version__}
+    try:
+        with open(cache_file) as fh:
+            cached = json.load(fh)
+        if cached.get('key') == key:
+            return cached['plot']
+    except (OSError, ValueError):
+        pass
+    plot = render_chi_plot(chis_file)
+    tmp = cache_file + '.tmp'
+    try:
+        with open(tmp, 'w') as fh:
+            json.dump({'key': key, 'plot': plot}, fh)
+        os.rename(tmp, cache_file)
+    except OSError:
+        pass  # Job directory may not be writeable; just cache in memory
+    return plot
+
+
+def render_chi_plot(chis_file):
     """Render the chi vs #state plot using Bokeh"""
-    source = get_chi_plot_source(job)
+    import bokeh.embed
+    import bokeh.plotting
+    from bokeh.models.tools import HoverTool
+    from bokeh.models.ranges import Range1d
+    source = get_chi_plot_source(chis_file)
     # If the error bars are huge, truncate them so we can see the best chi
     # in the default view
     ymax = min(max(source.data['val'])*2.,
@@ -0,0 +1 @@
+../../backend/foxs/exp_profile.py
\ No newline at end of file
@@ -0,0 +1,93 @@
+"""HTTP caching of completed jobs' result files and pages.
+
+   Once a job has completed its files never change, so they are sent with
+   long-lived cache headers. Flask already handles conditional (ETag and
+   Last-Modified) and byte-range requests for files. Large text results
+   may also have gzip-compressed copies made by the backend (see
+   backend/foxs/compress.py), which are sent instead to clients that
+   accept them, unless only part of the file was asked for (byte ranges
+   refer to the original file). Results pages are rendered only if the
+   client does not already have an up to date copy."""
+
+from flask import request, send_from_directory, make_response
+import functools
+import hashlib
+import mimetypes
+import os
+
+
+# How long clients may cache job files, in seconds
+FILE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Suffix of compressed copies of job files
+# (should match that in backend/foxs/compress.py)
+GZIP_SUFFIX = '.gz'
+
+
+def send_job_file(job, fp):
+    """Send the given file from a completed job's directory"""
+    gzip_fp = fp + GZIP_SUFFIX
+    if (request.range is None and 'gzip' in request.accept_encodings
+            and os.path.exists(job.get_path(gzip_fp))):
+        resp = send_from_directory(
+            job.directory, gzip_fp, max_age=FILE_MAX_AGE,
+            mimetype=(mimetypes.guess_type(fp)[0]
+                      or 'application/octet-stream'))
+        resp.headers['Content-Encoding'] = 'gzip'
+    else:
+        resp = send_from_directory(job.directory, fp, max_age=FILE_MAX_AGE)
+    resp.vary.add('Accept-Encoding')
+    return set_immutable(resp)
+
+
+def set_immutable(resp):
+    """Allow the browser to cache a response derived only from a
+       completed job's files"""
+    resp.cache_control.max_age = FILE_MAX_AGE
+    # Files are only available with the job password
+    resp.cache_control.private = True
+    resp.cache_control.immutable = True
+    return resp
+
+
+@functools.lru_cache(maxsize=None)
+def _get_app_version():
+    """Get a token that changes whenever the frontend is redeployed, so
+       that clients don't keep pages rendered by older versions"""
+    topdir = os.path.dirname(os.path.abspath(__file__))
+    mtimes = [os.stat(os.path.join(dirpath, f)).st_mtime
+              for dirpath, dirnames, filenames in os.walk(topdir)
+              for f in filenames]
+    return repr(max(mtimes))
+
+
+def _get_job_mtime(job):
+    """Get the time the job's results were last changed"""
+    summary = job.get_path('summary.json')
+    if os.path.exists(summary):
+        return os.stat(summary).st_mtime
+    else:
+        # Older jobs have no summary
+        return os.stat(job.directory).st_mtime
+
+
+def conditional_page(job, render):
+    """Return a results page for a completed job, calling render() to make
+       it only if the client's cached copy is out of date"""
+    mtime = _get_job_mtime(job)
+    # Pages also depend on the query string (password, page number) and
+    # on the logged-in user (shown in the page layout)
+    etag = hashlib.sha256(repr(
+        (job.name, mtime, request.full_path,
+         request.headers.get('Cookie'), _get_app_version())).encode(
+             'utf-8')).hexdigest()
+    if request.if_none_match.contains(etag):
+        resp = make_response('', 304)
+    else:
+        resp = make_response(render())
+    resp.set_etag(etag)
+    resp.last_modified = mtime
+    resp.vary.add('Cookie')
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True
+    return resp
@@ -0,0 +1 @@
+../../backend/foxs/input_check.py
\ No newline at end of file
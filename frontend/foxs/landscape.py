@@ -0,0 +1,67 @@
+"""Chi^2 landscapes from c1/c2 parameter scans.
+
+   If a job was submitted with the scan option, the backend fits each
+   structure at every point of a grid of excluded volume (c1) and
+   hydration layer (c2) parameters, and writes the chi^2 values as an
+   array file (see write_chi_landscape in backend/foxs/run_foxs.py). The
+   results page draws each structure's landscape in the browser as a
+   heatmap, from the same compact binary payload used for profiles (see
+   plot_data.py). The landscape is computed from partial profiles, while
+   the fit itself may have been done by FoXS (and with c1 or c2 fixed), so
+   the reported fit is marked on the heatmap as well as the best point of
+   the grid."""
+
+import collections
+import functools
+import os
+import numpy
+from . import plot_data
+
+
+# (should match that in backend/foxs/run_foxs.py)
+CHI_LANDSCAPE_FILE = 'chi-landscape.npz'
+
+
+Landscape = collections.namedtuple('Landscape',
+                                   ['c1', 'c2', 'structures', 'fits'])
+
+
+@functools.lru_cache(maxsize=64)
+def _read_landscape(fname, mtime):
+    with numpy.load(fname, allow_pickle=False) as data:
+        return (data['c1'], data['c2'], data['chi2'],
+                [str(s) for s in data['structures']])
+
+
+def _get_landscape_data(job):
+    fname = job.get_path(CHI_LANDSCAPE_FILE)
+    if not os.path.exists(fname):
+        return None
+    return _read_landscape(fname, os.stat(fname).st_mtime)
+
+
+def get_landscape(job, fits):
+    """Get the c1 and c2 values and structure names of a job's chi^2
+       landscape, plus the reported [chi, c1, c2] of each structure's fit
+       (or None) given the job's fits (see summary.parse_log), or None if
+       the job did not do a parameter scan"""
+    data = _get_landscape_data(job)
+    if data is None:
+        return None
+    c1, c2, chi2, structures = data
+    return Landscape(c1=[float(x) for x in c1], c2=[float(x) for x in c2],
+                     structures=structures,
+                     fits=[[float(x) for x in fits[s]] if s in fits else None
+                           for s in structures])
+
+
+def get_payload(job, index):
+    """Get the binary payload of the (c1, c2) chi^2 array for the
+       structure with the given index, or None if there isn't one"""
+    data = _get_landscape_data(job)
+    if data is None:
+        return None
+    chi2 = data[2]
+    if index < 0 or index >= chi2.shape[0]:
+        return None
+    return plot_data.encode(chi2[index])
@@ -0,0 +1 @@
+../../backend/foxs/partial_profile.py
\ No newline at end of file
@@ -0,0 +1,141 @@
+"""Shared cache of structures fetched by PDB code.
+
+   Extracting the requested chains of a PDB entry from the PDB mirror is
+   slow for large entries, and the same popular entries are requested
+   over and over. The extracted files are kept in a directory shared by
+   all frontend processes, keyed by the PDB code, chains and allowed
+   formats, and are hard linked into each job that needs them. The
+   directory is kept below a maximum size by removing the least recently
+   used entries. It can be filled in advance with the warm-pdb-cache
+   command, e.g. `flask warm-pdb-cache popular.txt`."""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import saliweb.frontend
+from .config import get_config
+
+
+# Formats that can be fetched by PDB code
+FORMATS = ("PDB", "MMCIF", "IHM")
+
+# Prefix of entries still being added to the cache
+_TMP_PREFIX = '.tmp'
+
+
+def _get_key(code, formats):
+    """Get the cache key for a PDB code (with optional chains)"""
+    pdb_id, _, chains = code.strip().partition(':')
+    return hashlib.sha256(("%s:%s:%s" % (pdb_id.lower(), chains,
+                                         ",".join(formats))).encode(
+        'utf-8')).hexdigest()
+
+
+def _get_entry(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], key)
+
+
+def _lookup(entry):
+    """Get the cached file in the given entry, marking the entry as
+       recently used, or None if it is not cached"""
+    try:
+        fnames = os.listdir(entry)
+        os.utime(entry)
+    except FileNotFoundError:
+        return None
+    return os.path.join(entry, fnames[0]) if len(fnames) == 1 else None
+
+
+def _add(cache_dir, entry, code, formats):
+    """Fetch a PDB entry and add it to the cache. Return the cached file."""
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+    tmpdir = tempfile.mkdtemp(prefix=_TMP_PREFIX, dir=os.path.dirname(entry))
+    try:
+        fname = os.path.basename(saliweb.frontend.get_pdb_chains(
+            code, tmpdir, formats=list(formats)))
+        try:
+            os.rename(tmpdir, entry)
+            tmpdir = None
+        except OSError:
+            # Another process added the same entry first; use theirs
+            pass
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    return os.path.join(entry, fname)
+
+
+def _entries(cache_dir):
+    """Get (mtime, size, path) for every complete entry in the cache"""
+    for subdir in os.scandir(cache_dir):
+        if not subdir.is_dir():
+            continue
+        for entry in os.scandir(subdir.path):
+            if entry.name.startswith(_TMP_PREFIX) or not entry.is_dir():
+                continue
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                yield entry.stat().st_mtime, size, entry.path
+            except FileNotFoundError:  # removed by another process
+                pass
+
+
+def evict(cache_dir, max_size, keep=None):
+    """Remove the least recently used entries from the cache until it is
+       no larger than `max_size` bytes. The entry `keep` is never
+       removed."""
+    entries = sorted(_entries(cache_dir))
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in entries:
+        if total <= max_size:
+            break
+        if path != keep:
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+def _get_cached(cache_dir, code, formats):
+    """Get the cached file for a PDB code, adding it if necessary"""
+    entry = _get_entry(cache_dir, _get_key(code, formats))
+    cached = _lookup(entry)
+    if cached is None:
+        cached = _add(cache_dir, entry, code, formats)
+        evict(cache_dir, get_config('pdb_cache_max_size', 1024) * 1024 * 1024,
+              keep=entry)
+    return cached
+
+
+def get_pdb_chains(code, outdir, formats=FORMATS):
+    """Like saliweb.frontend.get_pdb_chains, but use the cache if one is
+       configured"""
+    cache_dir = get_config('pdb_cache', '')
+    if cache_dir:
+        cached = _get_cached(cache_dir, code, formats)
+        out = os.path.join(outdir, os.path.basename(cached))
+        try:
+            os.link(cached, out)
+            return out
+        except FileNotFoundError:
+            # Entry was just evicted by another process; fetch directly
+            pass
+        except OSError:
+            shutil.copyfile(cached, out)
+            return out
+    return saliweb.frontend.get_pdb_chains(code, outdir,
+                                           formats=list(formats))
+
+
+def warm(codes):
+    """Add the given PDB codes to the cache. Return a list of
+       (code, error) pairs for codes that could not be fetched."""
+    cache_dir = get_config('pdb_cache', '')
+    if not cache_dir:
+        raise ValueError("No PDB cache is configured")
+    failed = []
+    for code in codes:
+        try:
+            _get_cached(cache_dir, code, FORMATS)
+        except Exception as exc:
+            failed.append((code, str(exc)))
+    return failed
@@ -0,0 +1,89 @@
+"""Compact profile and fit data for client-side plotting.
+
+   Profile (.dat) and fit (.fit, or the .dat written by FoXS when fitting)
+   files are sent to the results pages as a small binary payload rather
+   than as text or gnuplot canvas scripts. The payload is two little-endian
+   unsigned 32-bit integers (the number of rows and columns) followed by
+   the data as row-major little-endian 32-bit floats, and is read in the
+   browser as a Float32Array (see html/js/foxs_plot.js). Large profiles are
+   decimated, keeping the extremes of the intensity in each q bin so that
+   the shape of the curve is preserved."""
+
+import functools
+import os
+import struct
+import numpy
+from . import exp_profile
+
+
+# Default and maximum number of points sent per profile
+DEFAULT_POINTS = 500
+MAX_POINTS = 5000
+
+
+def read_columns(fname):
+    """Read the numeric columns of a profile or fit file, skipping comments
+       and any lines that can't be parsed"""
+    rows = []
+    ncol = None
+    with open(fname, encoding='latin1') as fh:
+        for line in fh:
+            if line.startswith('#'):
+                continue
+            try:
+                row = [float(x) for x in line.split()]
+            except ValueError:
+                continue
+            if not row or (ncol is not None and len(row) != ncol):
+                continue
+            ncol = len(row)
+            rows.append(row)
+    return numpy.array(rows, dtype=numpy.float64).reshape(
+        (len(rows), ncol or 0))
+
+
+def decimate(data, max_points):
+    """Reduce `data` to at most about `max_points` rows. Rows are split
+       into bins of equal size and the rows with the smallest and largest
+       intensity (second column) in each bin are kept, in their original
+       order."""
+    nrow = data.shape[0]
+    if nrow <= max_points or data.shape[1] < 2:
+        return data
+    nbins = max(1, max_points // 2)
+    keep = []
+    for rows in numpy.array_split(numpy.arange(nrow), nbins):
+        y = data[rows, 1]
+        keep.extend(sorted({rows[numpy.argmin(y)], rows[numpy.argmax(y)]}))
+    return data[keep]
+
+
+def encode(data):
+    """Encode a 2D array as the binary payload"""
+    nrow, ncol = data.shape
+    return (struct.pack('<II', nrow, ncol)
+            + numpy.ascontiguousarray(data, dtype='<f4').tobytes())
+
+
+def read_profile(fname):
+    """Read the columns of a profile or fit file. Experimental profiles
+       are read from their canonical binary form, if they have one (see
+       exp_profile); an error column that was not given is dropped."""
+    if not os.path.exists(fname + '.npy'):
+        return read_columns(fname)
+    data = exp_profile.load_profile(fname)
+    if numpy.all(numpy.isnan(data[:, 2])):
+        data = data[:, :2]
+    return data
+
+
+@functools.lru_cache(maxsize=256)
+def _get_payload(fname, mtime, max_points):
+    return encode(decimate(read_profile(fname), max_points))
+
+
+def get_payload(fname, max_points=DEFAULT_POINTS):
+    """Get the binary payload for the given file. Completed jobs do not
+       change, so payloads are cached, keyed by file modification time."""
+    max_points = min(max(max_points, 2), MAX_POINTS)
+    return _get_payload(fname, os.stat(fname).st_mtime, max_points)
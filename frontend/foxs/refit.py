@@ -0,0 +1,106 @@
+"""Refitting of a completed job with new fit parameters.
+
+   When fitting to a profile, FoXS also writes the partial profiles of
+   each structure, from which the fit for any excluded volume (c1) and
+   hydration layer (c2) parameters can be quickly computed. A refit is a
+   new job with the original job's structures, profiles and partial
+   profiles plus the new fit parameters; the backend then only redoes the
+   fit, without recomputing the profiles (see run_refit in
+   backend/foxs/run_foxs.py)."""
+
+from flask import request
+import saliweb.frontend
+from saliweb.frontend import InputValidationError
+import os
+import shutil
+from . import submit_page, submodels, summary
+from .batch_submit import copy_job_files
+
+
+# Name of the original job, for a refit
+# (should match that in backend/foxs/run_foxs.py)
+REFIT_FILE = 'refit-from.txt'
+
+
+def is_partial_profile(fname):
+    """Return True iff the given file is a partial profile written by FoXS
+       (q plus 3 or 6 partial profiles, rather than q, intensity, error)"""
+    if not os.path.exists(fname):
+        return False
+    with open(fname, encoding='latin1') as fh:
+        for line in fh:
+            if not line.startswith('#'):
+                return len(line.split()) in (4, 7)
+    return False
+
+
+def get_profiles(job, profile):
+    """Get all experimental profiles used by a job"""
+    fname = job.get_path('profiles.txt')
+    if os.path.exists(fname):
+        with open(fname) as fh:
+            return [f.strip() for f in fh]
+    else:
+        return [profile]
+
+
+def handle_refit(job):
+    with open(job.get_path('data.txt')) as fh:
+        fields = fh.readline().split()
+    archive, profile = fields[:2]
+    if profile == '-':
+        raise InputValidationError(
+            "Only jobs with an experimental profile can be refit")
+    if len(fields) > 15 and fields[15] == '1':
+        raise InputValidationError("Batch mode jobs cannot be refit")
+    if fields[10] == '1':
+        raise InputValidationError(
+            "Jobs that used background adjustment cannot be refit")
+    structures = summary.get_pdb_files(job.directory)
+    if not all(is_partial_profile(job.get_path(s + '.dat'))
+               for s in structures):
+        raise InputValidationError(
+            "The profiles of this job's structures are not available, so "
+            "it cannot be refit; please submit a new job")
+
+    hlayer, hlayer_value = submit_page.get_float_parameter(
+        checkbox="hlayer", parameter="c2", default=0.0, rng=(-1.0, 4.0),
+        name="hydration layer density")
+    exvolume, exvolume_value = submit_page.get_float_parameter(
+        checkbox="exvolume", parameter="c1", default=1.0, rng=(0.95, 1.05),
+        name="excluded volume adjustment parameter")
+    offset = 1 if request.form.get('offset') else 0
+    # Keep the original options for the profile calculation
+    opts = submit_page.JobOptions(
+        q=float(fields[3]), psize=int(fields[4]), hlayer=hlayer,
+        exvolume=exvolume, ihydrogens=int(fields[7]), residue=int(fields[8]),
+        offset=offset, background=0, hlayer_value=hlayer_value,
+        exvolume_value=exvolume_value, model_option=int(fields[13]),
+        unit_option=int(fields[14]))
+
+    profiles = get_profiles(job, profile)
+    scan = 1 if request.form.get('scan') else 0
+    if scan:
+        submit_page.check_scan(len(profiles), opts, batch=0)
+    # Give MultiFoXS the same profiles as before
+    pool = submit_page.read_pool_options(fields)
+    newjob = saliweb.frontend.IncomingJob(job.name + '_refit')
+    try:
+        copy_job_files(
+            job, newjob, set([archive] + structures
+                             + [s + '.dat' for s in structures] + profiles
+                             + [p + '.npy' for p in profiles]
+                             + [submodels.SUBMODEL_INDEX_FILE]
+                             + submodels.get_sources(job)))
+        submit_page.write_job_files(newjob, structures, archive, profile,
+                                    opts, batch=0, scan=scan, pool=pool)
+        if len(profiles) > 1:
+            with open(newjob.get_path('profiles.txt'), 'w') as fh:
+                fh.write("\n".join(profiles))
+        with open(newjob.get_path(REFIT_FILE), 'w') as fh:
+            fh.write(job.name + '\n')
+    except Exception:
+        shutil.rmtree(newjob.directory, ignore_errors=True)
+        raise
+    newjob.submit(job.email)
+    return saliweb.frontend.redirect_to_results_page(newjob)
@@ -0,0 +1,166 @@
+"""Machine-readable job results.
+
+   These are built from the job summary (see get_summary in
+   results_page.py) rather than by parsing foxs.log, and are available as
+   a single JSON document or as newline-delimited JSON (one record per
+   line) which is streamed, for large jobs. NDJSON records have a "type"
+   of "job", "structure" or "ensemble"; the JSON document has the same
+   information with the structures and ensembles in lists. Structures of
+   multi-profile jobs also list their fit to each profile."""
+
+from flask import Response, jsonify, stream_with_context
+import glob
+import json
+import os
+import re
+from .results_page import (get_summary, BATCH_INDEX_ENTRY_SIZE,
+                           CHI_MATRIX_FILE)
+from .ensemble import MultiStateModel, read_rg
+
+
+def _float_or_none(val):
+    return None if val is None else float(val)
+
+
+def get_job_record(job, summary):
+    return {'name': job.name, 'pdb': summary['pdb'],
+            'profile': summary['profile'], 'error': summary['error'],
+            'batch': os.path.exists(job.get_path('batch-summary.idx'))}
+
+
+def get_rg(job):
+    """Get a dict of radius of gyration for each structure, if computed"""
+    fname = job.get_path('rg')
+    if not os.path.exists(fname):
+        return {}
+    with open(fname) as fh:
+        return read_rg(fh)
+
+
+def _structure(job, pdb_file, fit, fit_dat, profile_dat, rg):
+    chi, c1, c2 = fit if fit else (None, None, None)
+    return {'pdb_file': pdb_file,
+            'url': job.get_results_file_url(pdb_file),
+            'profile_url': (job.get_results_file_url(profile_dat)
+                            if profile_dat else None),
+            'chi': _float_or_none(chi), 'c1': _float_or_none(c1),
+            'c2': _float_or_none(c2),
+            'fit_url': job.get_results_file_url(fit_dat) if fit_dat else None,
+            'rg': rg.get(pdb_file)}
+
+
+def _get_fit_dat(pdb_file, profile):
+    return "%s_%s.dat" % (os.path.splitext(pdb_file)[0],
+                          os.path.splitext(profile)[0])
+
+
+def get_profile_fits(job):
+    """Get the fits of a multi-profile job, as a dict keyed by structure
+       of a list of fits (one per profile), or an empty dict for other
+       jobs"""
+    fname = job.get_path(CHI_MATRIX_FILE)
+    if not os.path.exists(fname):
+        return {}
+    with open(fname) as fh:
+        matrix = json.load(fh)
+    fits = {}
+    for profile, profile_fits in zip(matrix['profiles'], matrix['fits']):
+        for structure, (chi, c1, c2) in zip(matrix['structures'],
+                                            profile_fits):
+            fit_dat = _get_fit_dat(structure, profile)
+            fits.setdefault(structure, []).append(
+                {'profile': profile, 'chi': chi, 'c1': c1, 'c2': c2,
+                 'fit_url': job.get_results_file_url(fit_dat)})
+    return fits
+
+
+def get_structures(job, summary, rg):
+    """Yield a dict for each structure in the job"""
+    if os.path.exists(job.get_path('batch-summary.idx')):
+        yield from _get_batch_structures(job, summary, rg)
+        return
+    profile = summary['profile']
+    profile = None if profile in (None, '-') else profile
+    profile_fits = get_profile_fits(job)
+    for pdb_file in summary['pdb_files']:
+        fit = summary['fits'].get(pdb_file) if profile else None
+        fit_dat = _get_fit_dat(pdb_file, profile) if fit else None
+        s = _structure(job, pdb_file, fit, fit_dat, pdb_file + '.dat', rg)
+        if profile_fits:
+            s['profiles'] = profile_fits.get(pdb_file, [])
+        yield s
+
+
+def _get_batch_structures(job, summary, rg):
+    """Yield a dict for each structure in a batch mode job, best fits
+       first. Profile and fit files are only kept for the structures
+       given to MultiFoXS."""
+    profile = summary['profile']
+    with open(job.get_path('batch-summary.idx'), 'rb') as idx, \
+            open(job.get_path('batch-summary.txt'), 'rb') as fh:
+        for entry in iter(lambda: idx.read(BATCH_INDEX_ENTRY_SIZE), b''):
+            fh.seek(int(entry))
+            pdb_file, chi, c1, c2 = fh.readline().decode('latin1').split()
+            fit_dat = _get_fit_dat(pdb_file, profile)
+            profile_dat = pdb_file + '.dat'
+            yield _structure(
+                job, pdb_file, (chi, c1, c2),
+                fit_dat if os.path.exists(job.get_path(fit_dat)) else None,
+                (profile_dat if os.path.exists(job.get_path(profile_dat))
+                 else None), rg)
+
+
+class _RgLookup(dict):
+    """Radius of gyration lookup which gives None for unknown structures"""
+    def __missing__(self, key):
+        return None
+
+
+def get_ensembles(job, rg):
+    """Yield a dict for the best scoring MultiFoXS ensemble of each size"""
+    sizere = re.compile(r'ensembles_size_(\d+)\.txt$')
+    sizes = sorted(int(m.group(1)) for m in
+                   (sizere.search(f) for f in
+                    glob.glob(job.get_path('ensembles_size_*.txt'))) if m)
+    for size in sizes:
+        m = MultiStateModel(job, size, 1,
+                            job.get_path('ensembles_size_%d.txt' % size),
+                            None, _RgLookup(rg))
+        yield {'size': size, 'score': m.score, 'c1': m.c1, 'c2': m.c2,
+               'members': [{'pdb_file': p.filename, 'weight': p.weight,
+                            'rg': p.rg} for p in m.pdbs],
+               'fit_url': job.get_results_file_url(m.fit_file)}
+
+
+def get_json(job):
+    """Get all results for the job as a JSON response"""
+    summary = get_summary(job)
+    rec = get_job_record(job, summary)
+    if summary['error']:
+        rec.update(structures=[], ensembles=[])
+    else:
+        rg = get_rg(job)
+        rec.update(structures=list(get_structures(job, summary, rg)),
+                   ensembles=list(get_ensembles(job, rg)))
+    return jsonify(rec)
+
+
+def get_ndjson(job):
+    """Get all results for the job as a streamed NDJSON response"""
+    summary = get_summary(job)
+
+    def generate():
+        yield _ndjson_line('job', get_job_record(job, summary))
+        if summary['error']:
+            return
+        rg = get_rg(job)
+        for s in get_structures(job, summary, rg):
+            yield _ndjson_line('structure', s)
+        for e in get_ensembles(job, rg):
+            yield _ndjson_line('ensemble', e)
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
+
+
+def _ndjson_line(rectype, rec):
+    return json.dumps(dict(type=rectype, **rec)) + '\n'
@@ -1,10 +1,14 @@
-from flask import url_for
+from flask import url_for, request
 import saliweb.frontend
 import collections
+import functools
+import json
 import os
 import re
-import glob
 from .ensemble import get_multi_state_models, get_bokeh, get_chi_plot
+from .ensemble import get_conformer_groups, get_profile_clusters
+from . import landscape, continue_search, reweight
+from .summary import make_summary
 
 
 Fit = collections.namedtuple('Fit', ['png', 'dat', 'chi', 'c1', 'c2'])
@@ -17,12 +21,95 @@ Result = collections.namedtuple(
     'Result', ['pdb', 'pdb_file', 'fit', 'profile'])
 
 
+BatchResult = collections.namedtuple(
+    'BatchResult', ['rank', 'pdb_file', 'fit'])
+
+
+MultiProfileFit = collections.namedtuple(
+    'MultiProfileFit', ['dat', 'chi', 'c1', 'c2', 'best'])
+
+
+# Number of structures shown on each page of batch mode results
+BATCH_PAGE_SIZE = 50
+
+# Number of structures (each with a plot) shown on each page of results
+RESULTS_PAGE_SIZE = 20
+
+# Ways to sort results that include a fit to a profile; the fit
+# parameters are in the same order as in the job summary
+RESULT_SORT_KEYS = ('chi', 'c1', 'c2', 'name')
+
+# Size in bytes of each entry in the batch summary index
+# (should match that in backend/foxs/run_foxs.py)
+BATCH_INDEX_ENTRY_SIZE = 13
+
+
+# Summary of the fits of a multi-profile job, and the directory for the
+# MultiFoXS run for each profile (should match those in
+# backend/foxs/run_foxs.py)
+CHI_MATRIX_FILE = 'chi-matrix.json'
+MULTIFOXS_DIR_SUFFIX = '_multifoxs'
+
+
+# Jmol table preprocessed by the backend
+# (should match that in backend/foxs/jmoltable.py)
+JMOL_TEMPLATE_FILE = 'jmoltable.tmpl'
+
+_jmol_placeholder_re = re.compile(r'\{\{(file|help):([^}]+)\}\}')
+
+# File names that appear unchanged in results URLs
+_jmol_safe_file_re = re.compile(r'[A-Za-z0-9_.\-/]+$')
+_JMOL_URL_SENTINEL = 'jmoltable-file-placeholder'
+
+
+def _help_url(anchor):
+    url = url_for("help", _anchor=anchor)
+    if anchor == 'c1c2':
+        return '%s" title="This value may indicate data overfitting' % url
+    else:
+        return url
+
+
 class JMolTableReader(object):
     """Functor to read jmol info"""
     def __init__(self, job):
         self.job = job
 
+    def available(self):
+        """Return True iff the job has a Jmol table"""
+        return (os.path.exists(self.job.get_path(JMOL_TEMPLATE_FILE))
+                or os.path.exists(self.job.get_path('jmoltable.html')))
+
     def __call__(self):
+        tmpl = self.job.get_path(JMOL_TEMPLATE_FILE)
+        if os.path.exists(tmpl):
+            return self._fill_template(tmpl)
+        else:
+            # Older jobs have only the raw table written by FoXS
+            return self._rewrite_table()
+
+    def _fill_template(self, tmpl):
+        """Fill in the job-specific URLs in the backend-made template"""
+        # Building URLs is the expensive part, so make the job URL only once
+        # and reuse it for every file whose name needs no quoting
+        url = self.job.get_results_file_url(_JMOL_URL_SENTINEL)
+        url_parts = url.split(_JMOL_URL_SENTINEL)
+        help_urls = {}
+
+        def get_url(match):
+            kind, name = match.groups()
+            if kind == 'help':
+                if name not in help_urls:
+                    help_urls[name] = _help_url(name)
+                return help_urls[name]
+            elif len(url_parts) == 2 and _jmol_safe_file_re.match(name):
+                return url_parts[0] + name + url_parts[1]
+            else:
+                return self.job.get_results_file_url(name)
+        with open(tmpl) as fh:
+            return _jmol_placeholder_re.sub(get_url, fh.read())
+
+    def _rewrite_table(self):
         with open(self.job.get_path('jmoltable.html')) as fh:
             contents = fh.read()
         # Fix link to per-job PDB or mmCIF file
@@ -42,13 +129,7 @@ class JMolTableReader(object):
 
         # Fix hard-coded links to help page
         def help_url(match):
-            anchor = match.group(1)
-            url = url_for("help", _anchor=anchor)
-            if anchor == 'c1c2':
-                return ('%s" title="This value may indicate data overfitting'
-                        % url)
-            else:
-                return url
+            return _help_url(match.group(1))
         contents = re.sub(r'https:\/\/modbase\.compbio\.ucsf\.edu\/'
                           r'foxs\/help\.html#(\w+)', help_url, contents)
 
@@ -59,38 +140,161 @@ class JMolTableReader(object):
 
 
 def show_results(job, interactive):
-    pdb, profile = get_input_data(job)
+    summary = get_summary(job)
+    pdb, profile = summary['pdb'], summary['profile']
+    # If the backend found problems with the user inputs, report them
+    if summary['error']:
+        return saliweb.frontend.render_results_template(
+            'validation_failed.html', job=job,
+            pdb=pdb, profile=profile, error=summary['error'])
+    if os.path.exists(job.get_path('batch-summary.idx')):
+        return show_batch_results(job, pdb, profile)
+    if os.path.exists(job.get_path(CHI_MATRIX_FILE)):
+        return show_multi_profile_results(job, pdb, profile)
     # If no plots were produced, there must be a problem with user inputs
-    if len(glob.glob(job.get_path("*.png"))) == 0:
+    pngs = frozenset(summary['pngs'])
+    if not any('/' not in png for png in pngs):
         return saliweb.frontend.render_results_template(
             'results_failed.html', job=job,
             pdb=pdb, profile=profile)
-    results = list(get_results(job, profile))
-    if results[0].fit:
-        png = results[0].fit.png
-    else:
-        png = results[0].profile.png
-    if not os.path.exists(job.get_path(png)):
+    first = next(get_results(summary))
+    png = first.fit.png if first.fit else first.profile.png
+    if png not in pngs:
         return saliweb.frontend.render_results_template(
             'results_failed.html', job=job,
             pdb=pdb, profile=profile)
 
+    nstruct = len(summary['pdb_files'])
     allresult = None
-    if len(results) > 1:
+    if nstruct > 1:
         fit = None if profile == '-' else Fit(png='fit.png', dat=None,
                                               chi=None, c1=None, c2=None)
         allresult = Result(pdb=None, pdb_file=None, fit=fit,
                            profile=Profile(png='profiles.png', dat=None))
-    template = 'results.html' if interactive else 'results_old.html'
+    jmoltable = JMolTableReader(job)
+    # Jobs that used profiles shared with other jobs (see batch_submit.py)
+    # were fit without FoXS so have no Jmol table; show the static page
+    if interactive and jmoltable.available():
+        # All structures are needed here, to match FoXS's Jmol table
+        return saliweb.frontend.render_results_template(
+            'results.html', job=job,
+            pdb=pdb, profile=profile, results=list(get_results(summary)),
+            allresult=allresult, include_jmoltable=jmoltable,
+            landscape=landscape.get_landscape(job, summary['fits']))
+
+    # Otherwise, show one page of structures with their plots
+    # Without a profile there are no fit parameters to sort by, so keep the
+    # order in which structures were given to FoXS
+    sort_keys = () if profile == '-' else RESULT_SORT_KEYS
+    sort = request.args.get('sort')
+    if sort not in sort_keys:
+        sort = sort_keys[0] if sort_keys else None
+    npages = max(1, (nstruct + RESULTS_PAGE_SIZE - 1) // RESULTS_PAGE_SIZE)
+    page = min(max(request.args.get('page', 1, type=int), 1), npages)
+    start = (page - 1) * RESULTS_PAGE_SIZE
+    pdb_files = sort_pdb_files(summary, sort)[start:start + RESULTS_PAGE_SIZE]
+    return saliweb.frontend.render_results_template(
+        'results_old.html', job=job,
+        pdb=pdb, profile=profile,
+        results=list(get_results(summary, pdb_files)), nstruct=nstruct,
+        sort=sort, sort_keys=sort_keys, page=page, npages=npages,
+        allresult=allresult,
+        landscape=landscape.get_landscape(job, summary['fits']))
+
+
+def sort_pdb_files(summary, sort):
+    """Get the job's structures, sorted by the given key (one of
+       RESULT_SORT_KEYS), or in input order if `sort` is None.
+       Structures without a fit (e.g. if FoXS failed on them) are
+       sorted last."""
+    if sort is None:
+        return summary['pdb_files']
+    elif sort == 'name':
+        return sorted(summary['pdb_files'])
+    col = RESULT_SORT_KEYS.index(sort)
+    fits = summary['fits']
+
+    def get_key(pdb_file):
+        fit = fits.get(pdb_file)
+        return (0, float(fit[col])) if fit else (1, 0.)
+    return sorted(summary['pdb_files'], key=get_key)
+
+
+def show_batch_results(job, pdb, profile):
+    """Show one page of the fits of a batch mode job, best fits first"""
+    nstruct = (os.stat(job.get_path('batch-summary.idx')).st_size
+               // BATCH_INDEX_ENTRY_SIZE)
+    npages = max(1, (nstruct + BATCH_PAGE_SIZE - 1) // BATCH_PAGE_SIZE)
+    page = min(max(request.args.get('page', 1, type=int), 1), npages)
+    results = get_batch_results(job, profile, (page - 1) * BATCH_PAGE_SIZE,
+                                BATCH_PAGE_SIZE)
     return saliweb.frontend.render_results_template(
-        template, job=job,
-        pdb=pdb, profile=profile, results=results,
-        allresult=allresult, include_jmoltable=JMolTableReader(job))
+        'results_batch.html', job=job, pdb=pdb, profile=profile,
+        results=results, nstruct=nstruct, page=page, npages=npages,
+        has_ensemble=os.path.exists(job.get_path('chis')))
+
+
+def show_multi_profile_results(job, pdb, profile):
+    """Show the fit of every profile to every structure in a multi-profile
+       job, plus the best MultiFoXS score for each profile"""
+    with open(job.get_path(CHI_MATRIX_FILE)) as fh:
+        matrix = json.load(fh)
+    profiles = matrix['profiles']
+    structures = matrix['structures']
+    # Index of the best-fitting structure for each profile
+    best = [min(range(len(fits)), key=lambda i: fits[i][0])
+            for fits in matrix['fits']]
+    rows = []
+    for i, structure in enumerate(structures):
+        stem = os.path.splitext(structure)[0]
+        rows.append((structure, [
+            MultiProfileFit(dat="%s_%s.dat" % (stem, os.path.splitext(p)[0]),
+                            chi=fits[i][0], c1=fits[i][1], c2=fits[i][2],
+                            best=best[j] == i)
+            for j, (p, fits) in enumerate(zip(profiles, matrix['fits']))]))
+    ensembles = matrix['ensembles']
+    sizes = sorted(set(int(size) for scores in ensembles if scores
+                       for size in scores))
+    ensemble_rows = [(size, [scores.get(str(size)) if scores else None
+                             for scores in ensembles]) for size in sizes]
+    return saliweb.frontend.render_results_template(
+        'results_multi_profile.html', job=job, pdb=pdb, profile=profile,
+        profiles=profiles, rows=rows, ensemble_rows=ensemble_rows,
+        multifoxs_dirs=[os.path.splitext(p)[0] + MULTIFOXS_DIR_SUFFIX
+                        for p in profiles])
+
+
+def get_batch_results(job, profile, start, count):
+    """Get BatchResult objects for `count` structures starting at rank
+       `start` (zero-based) in order of increasing chi. Only the batch
+       summary lines that are needed are read, using the index."""
+    profile = os.path.splitext(profile)[0]
+    results = []
+    with open(job.get_path('batch-summary.idx'), 'rb') as idx, \
+            open(job.get_path('batch-summary.txt'), 'rb') as summary:
+        idx.seek(start * BATCH_INDEX_ENTRY_SIZE)
+        for rank in range(start, start + count):
+            entry = idx.readline()
+            if not entry:
+                break
+            summary.seek(int(entry))
+            pdb_file, chi, c1, c2 = summary.readline().decode(
+                'latin1').split()
+            pdb = os.path.splitext(pdb_file)[0]
+            # Fit files are only kept for the structures given to MultiFoXS
+            dat = "%s_%s.dat" % (pdb, profile)
+            if not os.path.exists(job.get_path(dat)):
+                dat = None
+            results.append(BatchResult(
+                rank=rank + 1, pdb_file=pdb_file,
+                fit=Fit(png=None, dat=dat, chi=chi, c1=c1, c2=c2)))
+    return results
 
 
 def show_ensemble(job):
-    max_states = 4  # should match that in backend/foxs/run_foxs.py
-    pdb, profile = get_input_data(job)
+    max_states = continue_search.get_max_states(job)
+    summary = get_summary(job)
+    pdb, profile = summary['pdb'], summary['profile']
     if not os.path.exists(job.get_path("chis")):
         return saliweb.frontend.render_results_template(
             'ensemble_failed.html', job=job,
@@ -100,17 +304,26 @@ def show_ensemble(job):
             'ensemble.html', job=job,
             bokeh=get_bokeh(), chiplot=get_chi_plot(job),
             pdb=pdb, profile=profile, max_states=max_states,
-            multi_state_models=list(get_multi_state_models(job, max_states)))
+            multi_state_models=list(get_multi_state_models(job, max_states)),
+            conformer_groups=get_conformer_groups(job),
+            profile_clusters=get_profile_clusters(job),
+            fit_structures=reweight.get_structures(job),
+            ensemble_size=continue_search.get_ensemble_size(job),
+            max_ensemble_size=continue_search.get_max_ensemble_size(job))
 
 
-def get_results(job, profile):
-    """Get a list of Result objects for the given job"""
-    profile = os.path.splitext(profile)[0]
-    log_results = parse_log(job)
-    for pdb_file in get_pdb_files(job):
+def get_results(summary, pdb_files=None):
+    """Get Result objects for the given job summary, for all structures
+       or only those in `pdb_files`. Structures without a fit (e.g. if
+       FoXS failed on them) have no Fit object."""
+    profile = os.path.splitext(summary['profile'])[0]
+    if pdb_files is None:
+        pdb_files = summary['pdb_files']
+    for pdb_file in pdb_files:
         pdb = os.path.splitext(pdb_file)[0]
-        if profile != '-':
-            chi, c1, c2 = log_results[pdb_file]
+        fit = summary['fits'].get(pdb_file) if profile != '-' else None
+        if fit:
+            chi, c1, c2 = fit
             f = Fit(png="%s_%s.png" % (pdb, profile),
                     dat="%s_%s.dat" % (pdb, profile),
                     chi=chi, c1=c1, c2=c2)
@@ -120,27 +333,21 @@ def get_results(job, profile):
         yield Result(pdb=pdb, pdb_file=pdb_file, fit=f, profile=p)
 
 
-def parse_log(job):
-    """Get a dict of (chi, c1, c2) values for PDB-file keys"""
-    results = {}
-    with open(job.get_path('foxs.log'), encoding='latin1') as fh:
-        for line in fh:
-            if 'Chi^2' in line:
-                s = line.split()
-                results[s[0]] = (s[4], s[7], s[10])
-    return results
-
-
-def get_pdb_files(job):
-    """Get the PDB files used by a job"""
-    fname = job.get_path('multi-model-files.txt')
-    if not os.path.exists(fname):
-        fname = job.get_path('inputFiles.txt')
+@functools.lru_cache(maxsize=256)
+def _read_summary(job_name, fname, mtime):
     with open(fname) as fh:
-        return [line.rstrip('\r\n') for line in fh]
+        return json.load(fh)
 
 
-def get_input_data(job):
-    """Get the pdb file and profile used by a job"""
-    with open(job.get_path('data.txt')) as fh:
-        return fh.readline().split()[:2]
+def get_summary(job):
+    """Get the summary of a job's results (see summary.py).
+       Completed jobs do not change, so summaries are cached, keyed by
+       job name and summary modification time. Jobs completed before the
+       backend wrote summaries are summarized by parsing their outputs.
+       The returned dict should not be modified."""
+    fname = job.get_path('summary.json')
+    try:
+        mtime = os.stat(fname).st_mtime
+    except FileNotFoundError:
+        return make_summary(job.directory)
+    return _read_summary(job.name, fname, mtime)
@@ -0,0 +1,138 @@
+"""Fitting of user-chosen ensembles to the experimental profile.
+
+   The ensemble page shows only the ensembles found by MultiFoXS. To let
+   users try other combinations of structures, the backend stores the
+   partial profiles of every structure on the experimental q values (see
+   write_ensemble_profiles in backend/foxs/run_foxs.py). Any ensemble can
+   then be fit here, as MultiFoXS does: the same c1 and c2 are used for
+   every structure, and the best non-negative weights are found at every
+   point of the c1 x c2 grid at once."""
+
+import collections
+import functools
+import itertools
+import os
+import numpy
+from saliweb.frontend import InputValidationError
+from .config import get_config
+from . import partial_profile
+
+
+# (should match that in backend/foxs/run_foxs.py)
+ENSEMBLE_PROFILES_FILE = 'ensemble-profiles.npz'
+
+
+EnsembleProfiles = collections.namedtuple(
+    'EnsembleProfiles', ['structures', 'partials', 'q', 'intensity', 'error',
+                         'c1', 'c2', 'g', 'offset'])
+
+
+@functools.lru_cache(maxsize=16)
+def _read_profiles(fname, mtime):
+    with numpy.load(fname, allow_pickle=False) as data:
+        return EnsembleProfiles(
+            structures=[str(s) for s in data['structures']],
+            partials=data['partials'], q=data['q'],
+            intensity=data['intensity'], error=data['error'],
+            c1=data['c1'], c2=data['c2'], g=data['g'],
+            offset=bool(data['offset']))
+
+
+def get_profiles(job):
+    """Get the stored profiles of a job's structures, or None if the job
+       did not store them"""
+    fname = job.get_path(ENSEMBLE_PROFILES_FILE)
+    if not os.path.exists(fname):
+        return None
+    return _read_profiles(fname, os.stat(fname).st_mtime)
+
+
+def get_structures(job):
+    """Get the names of the structures that can be fit as an ensemble, or
+       None if ensembles cannot be fit"""
+    profiles = get_profiles(job)
+    return None if profiles is None else profiles.structures
+
+
+def _models(profiles, indices):
+    """Get the profile of each structure at every point of the c1 x c2
+       grid, as a (grid points, structures, q) array"""
+    models = partial_profile.combine_partial_profiles(
+        profiles.partials[indices][:, numpy.newaxis, numpy.newaxis, :, :],
+        profiles.g[indices][:, :, numpy.newaxis, :],
+        profiles.c2[numpy.newaxis, numpy.newaxis, :, numpy.newaxis])
+    return models.reshape((len(indices), -1, len(profiles.q))).transpose(
+        (1, 0, 2))
+
+
+def fit(profiles, indices):
+    """Fit the structures with the given indices as an ensemble. Return the
+       chi^2, c1, c2, the weight of each structure (summing to 1), the
+       overall scale, and the offset (if fit). The best non-negative
+       weights (plus offset, which may be negative) are found by solving
+       the least squares problem for each subset of the structures, for
+       every point of the grid at once, and keeping the best solution with
+       all weights positive."""
+    models = _models(profiles, indices)
+    nstruct = len(indices)
+    if profiles.offset:
+        models = numpy.concatenate(
+            (models, numpy.ones(models.shape[:1] + (1,) + models.shape[2:])),
+            axis=1)
+    w = 1. / (profiles.error * profiles.error)
+    wi = w * profiles.intensity
+    # Normal equations for every grid point
+    a = numpy.einsum('gik,gjk,k->gij', models, models, w)
+    b = numpy.einsum('gik,k->gi', models, wi)
+    c = numpy.sum(wi * profiles.intensity)
+    ngrid = a.shape[0]
+    best_chi2 = numpy.full(ngrid, numpy.inf)
+    best_x = numpy.zeros((ngrid, a.shape[1]))
+    for size in range(1, nstruct + 1):
+        for subset in itertools.combinations(range(nstruct), size):
+            ind = list(subset) + ([nstruct] if profiles.offset else [])
+            sa = a[:, ind][:, :, ind]
+            sb = b[:, ind]
+            # Guard against (nearly) identical profiles
+            ridge = 1e-12 * numpy.trace(sa, axis1=1, axis2=2) / len(ind)
+            sa = sa + ridge[:, numpy.newaxis, numpy.newaxis] * numpy.eye(
+                len(ind))
+            x = numpy.linalg.solve(sa, sb[..., numpy.newaxis])[..., 0]
+            chi2 = (c - numpy.sum(x * sb, axis=1)) / len(profiles.q)
+            better = numpy.all(x[:, :size] > 0., axis=1) & (chi2 < best_chi2)
+            best_chi2[better] = chi2[better]
+            best_x[better] = 0.
+            best_x[numpy.ix_(better, ind)] = x[better]
+    best = int(numpy.argmin(best_chi2))
+    if not numpy.isfinite(best_chi2[best]):
+        raise InputValidationError(
+            "No ensemble of these structures fits the profile")
+    i, j = numpy.unravel_index(best, (len(profiles.c1), len(profiles.c2)))
+    weights = best_x[best, :nstruct]
+    scale = numpy.sum(weights)
+    return {'chi2': float(max(best_chi2[best], 0.)),
+            'c1': float(profiles.c1[i]), 'c2': float(profiles.c2[j]),
+            'weights': [float(x) for x in weights / scale],
+            'scale': float(scale),
+            'offset': float(best_x[best, nstruct]) if profiles.offset
+            else 0.}
+
+
+def fit_ensemble(job, structures):
+    """Fit the named structures of a job as an ensemble (see fit)"""
+    profiles = get_profiles(job)
+    if profiles is None:
+        raise InputValidationError("Ensembles cannot be fit for this job")
+    max_size = get_config('max_ensemble_size', 10)
+    if not structures or len(structures) > max_size:
+        raise InputValidationError(
+            "Please choose between 1 and %d structures" % max_size)
+    if len(set(structures)) != len(structures):
+        raise InputValidationError("Each structure can only be chosen once")
+    index = dict((s, i) for i, s in enumerate(profiles.structures))
+    unknown = [s for s in structures if s not in index]
+    if unknown:
+        raise InputValidationError("Unknown structure %s" % unknown[0])
+    result = fit(profiles, [index[s] for s in structures])
+    result['structures'] = structures
+    return result
@@ -2,9 +2,14 @@ from flask import request
 import saliweb.frontend
 from saliweb.frontend import InputValidationError
 import os
+import json
+import collections
+import contextlib
 import socket
-import zipfile
+import functools
 from werkzeug.utils import secure_filename
+from .config import get_config
+from . import input_check, pdb_cache
 
 
 def handle_new_job():
@@ -12,6 +17,72 @@ def handle_new_job():
     saliweb.frontend.check_email(email, required=False)
     jobname = request.form.get('jobname')
 
+    opts = get_job_options()
+
+    # Large ensemble batch mode
+    batch = 1 if request.form.get('batch') else 0
+    if batch and not request.files.get("profile"):
+        raise InputValidationError(
+            "Batch mode requires an experimental profile")
+    max_structures = get_max_structures(batch)
+
+    # Multi-profile mode, e.g. for time-resolved SAXS
+    profiles = [fh for fh in request.files.getlist("profile") if fh]
+    if len(profiles) > 1:
+        check_multi_profile(profiles, opts, batch)
+
+    # Scan of the c1/c2 parameters
+    scan = 1 if request.form.get('scan') else 0
+    if scan:
+        check_scan(len(profiles), opts, batch)
+    pool = get_pool_options()
+
+    job = saliweb.frontend.IncomingJob(jobname)
+
+    # In fast-accept mode, uploaded files are checked later by the backend
+    deferred = get_config('deferred_validation', False)
+    pdb_file = request.files.get("pdbfile")
+    prot_file_names, archive = handle_pdb(
+        request.form.get("pdb"), pdb_file, job, deferred, max_structures)
+    if len(profiles) > 1:
+        # Multiple profiles are always checked here, as the backend only
+        # checks one
+        profile_file_names = [
+            save_job_nonempty_file(fh, job, "profile", check_profile)
+            for fh in profiles]
+        if len(set(profile_file_names)) != len(profile_file_names):
+            raise InputValidationError(
+                "Each uploaded profile must have a different file name")
+        with open(job.get_path('profiles.txt'), 'w') as fh:
+            fh.write("\n".join(profile_file_names))
+        profile_file_name = profile_file_names[0]
+    else:
+        profile_file_name = save_job_nonempty_file(
+            request.files.get("profile"), job, "profile",
+            None if deferred else check_profile) or "-"
+
+    write_job_files(job, prot_file_names, archive, profile_file_name, opts,
+                    batch, scan=scan, pool=pool)
+
+    if deferred:
+        write_validation_request(
+            job, archive if pdb_file else None,
+            os.path.basename(pdb_file.filename) if pdb_file else None,
+            (None if profile_file_name == '-' or len(profiles) > 1
+             else profile_file_name), max_structures)
+
+    job.submit(email)
+    return saliweb.frontend.redirect_to_results_page(job)
+
+
+JobOptions = collections.namedtuple(
+    'JobOptions', ['q', 'psize', 'hlayer', 'exvolume', 'ihydrogens',
+                   'residue', 'offset', 'background', 'hlayer_value',
+                   'exvolume_value', 'model_option', 'unit_option'])
+
+
+def get_job_options():
+    """Get the FoXS options for a new job from the submitted form"""
     q = request.form.get('q', 0.5, type=float)
     if q <= 0.0 or q >= 1.0:
         raise InputValidationError(
@@ -46,137 +117,167 @@ def handle_new_job():
     opts = {"angstroms": 2, "nanometers": 3}
     unit_option = opts.get(request.form.get('units'), 1)
 
-    job = saliweb.frontend.IncomingJob(jobname)
+    return JobOptions(q, psize, hlayer, exvolume, ihydrogens, residue, offset,
+                      background, hlayer_value, exvolume_value, model_option,
+                      unit_option)
 
-    prot_file_names, archive = handle_pdb(
-        request.form.get("pdb"), request.files.get("pdbfile"), job)
-    profile_file_name = save_job_nonempty_file(
-        request.files.get("profile"), job, "profile", check_profile) or "-"
 
+# Options that reduce the set of profiles given to MultiFoXS
+PoolOptions = collections.namedtuple(
+    'PoolOptions', ['dedup_rmsd', 'profile_clusters', 'cluster_refine'])
+NO_POOL_OPTIONS = PoolOptions(dedup_rmsd=0., profile_clusters=0,
+                              cluster_refine=0)
+
+
+def write_job_files(job, prot_file_names, archive, profile_file_name, opts,
+                    batch, share=0, scan=0, pool=NO_POOL_OPTIONS):
+    """Write the files read by the backend to set up the job"""
     with open(job.get_path('inputFiles.txt'), 'w') as fh:
         fh.write("\n".join(prot_file_names))
 
+    # The optional fields after batch (share, to share structure profiles
+    # with other jobs, scan, then the PoolOptions) are only written if
+    # needed
+    fmt = "%s %s %s %.2f %d %d %d %d %d %d %d %.2f %.2f %d %d %d"
+    fields = (archive, profile_file_name, '-') + tuple(opts) + (batch,)
+    optional = [("%d", share), ("%d", scan), ("%.2f", pool.dedup_rmsd),
+                ("%d", pool.profile_clusters), ("%d", pool.cluster_refine)]
+    while optional and not optional[-1][1]:
+        optional.pop()
+    for field_fmt, field in optional:
+        fmt += " " + field_fmt
+        fields += (field,)
     with open(job.get_path('data.txt'), 'w') as fh:
-        fh.write("%s %s %s %.2f %d %d %d %d %d %d %d %.2f %.2f %d %d\n"
-                 % (archive, profile_file_name, '-', q, psize,
-                    hlayer, exvolume, ihydrogens, residue, offset,
-                    background, hlayer_value, exvolume_value, model_option,
-                    unit_option))
+        fh.write(fmt % fields + "\n")
 
-    job.submit(email)
-    return saliweb.frontend.redirect_to_results_page(job)
+
+def get_pool_options():
+    """Get the options that reduce the set of profiles given to MultiFoXS:
+       the RMSD (in angstroms) below which conformers are represented by a
+       single conformer, the number of clusters of similar profiles (each
+       represented by its medoid), and whether to search again using the
+       members of the best clusters. All are 0 to use every profile."""
+    dedup_rmsd = request.form.get('dedup_rmsd', 0., type=float)
+    if dedup_rmsd < 0. or dedup_rmsd > 20.:
+        raise InputValidationError(
+            "Invalid conformer RMSD threshold; it must be >= 0 and <= 20")
+    max_clusters = get_config('max_profile_clusters', 100)
+    profile_clusters = request.form.get('profile_clusters', 0, type=int)
+    if (profile_clusters < 0 or profile_clusters == 1
+            or profile_clusters > max_clusters):
+        raise InputValidationError(
+            "Invalid number of profile clusters; it must be 0 (for no "
+            "clustering) or between 2 and %d" % max_clusters)
+    cluster_refine = 1 if request.form.get('cluster_refine') else 0
+    if cluster_refine and not profile_clusters:
+        raise InputValidationError(
+            "Refining the ensemble search requires profile clustering")
+    return PoolOptions(dedup_rmsd=dedup_rmsd,
+                       profile_clusters=profile_clusters,
+                       cluster_refine=cluster_refine)
 
 
-def check_profile(fname):
-    """Check that the profile contains at least one valid line.
-       Also, FoXS doesn't like some weird line endings (e.g. old Mac style)
-       so take this opportunity to use Python's universal line ending
-       support to get rid of them"""
-    check_valid_profile(fname)
-    tmp = fname + '.tmp'
-    with open(fname, encoding='latin1') as fhin:
-        with open(tmp, 'w', encoding='latin1') as fhout:
-            for line in fhin:
-                fhout.write(line)
-    os.rename(tmp, fname)
-
-
-def check_valid_profile(fname):
-    help_text = ("Profiles should be text files with each "
-                 "line containing a q value and measured scattering, "
-                 "which should be non-zero and positive")
-
-    if fname.endswith('.pdb') or fname.endswith('.cif'):
+def read_pool_options(fields):
+    """Get the PoolOptions from the fields of an existing data.txt"""
+    values = [field_type(field) for field_type, field
+              in zip((float, int, int), fields[18:21])]
+    return PoolOptions(*(values + list(NO_POOL_OPTIONS[len(values):])))
+
+
+def check_multi_profile(profiles, opts, batch):
+    """Check that the options are compatible with fitting many profiles"""
+    max_profiles = get_config('max_profiles', 50)
+    if len(profiles) > max_profiles and not local_connection():
+        raise InputValidationError(
+            "Only %d profiles can be fit in a single job" % max_profiles)
+    if batch:
+        raise InputValidationError(
+            "Batch mode can only be used with a single profile")
+    if opts.background:
         raise InputValidationError(
-                "PDB or mmCIF file uploaded where a profile was expected. "
-                + help_text)
-
-    with open(fname, encoding='latin1') as fh:
-        for line in fh:
-            if line.startswith('#'):
-                continue
-            spl = line.split()
-            if 2 <= len(spl) <= 5 and spl[0][0] in '0123456789':
-                try:
-                    _ = float(spl[0])
-                    sc = float(spl[1])
-                    if sc > 1e-15:
-                        return
-                except ValueError:
-                    pass
-    raise InputValidationError(
-        "Invalid profile uploaded. " + help_text)
-
-
-def handle_pdb(pdb_code, pdb_file, job):
+            "Background adjustment can only be used with a single profile")
+
+
+def check_scan(nprofiles, opts, batch):
+    """Check that the options are compatible with a c1/c2 parameter scan"""
+    if nprofiles != 1:
+        raise InputValidationError(
+            "Parameter scan requires a single experimental profile")
+    if batch:
+        raise InputValidationError(
+            "Parameter scan cannot be used in batch mode")
+    if opts.background:
+        raise InputValidationError(
+            "Parameter scan cannot be used with background adjustment")
+
+
+@contextlib.contextmanager
+def user_errors():
+    """Report errors found by input_check to the user"""
+    try:
+        yield
+    except input_check.InputError as err:
+        raise InputValidationError(str(err)) from err
+
+
+def check_profile(fname):
+    """Check that the profile contains at least one valid line, and
+       store it in canonical form (see input_check.check_profile)"""
+    with user_errors():
+        input_check.check_profile(fname)
+
+
+def get_max_structures(batch):
+    """Get the maximum number of structures that can be uploaded"""
+    if batch:
+        return get_config('batch_max_structures', 5000)
+    else:
+        return get_config('max_structures', 100)
+
+
+def write_validation_request(job, structures, show_filename, profile,
+                             max_structures):
+    """Ask the backend to check the given uploaded structure (PDB, mmCIF
+       or zip) file and/or profile before running the job"""
+    with open(job.get_path('validate.json'), 'w') as fh:
+        json.dump({'structures': structures, 'show_filename': show_filename,
+                   'profile': profile, 'local': local_connection(),
+                   'max_structures': max_structures}, fh)
+
+
+def handle_pdb(pdb_code, pdb_file, job, deferred=False, max_structures=100):
     """Handle input PDB code or file. Return a list of file names plus
-       a single archive that contains all files."""
+       a single archive that contains all files. If `deferred` is True,
+       uploaded files are saved but not checked or extracted."""
     if pdb_file:
         saved_fname = save_job_nonempty_file(
             pdb_file, job, "PDB, mmCIF or zip")
-        try:
-            return handle_zipfile(saved_fname, job), saved_fname
-        except zipfile.BadZipfile:
-            saliweb.frontend.check_pdb_or_mmcif(
-                job.get_path(saved_fname),
-                show_filename=os.path.basename(pdb_file.filename))
+        if deferred:
             return [saved_fname], saved_fname
+        with user_errors():
+            return (input_check.handle_structures(
+                saved_fname, os.path.basename(pdb_file.filename),
+                job.directory, local_connection(), max_structures,
+                check=saliweb.frontend.check_pdb_or_mmcif),
+                saved_fname)
     elif pdb_code:
-        fname = saliweb.frontend.get_pdb_chains(
-            pdb_code, job.directory, formats=["PDB", "MMCIF", "IHM"])
+        fname = pdb_cache.get_pdb_chains(pdb_code, job.directory)
         return [os.path.basename(fname)], os.path.basename(fname)
     else:
         raise InputValidationError("Error in protein input: please specify "
                                    "PDB code or upload PDB/mmCIF file")
 
 
-def handle_zipfile(zfname, job):
-    """Extract PDB files from the given zip file"""
-    exclude = frozenset((zfname, 'inputFiles.txt'))
-    pdbs = []
-    fh = zipfile.ZipFile(job.get_path(zfname))
-    for zi in fh.infolist():
-        if zi.is_dir():
-            continue
-        subdir, fname = os.path.split(zi.filename)
-        # Exclude hidden files, e.g. __MACOSX/.something.pdb
-        if fname.startswith('.'):
-            continue
-        fname = secure_filename(fname)
-        subdir = secure_filename(subdir)
-        full_fname = os.path.join(subdir, fname)
-        if full_fname not in exclude:
-            if subdir not in ('', '.'):
-                full_subdir = job.get_path(subdir)
-                if not os.path.exists(full_subdir):
-                    os.mkdir(full_subdir)
-            with open(job.get_path(full_fname), 'wb') as out_fh:
-                out_fh.write(fh.read(zi))
-            if not fname.endswith('.pdb') and not fname.endswith('.cif'):
-                raise InputValidationError(
-                    "zip file should contain ONLY files with the .pdb or "
-                    ".cif extension (first invalid file %r)" % full_fname)
-            saliweb.frontend.check_pdb_or_mmcif(
-                job.get_path(full_fname), show_filename=zi.filename)
-            pdbs.append(full_fname)
-            if len(pdbs) > 100 and not local_connection():
-                raise InputValidationError(
-                    "Only 100 PDB/mmCIF files can run on the server. "
-                    "Please use download version for more")
-    fh.close()
-    if len(pdbs) == 0:
-        raise InputValidationError(
-            "The uploaded zip file contains no PDB/mmCIFs")
-    return pdbs
-
-
-LOCAL_IPS = frozenset(('127.0.0.1',
-                       socket.gethostbyname(socket.gethostname())))
+@functools.lru_cache(maxsize=None)
+def get_local_ips():
+    """Get the IP addresses of this host. This needs a DNS lookup, so is
+       done only when first needed rather than at import time."""
+    return frozenset(('127.0.0.1', socket.gethostbyname(socket.gethostname())))
 
 
 def local_connection():
     """Return True iff we are connecting to this web service locally"""
-    return request.remote_addr in LOCAL_IPS
+    return request.remote_addr in get_local_ips()
 
 
 def save_job_nonempty_file(fh, job, filetype, check=None):
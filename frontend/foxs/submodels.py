@@ -0,0 +1,72 @@
+"""Submodels of multi-model PDB files, written out on demand.
+
+   When each model of a multi-model PDB file is treated as a separate
+   structure, the backend does not write every submodel to its own file;
+   it only records the byte range of each submodel in the original file
+   (see setup_multimodel in backend/foxs/run_foxs.py). Most submodels are
+   never looked at, so each is only written to the job directory the first
+   time it is requested."""
+
+from flask import make_response
+import functools
+import mimetypes
+import os
+from . import http_cache
+
+
+# (should match that in backend/foxs/run_foxs.py)
+SUBMODEL_INDEX_FILE = 'submodel-ranges.txt'
+
+
+@functools.lru_cache(maxsize=16)
+def _read_index(fname, mtime):
+    with open(fname) as fh:
+        return dict((s[0], (s[1], int(s[2]), int(s[3])))
+                    for s in (line.split() for line in fh))
+
+
+def get_index(job):
+    """Get a dict of (source file, start, end) byte ranges for each
+       submodel of a job, keyed by submodel file name"""
+    fname = job.get_path(SUBMODEL_INDEX_FILE)
+    if not os.path.exists(fname):
+        return {}
+    return _read_index(fname, os.stat(fname).st_mtime)
+
+
+def get_sources(job):
+    """Get the multi-model PDB files that the job's submodels are in"""
+    return sorted(set(r[0] for r in get_index(job).values()))
+
+
+def read_submodel(job, pdb, start, end):
+    """Get the contents of a submodel of a PDB file, given its byte range"""
+    with open(job.get_path(pdb), 'rb') as fh:
+        fh.seek(start)
+        data = fh.read(end - start)
+    return b"".join(line for line in data.splitlines(True)
+                    if not line.startswith(b'ENDMDL'))
+
+
+def send_submodel(job, fp):
+    """If `fp` is a submodel of a job that has not been written out yet,
+       write it to the job directory so that it can be sent as a normal
+       file, and return None. If the job directory cannot be written to,
+       return a response with the submodel instead. Return None for any
+       other file."""
+    fname = job.get_path(fp)
+    ranges = get_index(job).get(fp)
+    if ranges is None or os.path.exists(fname):
+        return None
+    contents = read_submodel(job, *ranges)
+    tmp = fname + '.%d.tmp' % os.getpid()
+    try:
+        with open(tmp, 'wb') as fh:
+            fh.write(contents)
+        os.rename(tmp, fname)
+        return None
+    except OSError:
+        resp = make_response(contents)
+        resp.mimetype = (mimetypes.guess_type(fp)[0]
+                         or 'application/octet-stream')
+        return http_cache.set_immutable(resp)
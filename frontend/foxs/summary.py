@@ -0,0 +1 @@
+../../backend/foxs/summary.py
\ No newline at end of file
@@ -0,0 +1,439 @@
+/* Client-side plotting of SAXS profiles and fits for the FoXS results
+   pages. Data are fetched from the job's plotdata endpoint as a compact
+   binary payload: two little-endian uint32s (rows, columns) followed by
+   row-major little-endian float32 values. */
+
+function FoxsPlot(canvasId, options) {
+  options = options || {};
+  this.canvas = document.getElementById(canvasId);
+  this.ctx = this.canvas.getContext('2d');
+  this.residuals = !!options.residuals;
+  this.xlabel = options.xlabel || 'q';
+  this.ylabel = options.ylabel || 'intensity (log-scale)';
+  this.series = [];
+  this.xrange = null;
+  this._setupZoom();
+}
+
+/* Add a data series. spec.url is the plotdata URL; spec.y is the column
+   to plot against column 0; spec.points draws markers instead of a line;
+   spec.residual, if given, is [exp, error, fit] columns used to draw
+   (exp - fit) / error in the residuals panel. */
+FoxsPlot.prototype.addSeries = function(spec) {
+  this.series.push({url: spec.url, y: spec.y, color: spec.color || '#333333',
+                    points: !!spec.points, residual: spec.residual || null,
+                    visible: spec.visible !== false, data: null});
+  return this.series.length - 1;
+};
+
+/* Remove all data series, e.g. to show different data on the same plot */
+FoxsPlot.prototype.clear = function() {
+  this.series = [];
+  this.xrange = null;
+};
+
+FoxsPlot.decode = function(buffer) {
+  var view = new DataView(buffer);
+  var nrow = view.getUint32(0, true), ncol = view.getUint32(4, true);
+  var values = new Float32Array(nrow * ncol);
+  for (var i = 0; i < nrow * ncol; i++) {
+    values[i] = view.getFloat32(8 + 4 * i, true);
+  }
+  return {nrow: nrow, ncol: ncol, values: values,
+          get: function(row, col) { return values[row * ncol + col]; }};
+};
+
+/* Fetch the data for all series and draw the plot */
+FoxsPlot.prototype.load = function() {
+  var self = this;
+  return Promise.all(this.series.map(function(s) {
+    return fetch(s.url).then(function(r) {
+      if (!r.ok) { throw new Error('Could not load ' + s.url); }
+      return r.arrayBuffer();
+    }).then(function(buf) {
+      s.data = FoxsPlot.decode(buf);
+    }).catch(function() { s.data = null; });
+  })).then(function() { self.draw(); });
+};
+
+FoxsPlot.prototype.setVisible = function(i, visible) {
+  if (this.series[i]) {
+    this.series[i].visible = visible;
+    this.draw();
+  }
+};
+
+FoxsPlot.prototype.toggle = function(i) {
+  if (this.series[i]) {
+    this.setVisible(i, !this.series[i].visible);
+  }
+};
+
+FoxsPlot.prototype.unzoom = function() {
+  this.xrange = null;
+  this.draw();
+};
+
+FoxsPlot.prototype._panels = function() {
+  var w = this.canvas.width, h = this.canvas.height;
+  var left = 55, right = 10, top = 10, bottom = 35;
+  var plotw = w - left - right, ploth = h - top - bottom;
+  if (this.residuals) {
+    var resh = Math.round(ploth * 0.3);
+    return {main: {x: left, y: top, w: plotw, h: ploth - resh},
+            res: {x: left, y: top + ploth - resh, w: plotw, h: resh}};
+  } else {
+    return {main: {x: left, y: top, w: plotw, h: ploth}, res: null};
+  }
+};
+
+FoxsPlot.prototype._ranges = function() {
+  var xmin = Infinity, xmax = -Infinity, ymin = Infinity, ymax = -Infinity;
+  var rmax = 0;
+  var self = this;
+  this.series.forEach(function(s) {
+    if (!s.visible || !s.data) { return; }
+    for (var i = 0; i < s.data.nrow; i++) {
+      var x = s.data.get(i, 0), y = s.data.get(i, s.y);
+      if (self.xrange && (x < self.xrange[0] || x > self.xrange[1])) {
+        continue;
+      }
+      xmin = Math.min(xmin, x);
+      xmax = Math.max(xmax, x);
+      if (y > 0) {
+        ymin = Math.min(ymin, y);
+        ymax = Math.max(ymax, y);
+      }
+      if (s.residual) {
+        var r = FoxsPlot.residual(s, i);
+        if (isFinite(r)) { rmax = Math.max(rmax, Math.abs(r)); }
+      }
+    }
+  });
+  if (this.xrange) {
+    xmin = this.xrange[0];
+    xmax = this.xrange[1];
+  }
+  if (!isFinite(xmin) || xmax <= xmin) { xmin = 0; xmax = 1; }
+  if (!isFinite(ymin) || ymax <= ymin) { ymin = 1; ymax = 10; }
+  return {x: [xmin, xmax], logy: [Math.log10(ymin), Math.log10(ymax)],
+          r: rmax > 0 ? rmax * 1.1 : 1};
+};
+
+FoxsPlot.residual = function(s, i) {
+  var c = s.residual;
+  return (s.data.get(i, c[0]) - s.data.get(i, c[2])) / s.data.get(i, c[1]);
+};
+
+FoxsPlot.prototype.draw = function() {
+  var ctx = this.ctx, panels = this._panels(), ranges = this._ranges();
+  var self = this;
+  ctx.clearRect(0, 0, this.canvas.width, this.canvas.height);
+  var m = panels.main;
+  var sx = function(x) {
+    return m.x + (x - ranges.x[0]) / (ranges.x[1] - ranges.x[0]) * m.w;
+  };
+  var sy = function(y) {
+    var ly = Math.log10(y);
+    return m.y + m.h - (ly - ranges.logy[0])
+                       / (ranges.logy[1] - ranges.logy[0]) * m.h;
+  };
+  this._sx = sx;
+  this._drawAxes(panels, ranges, sx);
+
+  ctx.save();
+  ctx.beginPath();
+  ctx.rect(m.x, m.y, m.w, m.h);
+  if (panels.res) {
+    ctx.rect(panels.res.x, panels.res.y, panels.res.w, panels.res.h);
+  }
+  ctx.clip();
+  this.series.forEach(function(s) {
+    if (!s.visible || !s.data) { return; }
+    ctx.strokeStyle = ctx.fillStyle = s.color;
+    ctx.lineWidth = s.points ? 1 : 2;
+    var started = false;
+    ctx.beginPath();
+    for (var i = 0; i < s.data.nrow; i++) {
+      var y = s.data.get(i, s.y);
+      if (!(y > 0)) { continue; }
+      var px = sx(s.data.get(i, 0)), py = sy(y);
+      if (s.points) {
+        ctx.moveTo(px + 2, py);
+        ctx.arc(px, py, 2, 0, 2 * Math.PI);
+      } else if (started) {
+        ctx.lineTo(px, py);
+      } else {
+        ctx.moveTo(px, py);
+        started = true;
+      }
+    }
+    ctx.stroke();
+    if (s.residual && panels.res) {
+      self._drawResidual(s, panels.res, ranges, sx);
+    }
+  });
+  ctx.restore();
+};
+
+FoxsPlot.prototype._drawResidual = function(s, p, ranges, sx) {
+  var ctx = this.ctx, started = false;
+  var sr = function(r) { return p.y + p.h / 2 - r / ranges.r * p.h / 2; };
+  ctx.beginPath();
+  for (var i = 0; i < s.data.nrow; i++) {
+    var r = FoxsPlot.residual(s, i);
+    if (!isFinite(r)) { continue; }
+    var px = sx(s.data.get(i, 0)), py = sr(r);
+    if (started) {
+      ctx.lineTo(px, py);
+    } else {
+      ctx.moveTo(px, py);
+      started = true;
+    }
+  }
+  ctx.stroke();
+};
+
+FoxsPlot.prototype._drawAxes = function(panels, ranges, sx) {
+  var ctx = this.ctx, m = panels.main, i;
+  var bottom = panels.res || m;
+  ctx.save();
+  ctx.strokeStyle = '#808080';
+  ctx.fillStyle = '#333333';
+  ctx.lineWidth = 1;
+  ctx.font = '10px sans-serif';
+  ctx.beginPath();
+  ctx.moveTo(m.x, m.y);
+  ctx.lineTo(m.x, bottom.y + bottom.h);
+  ctx.lineTo(m.x + m.w, bottom.y + bottom.h);
+  if (panels.res) {
+    var zero = panels.res.y + panels.res.h / 2;
+    ctx.moveTo(m.x, zero);
+    ctx.lineTo(m.x + m.w, zero);
+  }
+  ctx.stroke();
+
+  // x ticks
+  var xticks = FoxsPlot.niceTicks(ranges.x[0], ranges.x[1], 5);
+  ctx.textAlign = 'center';
+  ctx.textBaseline = 'top';
+  for (i = 0; i < xticks.length; i++) {
+    var px = sx(xticks[i]);
+    ctx.fillText(+xticks[i].toFixed(3), px, bottom.y + bottom.h + 3);
+  }
+  ctx.fillText(this.xlabel, m.x + m.w / 2, bottom.y + bottom.h + 17);
+
+  // y ticks at powers of ten
+  ctx.textAlign = 'right';
+  ctx.textBaseline = 'middle';
+  var lo = Math.ceil(ranges.logy[0]), hi = Math.floor(ranges.logy[1]);
+  var step = Math.max(1, Math.ceil((hi - lo + 1) / 6));
+  for (i = lo; i <= hi; i += step) {
+    var py = m.y + m.h - (i - ranges.logy[0])
+                         / (ranges.logy[1] - ranges.logy[0]) * m.h;
+    ctx.fillText('1e' + i, m.x - 3, py);
+  }
+  ctx.save();
+  ctx.translate(12, m.y + m.h / 2);
+  ctx.rotate(-Math.PI / 2);
+  ctx.textAlign = 'center';
+  ctx.fillText(this.ylabel, 0, 0);
+  ctx.restore();
+  ctx.restore();
+};
+
+FoxsPlot.niceTicks = function(lo, hi, n) {
+  var span = hi - lo;
+  var step = Math.pow(10, Math.floor(Math.log10(span / n)));
+  var err = n / span * step;
+  if (err <= 0.15) { step *= 10; }
+  else if (err <= 0.35) { step *= 5; }
+  else if (err <= 0.75) { step *= 2; }
+  var ticks = [];
+  for (var t = Math.ceil(lo / step) * step; t <= hi + step * 1e-6;
+       t += step) {
+    ticks.push(t);
+  }
+  return ticks;
+};
+
+/* Drag horizontally across the plot to zoom in on a q range */
+FoxsPlot.prototype._setupZoom = function() {
+  var self = this, start = null;
+  var toX = function(ev) {
+    var rect = self.canvas.getBoundingClientRect();
+    return ev.clientX - rect.left;
+  };
+  this.canvas.addEventListener('mousedown', function(ev) {
+    start = toX(ev);
+  });
+  this.canvas.addEventListener('mouseup', function(ev) {
+    if (start === null) { return; }
+    var end = toX(ev), p = self._panels().main;
+    if (Math.abs(end - start) > 5) {
+      var ranges = self._ranges();
+      var toQ = function(px) {
+        return ranges.x[0] + (px - p.x) / p.w * (ranges.x[1] - ranges.x[0]);
+      };
+      self.xrange = [toQ(Math.min(start, end)), toQ(Math.max(start, end))];
+      self.draw();
+    }
+    start = null;
+  });
+};
+
+/* The Jmol table written by FoXS shows and hides plots of the gnuplot
+   canvas output by name (jsoutput_1_plot_N); map these onto our series */
+function foxsGnuplotShim(plot) {
+  var index = function(name) {
+    return parseInt(name.split('_plot_')[1], 10) - 1;
+  };
+  return {
+    show_plot: function(name) { plot.setVisible(index(name), true); },
+    hide_plot: function(name) { plot.setVisible(index(name), false); },
+    toggle_plot: function(name) { plot.toggle(index(name)); },
+    unzoom: function() { plot.unzoom(); }
+  };
+}
+
+/* Heatmap of the chi^2 of fits over a grid of c1 (y axis) and c2 (x axis)
+   values, from a (c1, c2) plotdata-style payload. The best fit is marked
+   and, if infoId is given, reported in that element. */
+function FoxsHeatmap(canvasId, c1s, c2s, infoId) {
+  this.canvas = document.getElementById(canvasId);
+  this.ctx = this.canvas.getContext('2d');
+  this.c1s = c1s;
+  this.c2s = c2s;
+  this.info = infoId ? document.getElementById(infoId) : null;
+  this.data = null;
+  this.fit = null;
+}
+
+/* Show the landscape at url, marking the reported fit, [chi, c1, c2]
+   (if given) */
+FoxsHeatmap.prototype.show = function(url, fit) {
+  var self = this;
+  this.fit = fit || null;
+  return fetch(url).then(function(r) {
+    if (!r.ok) { throw new Error('Could not load ' + url); }
+    return r.arrayBuffer();
+  }).then(function(buf) {
+    self.data = FoxsPlot.decode(buf);
+  }).catch(function() { self.data = null; }).then(function() {
+    self.draw();
+  });
+};
+
+/* Map t in [0, 1] from dark blue (good) to pale yellow (bad) */
+FoxsHeatmap.color = function(t) {
+  var stops = [[8, 29, 88], [34, 94, 168], [65, 182, 196],
+               [199, 233, 180], [255, 255, 217]];
+  var x = Math.min(Math.max(t, 0), 1) * (stops.length - 1);
+  var i = Math.min(Math.floor(x), stops.length - 2), f = x - i;
+  var c = stops[i].map(function(v, j) {
+    return Math.round(v + f * (stops[i + 1][j] - v));
+  });
+  return 'rgb(' + c.join(',') + ')';
+};
+
+FoxsHeatmap.prototype.draw = function() {
+  var ctx = this.ctx, d = this.data, i, j;
+  var w = this.canvas.width, h = this.canvas.height;
+  var p = {x: 55, y: 10, w: w - 65, h: h - 45};
+  ctx.clearRect(0, 0, w, h);
+  if (!d || d.nrow !== this.c1s.length || d.ncol !== this.c2s.length) {
+    if (this.info) { this.info.textContent = 'No data'; }
+    return;
+  }
+  // Color on a log scale, since the best region is usually narrow
+  var lo = Infinity, hi = -Infinity, best = [0, 0];
+  for (i = 0; i < d.nrow; i++) {
+    for (j = 0; j < d.ncol; j++) {
+      var v = d.get(i, j);
+      if (!(v > 0)) { continue; }
+      if (v < lo) { lo = v; best = [i, j]; }
+      hi = Math.max(hi, v);
+    }
+  }
+  var llo = Math.log10(lo), lspan = Math.log10(hi) - llo || 1;
+  var cw = p.w / d.ncol, ch = p.h / d.nrow;
+  for (i = 0; i < d.nrow; i++) {
+    for (j = 0; j < d.ncol; j++) {
+      ctx.fillStyle = FoxsHeatmap.color(
+          (Math.log10(d.get(i, j)) - llo) / lspan);
+      // Highest c1 at the top
+      ctx.fillRect(p.x + j * cw, p.y + (d.nrow - 1 - i) * ch,
+                   Math.ceil(cw), Math.ceil(ch));
+    }
+  }
+  ctx.strokeStyle = '#d7191c';
+  ctx.lineWidth = 2;
+  // Circle at the best point of the grid
+  ctx.beginPath();
+  ctx.arc(p.x + (best[1] + 0.5) * cw, p.y + (d.nrow - 0.5 - best[0]) * ch,
+          6, 0, 2 * Math.PI);
+  ctx.stroke();
+  // Cross at the reported fit, if it is within the grid
+  var fi = this.fit ? FoxsHeatmap.nearest(this.c1s, this.fit[1]) : -1;
+  var fj = this.fit ? FoxsHeatmap.nearest(this.c2s, this.fit[2]) : -1;
+  if (fi >= 0 && fj >= 0) {
+    var bx = p.x + (fj + 0.5) * cw;
+    var by = p.y + (d.nrow - 0.5 - fi) * ch;
+    ctx.beginPath();
+    ctx.moveTo(bx - 5, by - 5);
+    ctx.lineTo(bx + 5, by + 5);
+    ctx.moveTo(bx + 5, by - 5);
+    ctx.lineTo(bx - 5, by + 5);
+    ctx.stroke();
+  }
+  this._drawAxes(p, cw, ch);
+  if (this.info) {
+    this.info.textContent = (this.fit ? 'Reported fit (cross): chi^2 = '
+        + this.fit[0].toFixed(3) + ', c1 = ' + this.fit[1].toFixed(3)
+        + ', c2 = ' + this.fit[2].toFixed(3) + '; ' : '')
+        + 'best point of the grid (circle): chi^2 = ' + lo.toFixed(3)
+        + ', c1 = ' + this.c1s[best[0]].toFixed(3)
+        + ', c2 = ' + this.c2s[best[1]].toFixed(3)
+        + '; worst chi^2 = ' + hi.toFixed(3);
+  }
+};
+
+/* Get the index of the value in the (evenly spaced) array vals closest to
+   v, or -1 if v is more than half a step outside the array */
+FoxsHeatmap.nearest = function(vals, v) {
+  var i, best = -1, dist = Infinity;
+  var half = vals.length > 1 ? Math.abs(vals[1] - vals[0]) / 2 : 1e-6;
+  for (i = 0; i < vals.length; i++) {
+    if (Math.abs(vals[i] - v) < dist) {
+      dist = Math.abs(vals[i] - v);
+      best = i;
+    }
+  }
+  return dist <= half + 1e-9 ? best : -1;
+};
+
+FoxsHeatmap.prototype._drawAxes = function(p, cw, ch) {
+  var ctx = this.ctx, c1s = this.c1s, c2s = this.c2s, i;
+  ctx.save();
+  ctx.fillStyle = '#333333';
+  ctx.font = '10px sans-serif';
+  ctx.textAlign = 'center';
+  ctx.textBaseline = 'top';
+  var xstep = Math.max(1, Math.ceil(c2s.length / 6));
+  for (i = 0; i < c2s.length; i += xstep) {
+    ctx.fillText(+c2s[i].toFixed(2), p.x + (i + 0.5) * cw, p.y + p.h + 3);
+  }
+  ctx.fillText('c2', p.x + p.w / 2, p.y + p.h + 17);
+  ctx.textAlign = 'right';
+  ctx.textBaseline = 'middle';
+  var ystep = Math.max(1, Math.ceil(c1s.length / 8));
+  for (i = 0; i < c1s.length; i += ystep) {
+    ctx.fillText(+c1s[i].toFixed(3), p.x - 3,
+                 p.y + (c1s.length - 0.5 - i) * ch);
+  }
+  ctx.translate(12, p.y + p.h / 2);
+  ctx.rotate(-Math.PI / 2);
+  ctx.textAlign = 'center';
+  ctx.fillText('c1', 0, 0);
+  ctx.restore();
+};
@@ -0,0 +1,50 @@
+import unittest
+from foxs import compress
+import saliweb.test
+import os
+import gzip
+
+
+class Tests(saliweb.test.TestCase):
+
+    def test_write_gzip_sidecars(self):
+        """Test write_gzip_sidecars()"""
+        with saliweb.test.temporary_working_directory():
+            os.mkdir('subdir')
+            big = 'x' * 5000
+            for fname, contents in (('big.dat', big), ('small.dat', 'x'),
+                                    ('big.png', big), ('input.pdb', big),
+                                    ('exp.dat', big), ('exp2.dat', big),
+                                    ('subdir/big.fit', big),
+                                    ('subdir/chi.json', big)):
+                with open(fname, 'w') as fh:
+                    fh.write(contents)
+            with open('data.txt', 'w') as fh:
+                fh.write("input.pdb exp.dat EMAIL 0.50 500 1 1 1 0 0 0 "
+                         "0.00 1.00 3 1\n")
+            with open('profiles.txt', 'w') as fh:
+                fh.write("exp.dat\nexp2.dat\n")
+            compress.write_gzip_sidecars()
+            # Uploaded structures and profiles are not compressed
+            self.assertEqual(sorted(os.listdir('.')),
+                             ['big.dat', 'big.dat.gz', 'big.png', 'data.txt',
+                              'exp.dat', 'exp2.dat', 'input.pdb',
+                              'profiles.txt', 'small.dat', 'subdir'])
+            self.assertEqual(sorted(os.listdir('subdir')),
+                             ['big.fit', 'big.fit.gz', 'chi.json',
+                              'chi.json.gz'])
+            with gzip.open('big.dat.gz', 'rt') as fh:
+                self.assertEqual(fh.read(), big)
+
+    def test_get_uploaded_profiles(self):
+        """Test get_uploaded_profiles()"""
+        with saliweb.test.temporary_working_directory():
+            self.assertEqual(compress.get_uploaded_profiles(), set())
+            with open('data.txt', 'w') as fh:
+                fh.write("input.pdb - EMAIL 0.50 500 1 1 1 0 0 0 "
+                         "0.00 1.00 3 1\n")
+            self.assertEqual(compress.get_uploaded_profiles(), set())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import unittest
+from foxs import conformers
+import saliweb.test
+import numpy
+
+
+def make_coordinates(seed=0, natom=20):
+    rng = numpy.random.default_rng(seed)
+    return rng.normal(size=(natom, 3)) * 5.
+
+
+def rotate(coords, angle):
+    c, s = numpy.cos(angle), numpy.sin(angle)
+    rot = numpy.array([[c, -s, 0.], [s, c, 0.], [0., 0., 1.]])
+    return coords.dot(rot.T)
+
+
+def write_pdb(fname, coords, name='CA'):
+    with open(fname, 'w') as fh:
+        for i, (x, y, z) in enumerate(coords):
+            fh.write("ATOM  %5d  %-3s ALA A%4d    %8.3f%8.3f%8.3f"
+                     "  1.00  0.00           C\n"
+                     % (i + 1, name, i + 1, x, y, z))
+
+
+class Tests(saliweb.test.TestCase):
+
+    def test_read_coordinates_pdb(self):
+        """Test read_coordinates() with PDB files"""
+        with saliweb.test.temporary_working_directory():
+            with open('test.pdb', 'w') as fh:
+                fh.write(
+                    "MODEL 1\n"
+                    "ATOM      1  N   ALA A   1       1.000   2.000   3.000"
+                    "  1.00  0.00           N\n"
+                    "ATOM      2  CA  ALA A   1       4.000   5.000   6.000"
+                    "  1.00  0.00           C\n"
+                    "HETATM    3  CA  CA  A   2       7.000   8.000   9.000"
+                    "  1.00  0.00          CA\n"
+                    "ENDMDL\n"
+                    "MODEL 2\n"
+                    "ATOM      1  CA  ALA A   1       1.000   1.000   1.000"
+                    "  1.00  0.00           C\n"
+                    "ENDMDL\n")
+            c = conformers.read_coordinates('test.pdb')
+            numpy.testing.assert_allclose(c, [[4., 5., 6.], [1., 1., 1.]])
+            c = conformers.read_coordinates('test.pdb',
+                                            first_model_only=True)
+            numpy.testing.assert_allclose(c, [[4., 5., 6.]])
+            # With no CA or P atoms, all atoms are used
+            write_pdb('noca.pdb', [[1., 2., 3.], [4., 5., 6.]], name='N')
+            c = conformers.read_coordinates('noca.pdb')
+            self.assertEqual(c.shape, (2, 3))
+
+    def test_read_coordinates_cif(self):
+        """Test read_coordinates() with mmCIF files"""
+        with saliweb.test.temporary_working_directory():
+            with open('test.cif', 'w') as fh:
+                fh.write("""
+loop_
+_atom_site.group_PDB
+_atom_site.label_atom_id
+_atom_site.Cartn_x
+_atom_site.Cartn_y
+_atom_site.Cartn_z
+_atom_site.pdbx_PDB_model_num
+ATOM N 1.0 2.0 3.0 1
+ATOM CA 4.0 5.0 6.0 1
+ATOM P 7.0 8.0 9.0 1
+HETATM CA 0.0 0.0 0.0 1
+ATOM CA 1.0 1.0 1.0 2
+""")
+            c = conformers.read_coordinates('test.cif')
+            numpy.testing.assert_allclose(
+                c, [[4., 5., 6.], [7., 8., 9.], [1., 1., 1.]])
+            c = conformers.read_coordinates('test.cif',
+                                            first_model_only=True)
+            self.assertEqual(c.shape, (2, 3))
+
+    def test_superposed_rmsd(self):
+        """Test superposed_rmsd()"""
+        ref = make_coordinates()
+        moved = rotate(ref, 0.7) + 3.
+        noisy = ref + make_coordinates(seed=1) * 0.1
+        rmsd = conformers.superposed_rmsd(
+            ref, numpy.array([ref, moved, noisy, -ref]))
+        self.assertAlmostEqual(rmsd[0], 0., delta=1e-6)
+        self.assertAlmostEqual(rmsd[1], 0., delta=1e-6)
+        self.assertGreater(rmsd[2], 0.1)
+        self.assertLess(rmsd[2], 1.0)
+        # Mirror images cannot be superposed
+        self.assertGreater(rmsd[3], 1.0)
+
+    def test_find_representatives(self):
+        """Test find_representatives() and write_groups()"""
+        ref = make_coordinates()
+        other = make_coordinates(seed=2)
+        with saliweb.test.temporary_working_directory():
+            write_pdb('a.pdb', ref)
+            write_pdb('b.pdb', other)
+            write_pdb('c.pdb', rotate(ref, 1.2))
+            write_pdb('d.pdb', rotate(other, 0.3) + 0.01)
+            # Different size, so never grouped with the others
+            write_pdb('e.pdb', ref[:10])
+            with open('f.pdb', 'w') as fh:
+                fh.write("REMARK no atoms\n")
+            groups = conformers.find_representatives(
+                ['a.pdb', 'b.pdb', 'c.pdb', 'd.pdb', 'e.pdb', 'f.pdb'], 0.5)
+            self.assertEqual(groups, [('a.pdb', ['a.pdb', 'c.pdb']),
+                                      ('b.pdb', ['b.pdb', 'd.pdb']),
+                                      ('e.pdb', ['e.pdb']),
+                                      ('f.pdb', ['f.pdb'])])
+            conformers.write_groups('groups.txt', groups, 0.5)
+            with open('groups.txt') as fh:
+                self.assertEqual(fh.read(),
+                                 "# RMSD threshold 0.50\na.pdb c.pdb\n"
+                                 "b.pdb d.pdb\ne.pdb\nf.pdb\n")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+from foxs import exp_profile
+import saliweb.test
+import os
+import math
+import numpy
+
+
+class Tests(saliweb.test.TestCase):
+
+    def test_parse_profile(self):
+        """Test parse_profile()"""
+        with saliweb.test.temporary_working_directory():
+            with open('test.profile', 'w') as fh:
+                fh.write("# comment\n0.1 2.0 0.1\ngarbage\n1 2 3 4 5 6\n"
+                         "0.2 3.0\n0.3 bad\n0.4 5.0 x\n")
+            p = exp_profile.parse_profile('test.profile')
+            self.assertEqual(p.shape, (3, 3))
+            self.assertAlmostEqual(p[0, 0], 0.1, delta=1e-6)
+            self.assertAlmostEqual(p[1, 1], 3.0, delta=1e-6)
+            self.assertTrue(math.isnan(p[1, 2]))
+            # Lines are read if their first two columns are numbers
+            self.assertAlmostEqual(p[2, 1], 5.0, delta=1e-6)
+            self.assertTrue(math.isnan(p[2, 2]))
+
+    def test_write_load_profile(self):
+        """Test write_profile() and load_profile()"""
+        with saliweb.test.temporary_working_directory():
+            p = numpy.array([[0.1, 2.0, 0.1], [0.2, 3.0, numpy.nan]])
+            with open('test.profile', 'w') as fh:
+                fh.write("0.5 4.0\n")
+            # No binary form yet, so the text file should be parsed
+            self.assertEqual(exp_profile.load_profile('test.profile').shape,
+                             (1, 3))
+            exp_profile.write_profile('test.profile', p)
+            # The text file is not changed (other than line endings)
+            with open('test.profile') as fh:
+                self.assertEqual(fh.read(), "0.5 4.0\n")
+            self.assertTrue(os.path.exists('test.profile.npy'))
+            loaded = exp_profile.load_profile('test.profile')
+            self.assertIsInstance(loaded, numpy.memmap)
+            numpy.testing.assert_allclose(loaded, p)
+
+
+if __name__ == '__main__':
+    unittest.main()
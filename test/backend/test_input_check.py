@@ -0,0 +1,121 @@
+import unittest
+from foxs import input_check
+import saliweb.test
+import os
+import zipfile
+
+
+class Tests(saliweb.test.TestCase):
+
+    def test_check_structure(self):
+        """Test check_structure()"""
+        with saliweb.test.temporary_working_directory():
+            with open('ok.pdb', 'w') as fh:
+                fh.write("REMARK\nHETATM\n")
+            with open('bad.pdb', 'w') as fh:
+                fh.write("REMARK\n")
+            with open('ok.cif', 'w') as fh:
+                fh.write("loop_\n_atom_site.Cartn_x\n1.0\n")
+            with open('bad.cif', 'w') as fh:
+                fh.write("data_test\n")
+            input_check.check_structure('ok.pdb')
+            input_check.check_structure('ok.cif')
+            self.assertRaisesRegex(
+                input_check.InputError,
+                'PDB file shown.pdb contains no ATOM or HETATM',
+                input_check.check_structure, 'bad.pdb',
+                show_filename='shown.pdb')
+            self.assertRaisesRegex(
+                input_check.InputError, 'mmCIF file bad.cif contains no',
+                input_check.check_structure, 'bad.cif')
+
+    def test_check_profile(self):
+        """Test check_profile()"""
+        with saliweb.test.temporary_working_directory():
+            with open('ok.profile', 'w', newline='') as fh:
+                fh.write("# comment\r0.1 -0.5\r0.2 0.5\r")
+            with open('bad.profile', 'w') as fh:
+                fh.write("1 2 3 4 5 6\n")
+            input_check.check_profile('ok.profile')
+            with open('ok.profile', newline='') as fh:
+                self.assertEqual(fh.read(), "# comment\n0.1 -0.5\n0.2 0.5\n")
+            self.assertTrue(os.path.exists('ok.profile.npy'))
+            self.assertRaisesRegex(
+                input_check.InputError, 'Invalid profile uploaded',
+                input_check.check_profile, 'bad.profile')
+            self.assertRaisesRegex(
+                input_check.InputError, 'PDB or mmCIF file uploaded',
+                input_check.check_profile, 'test.pdb')
+
+    def test_handle_zipfile(self):
+        """Test handle_zipfile()"""
+        with saliweb.test.temporary_working_directory():
+            with zipfile.ZipFile('input.zip', 'w') as z:
+                z.writestr("inputFiles.txt", "foo")  # should be ignored
+                z.writestr("in/subdir/.hidden.pdb", "bar")  # ignored
+                z.writestr("in/subdir/1abc.pdb", "ATOM  bar")
+                z.writestr("2xyz.pdb", "ATOM  baz")
+            pdbs = input_check.handle_structures('input.zip', 'input.zip',
+                                                 '.', local=False)
+            self.assertEqual(pdbs, ['in_subdir/1abc.pdb', '2xyz.pdb'])
+
+            with zipfile.ZipFile('bad.zip', 'w') as z:
+                z.writestr("test.notapdb", "ATOM  \n")
+            self.assertRaisesRegex(
+                input_check.InputError, 'ONLY files with the .pdb',
+                input_check.handle_zipfile, 'bad.zip', '.', local=False)
+
+            with zipfile.ZipFile('empty.zip', 'w') as z:
+                pass
+            self.assertRaisesRegex(
+                input_check.InputError, 'contains no PDB/mmCIFs',
+                input_check.handle_zipfile, 'empty.zip', '.', local=False)
+
+            with zipfile.ZipFile('big.zip', 'w') as z:
+                for i in range(101):
+                    z.writestr("%d.pdb" % i, "ATOM  \n")
+            self.assertRaisesRegex(
+                input_check.InputError, 'Only 100 PDB/mmCIF files',
+                input_check.handle_zipfile, 'big.zip', '.', local=False)
+            self.assertEqual(
+                len(input_check.handle_zipfile('big.zip', '.', local=True)),
+                101)
+
+            # The first error (in zip order) is reported, even if a later
+            # file is also invalid
+            with zipfile.ZipFile('invalid.zip', 'w') as z:
+                for i in range(20):
+                    z.writestr("%d.pdb" % i,
+                               "REMARK\n" if i in (5, 12) else "ATOM  \n")
+                z.writestr("test.notapdb", "ATOM  \n")
+            self.assertRaisesRegex(
+                input_check.InputError, 'PDB file 5.pdb contains no ATOM',
+                input_check.handle_zipfile, 'invalid.zip', '.', local=False)
+
+            # Files can be in another directory
+            os.mkdir('job')
+            os.rename('input.zip', os.path.join('job', 'input.zip'))
+            pdbs = input_check.handle_structures('input.zip', 'input.zip',
+                                                 'job', local=False)
+            self.assertEqual(pdbs, ['in_subdir/1abc.pdb', '2xyz.pdb'])
+            self.assertTrue(os.path.exists(os.path.join('job', '2xyz.pdb')))
+
+            # Structures can be checked with another function
+            checked = []
+            pdbs = input_check.handle_structures(
+                'input.zip', 'input.zip', 'job', local=False,
+                check=lambda fname, show_filename: checked.append(
+                    show_filename))
+            self.assertEqual(checked, ['in/subdir/1abc.pdb', '2xyz.pdb'])
+            with open('bad.pdb', 'w') as fh:
+                fh.write("REMARK\n")
+            pdbs = input_check.handle_structures(
+                'bad.pdb', 'upload.pdb', '.', local=False,
+                check=lambda fname, show_filename: checked.append(
+                    show_filename))
+            self.assertEqual(pdbs, ['bad.pdb'])
+            self.assertEqual(checked[-1], 'upload.pdb')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+from foxs import jmoltable
+import saliweb.test
+import os
+
+
+class Tests(saliweb.test.TestCase):
+
+    def test_make_template_contents(self):
+        """Test make_template_contents()"""
+        t = jmoltable.make_template_contents(
+            'load jmoltable.pdb\n'
+            '<script src="/foxs/jsmol/JSmol.min.js"></script>\n'
+            'jmolSetCheckboxGroup(0,1,2)\n'
+            '<table border=1>\n'
+            '<a href="https://modbase.compbio.ucsf.edu/foxs/help.html#c1c2">'
+            '\n<a href="dirname/1abc_test.dat">fit</a>\n')
+        self.assertEqual(
+            t, 'load "{{file:jmoltable.pdb}}"\n'
+               '<script src="/jsmol/JSmol.min.js"></script>\n'
+               'Jmol.setCheckboxGroup(0,[1,2])\n'
+               '<table id="plotcontrol" border=1>\n'
+               '<a href="{{help:c1c2}}">\n'
+               '<a href="{{file:1abc_test.dat}}">fit</a>\n')
+
+    def test_write_template(self):
+        """Test write_template()"""
+        with saliweb.test.temporary_working_directory():
+            # No table, so no template
+            jmoltable.write_template()
+            self.assertFalse(os.path.exists(jmoltable.TEMPLATE_FILE))
+            with open('jmoltable.html', 'w') as fh:
+                fh.write('load jmoltable.cif\n')
+            jmoltable.write_template()
+            with open(jmoltable.TEMPLATE_FILE) as fh:
+                self.assertEqual(fh.read(), 'load "{{file:jmoltable.cif}}"\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
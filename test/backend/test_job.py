@@ -1,4 +1,6 @@
 import unittest
+import os
+import json
 import foxs
 import saliweb.test
 import saliweb.backend
@@ -17,6 +19,33 @@ class JobTests(saliweb.test.TestCase):
             cls = j.run()
             self.assertIsInstance(cls, saliweb.backend.LocalRunner)
 
+    def test_preprocess_validation(self):
+        """Test preprocess with deferred validation"""
+        j = self.make_test_job(foxs.Job, 'RUNNING')
+        with saliweb.test.working_directory(j.directory):
+            # No validation requested
+            j.preprocess()
+            with open('validate.json', 'w') as fh:
+                json.dump({'structures': 'test.pdb', 'profile': None}, fh)
+            with open('test.pdb', 'w') as fh:
+                fh.write("ATOM  \n")
+            j.preprocess()
+            with open('inputFiles.txt') as fh:
+                self.assertEqual(fh.read(), 'test.pdb')
+
+    def test_preprocess_validation_fail(self):
+        """Test preprocess with deferred validation of bad inputs"""
+        j = self.make_test_job(foxs.Job, 'RUNNING')
+        with saliweb.test.working_directory(j.directory):
+            with open('validate.json', 'w') as fh:
+                json.dump({'structures': 'test.pdb', 'profile': None}, fh)
+            with open('test.pdb', 'w') as fh:
+                fh.write("garbage\n")
+            j.preprocess()
+            self.assertTrue(os.path.exists('validation-error.txt'))
+            # postprocess should not look for foxs.log
+            j.postprocess()
+
     def test_postprocess_ok(self):
         """Test successful postprocess"""
         j = self.make_test_job(foxs.Job, 'RUNNING')
@@ -24,6 +53,7 @@ class JobTests(saliweb.test.TestCase):
             with open('foxs.log', 'w') as fh:
                 fh.write('no error\n')
             j.postprocess()
+            self.assertTrue(os.path.exists('summary.json'))
 
     def test_postprocess_fail(self):
         """Test postprocess with failed job"""
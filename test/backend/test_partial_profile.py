@@ -0,0 +1,260 @@
+import unittest
+import os
+from foxs import partial_profile
+import saliweb.test
+import numpy
+
+EXAMPLES = os.path.join(os.path.dirname(__file__), '..', '..', 'html',
+                        'examples')
+
+
+def make_partials(nq=50, hydration=True):
+    """Make some partial profiles with a plausible shape"""
+    q = numpy.linspace(0., 0.5, nq)
+    decay = numpy.exp(-q * q * 400.)
+    partials = [100. * decay + 1., 30. * decay + 0.1, 50. * decay + 0.2]
+    if hydration:
+        partials.extend([5. * decay, 10. * decay, 8. * decay])
+    return q, numpy.column_stack(partials)
+
+
+def write_partials(fname, q, partials):
+    with open(fname, 'w') as fh:
+        fh.write("# partial profiles\n")
+        for qval, row in zip(q, partials):
+            fh.write("%.6f " % qval + " ".join("%.8e" % x for x in row)
+                     + "\n")
+
+
+class Tests(saliweb.test.TestCase):
+
+    def test_read_partial_profile(self):
+        """Test read_partial_profile()"""
+        q, partials = make_partials(hydration=False)
+        with saliweb.test.temporary_working_directory():
+            write_partials('test.dat', q, partials)
+            rq, rp = partial_profile.read_partial_profile('test.dat')
+            self.assertEqual(rp.shape, (50, 3))
+            self.assertAlmostEqual(rq[-1], 0.5, delta=1e-6)
+            with open('bad.dat', 'w') as fh:
+                fh.write("0.1 1.0 0.1\n")
+            self.assertRaises(ValueError, partial_profile.read_partial_profile,
+                              'bad.dat')
+
+    def test_sum_partial_profiles(self):
+        """Test sum_partial_profiles()"""
+        q, partials = make_partials()
+        # With c1=1 and c2=0, the profile is simply P0 + P1 - 2 P2
+        i = partial_profile.sum_partial_profiles(q, partials, 1.0, 0.0)
+        numpy.testing.assert_allclose(
+            i, partials[:, 0] + partials[:, 1] - 2. * partials[:, 2])
+        # Many profiles can be computed at once
+        i = partial_profile.sum_partial_profiles(
+            q, partials, [[1.0, 1.02]], [[0.0, 1.0]])
+        self.assertEqual(i.shape, (1, 2, 50))
+        # Profiles of several structures, given the excluded volume factor
+        g = partial_profile.excluded_volume_factor(q, [1.0, 1.02])
+        i = partial_profile.combine_partial_profiles(
+            numpy.array([partials, 2. * partials])[:, numpy.newaxis],
+            g, 1.0)
+        self.assertEqual(i.shape, (2, 2, 50))
+        numpy.testing.assert_allclose(
+            i[1, 1], 2. * partial_profile.sum_partial_profiles(
+                q, partials, 1.02, 1.0))
+
+    def test_fit_profile(self):
+        """Test fit_profile()"""
+        q, partials = make_partials()
+        exp_q = numpy.linspace(0.01, 0.49, 30)
+        model = partial_profile.sum_partial_profiles(
+            exp_q, numpy.column_stack(
+                [numpy.interp(exp_q, q, partials[:, i]) for i in range(6)]),
+            1.02, 1.5)
+        exp = (exp_q, 3.0 * model, 0.01 * model)
+        fit = partial_profile.fit_profile(exp, q, partials)
+        self.assertAlmostEqual(fit.c1, 1.02, delta=0.02)
+        self.assertAlmostEqual(fit.c2, 1.5, delta=0.2)
+        self.assertLess(fit.chi2, 0.2)
+        self.assertGreater(fit.default_chi2, 1000. * fit.chi2)
+        # Fixed c1
+        fit = partial_profile.fit_profile(exp, q, partials,
+                                          c1_range=(1.02, 1.02))
+        self.assertAlmostEqual(fit.c1, 1.02, delta=1e-6)
+        self.assertAlmostEqual(fit.c2, 1.5, delta=0.01)
+        self.assertAlmostEqual(fit.scale, 3.0, delta=1e-2)
+        self.assertLess(fit.chi2, 0.01)
+        # Fixed c1 and c2
+        fit = partial_profile.fit_profile(exp, q, partials,
+                                          c1_range=(1.0, 1.0),
+                                          c2_range=(0.5, 0.5))
+        self.assertAlmostEqual(fit.c1, 1.0, delta=1e-6)
+        self.assertAlmostEqual(fit.c2, 0.5, delta=1e-6)
+        self.assertGreater(fit.chi2, 1e-3)
+        # Fit with offset
+        exp = (exp_q, 3.0 * model + 2.0, 0.01 * model)
+        fit = partial_profile.fit_profile(exp, q, partials,
+                                          c1_range=(1.02, 1.02), offset=True)
+        self.assertAlmostEqual(fit.offset, 2.0, delta=0.05)
+        # No points in range
+        self.assertRaises(ValueError, partial_profile.fit_profile,
+                          (exp_q[:0], model[:0], model[:0]), q, partials)
+
+    def test_scan_profile(self):
+        """Test scan_profile()"""
+        q, partials = make_partials()
+        exp_q = numpy.linspace(0.01, 0.49, 30)
+        model = partial_profile.sum_partial_profiles(
+            exp_q, numpy.column_stack(
+                [numpy.interp(exp_q, q, partials[:, i]) for i in range(6)]),
+            1.02, 1.5)
+        exp = (exp_q, 3.0 * model, 0.01 * model)
+        c1s, c2s, chi2 = partial_profile.scan_profile(exp, q, partials)
+        self.assertEqual(chi2.shape, (len(c1s), len(c2s)))
+        self.assertEqual(chi2.shape, (21, 61))
+        i, j = numpy.unravel_index(numpy.argmin(chi2), chi2.shape)
+        self.assertAlmostEqual(c1s[i], 1.02, delta=1e-6)
+        self.assertAlmostEqual(c2s[j], 1.5, delta=1e-6)
+        # Without hydration layer partials, c2 is always zero
+        q, partials = make_partials(hydration=False)
+        c1s, c2s, chi2 = partial_profile.scan_profile(exp, q, partials)
+        self.assertEqual(chi2.shape, (21, 1))
+        numpy.testing.assert_allclose(c2s, [0.])
+
+    def test_prepare_exp_profile(self):
+        """Test prepare_exp_profile()"""
+        profile = numpy.array([[0.1, 10., numpy.nan], [0.2, 5., 0.5],
+                               [0.9, 1., 0.1]])
+        q, i, err = partial_profile.prepare_exp_profile(profile, 0.5)
+        numpy.testing.assert_allclose(q, [0.1, 0.2])
+        numpy.testing.assert_allclose(err, [0.5, 0.5])
+        # Profile in 1/nm
+        q, i, err = partial_profile.prepare_exp_profile(profile, 0.5,
+                                                        units=3)
+        numpy.testing.assert_allclose(q, [0.01, 0.02, 0.09])
+
+    def test_fit_files(self):
+        """Test fit_files() and write_fit_file()"""
+        q, partials = make_partials(hydration=False)
+        with saliweb.test.temporary_working_directory():
+            write_partials('test.pdb.dat', q, partials)
+            model = partial_profile.sum_partial_profiles(q, partials,
+                                                         1.03, 0.)
+            with open('exp.dat', 'w') as fh:
+                for row in zip(q[1:], model[1:], model[1:] * 0.05):
+                    fh.write("%f %f %f\n" % row)
+            fit = partial_profile.fit_files('exp.dat', 'test.pdb.dat',
+                                            units=2)
+            self.assertAlmostEqual(fit.c1, 1.03, delta=1e-3)
+            self.assertEqual(fit.c2, 0.)
+            partial_profile.write_fit_file('test_exp.dat', fit)
+            data = numpy.loadtxt('test_exp.dat')
+            self.assertEqual(data.shape, (49, 4))
+
+    def test_fit_radius(self):
+        """Test fit_profile() with a structure's average radius"""
+        q, partials = make_partials()
+        exp_q = numpy.linspace(0.01, 0.49, 30)
+        model = partial_profile.sum_partial_profiles(
+            exp_q, numpy.column_stack(
+                [numpy.interp(exp_q, q, partials[:, i]) for i in range(6)]),
+            1.02, 1.5, radius=2.0)
+        exp = (exp_q, 3.0 * model, 0.01 * model)
+        fit = partial_profile.fit_profile(exp, q, partials, radius=2.0,
+                                          c1_range=(1.02, 1.02))
+        self.assertLess(fit.chi2, 0.01)
+        fit = partial_profile.fit_profile(exp, q, partials,
+                                          c1_range=(1.02, 1.02))
+        self.assertGreater(fit.chi2, 1.)
+
+    def test_average_radius(self):
+        """Test average_radius()"""
+        pdb = os.path.join(EXAMPLES, '3KFOfill.B99990003.pdb')
+        cif = os.path.join(EXAMPLES, '3KFOfill.B99990003.cif')
+        # For a typical protein, close to FoXS's default
+        r = partial_profile.average_radius(pdb)
+        self.assertAlmostEqual(r, 1.58, delta=0.01)
+        self.assertAlmostEqual(partial_profile.average_radius(cif), r,
+                               delta=1e-6)
+        # With explicit hydrogens (none in this file), heavy atoms only
+        self.assertLess(
+            partial_profile.average_radius(pdb, explicit_hydrogens=True), r)
+        # Residue-level profiles use residue volumes
+        self.assertGreater(partial_profile.average_radius(pdb, residue=True),
+                           3.0)
+        with saliweb.test.temporary_working_directory():
+            with open('test.pdb', 'w') as fh:
+                fh.write("MODEL        1\n"
+                         "ATOM      1  CB  ALA A   1       0.000   0.000"
+                         "   0.000  1.00  0.00           C\n"
+                         "ATOM      2  H   ALA A   1       0.000   0.000"
+                         "   0.000  1.00  0.00           H\n"
+                         "ENDMDL\nMODEL        2\n"
+                         "ATOM      1  N   ALA A   1       0.000   0.000"
+                         "   0.000  1.00  0.00           N\n"
+                         "ENDMDL\n")
+            # CH3 group
+            self.assertAlmostEqual(
+                partial_profile.average_radius('test.pdb',
+                                               first_model_only=True),
+                1.96, delta=0.01)
+            r = partial_profile.average_radius('test.pdb',
+                                               explicit_hydrogens=True)
+            self.assertAlmostEqual(r, (1.58 + 1.07 + 0.84) / 3., delta=0.01)
+            # No atoms
+            with open('empty.pdb', 'w') as fh:
+                fh.write("REMARK\n")
+            self.assertAlmostEqual(partial_profile.average_radius('empty.pdb'),
+                                   partial_profile.AVERAGE_RADIUS,
+                                   delta=1e-6)
+
+    def test_foxs_fit(self):
+        """Test fit chi^2 and scale against a fit made by FoXS"""
+        fit_file = os.path.join(EXAMPLES, '3KFOfill.B99990003_saxs.fit')
+        with open(fit_file) as fh:
+            header = [line for line in fh if line.startswith('#')]
+        self.assertIn('Chi^2 = 1.18697971357778', header[1])
+        q, exp_i, exp_err, model = numpy.loadtxt(fit_file, unpack=True)
+        # Partial profiles that give FoXS's fitted profile at any c1
+        partials = numpy.column_stack((model, numpy.zeros_like(model),
+                                       numpy.zeros_like(model)))
+        fit = partial_profile.fit_profile((q, exp_i, exp_err), q, partials)
+        self.assertAlmostEqual(fit.chi2, 1.18697971357778, delta=1e-5)
+        self.assertAlmostEqual(fit.scale, 1.0, delta=1e-5)
+        numpy.testing.assert_allclose(fit.fit, model, rtol=1e-5)
+
+    def test_foxs_fit_search(self):
+        """Test that fit_profile searches c1 and c2 as FoXS does"""
+        fit_file = os.path.join(EXAMPLES, '3KFOfill.B99990003_saxs.fit')
+        q, exp_i, exp_err, model = numpy.loadtxt(fit_file, unpack=True)
+        # 7-column partial profiles (atomic, excluded volume and hydration
+        # layer amplitudes a, e and h) built from FoXS's fitted profile,
+        # so that the profile is (a - g*e + c2*h)^2
+        a = numpy.sqrt(model) * 1.5
+        e = a * 0.6 * numpy.exp(-30. * q * q)
+        h = a * 0.05 * (1. + 10. * q)
+        partials = numpy.column_stack((a * a, e * e, a * e, h * h, a * h,
+                                       e * h))
+        exp = (q, 2.5 * partial_profile.sum_partial_profiles(
+            q, partials, 1.027, 1.73), exp_err)
+        fit = partial_profile.fit_profile(exp, q, partials)
+        self.assertAlmostEqual(fit.c1, 1.027, delta=5e-4)
+        self.assertAlmostEqual(fit.c2, 1.73, delta=0.05)
+        self.assertLess(fit.chi2, 0.01)
+        self.assertAlmostEqual(fit.scale, 2.5, delta=0.05)
+        # Both c1 and c2 affect the fit
+        self.assertGreater(fit.default_chi2, 100.)
+        for c1_range, c2_range in (((1.0, 1.0), partial_profile.C2_RANGE),
+                                   (partial_profile.C1_RANGE, (0., 0.))):
+            f = partial_profile.fit_profile(exp, q, partials,
+                                            c1_range=c1_range,
+                                            c2_range=c2_range)
+            self.assertGreater(f.chi2, 1.)
+        # The search finds a better fit than the best point on the grid
+        c1s, c2s, chi2 = partial_profile.scan_profile(
+            exp, q, partials, c1_range=partial_profile.C1_RANGE,
+            c2_range=partial_profile.C2_RANGE)
+        self.assertGreater(numpy.min(chi2), 10. * fit.chi2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import unittest
+from foxs import profile_clusters
+import saliweb.test
+import numpy
+
+
+def write_profile(fname, q, intensity, hlayer=True):
+    """Write a partial profile as written by FoXS -p, whose profile with
+       the default c1 and c2 is `intensity`"""
+    with open(fname, 'w') as fh:
+        fh.write("# partial profile\n")
+        for qi, ii in zip(q, intensity):
+            # Vacuum, excluded volume and cross terms; with c1=1, c2=0 the
+            # profile is p0 + p1 - 2 * p2
+            fh.write("%f %g %g %g" % (qi, 1.2 * ii, 0.4 * ii, 0.3 * ii))
+            if hlayer:
+                fh.write(" %g %g %g" % (0.05 * ii, 0.02 * ii, 0.01 * ii))
+            fh.write("\n")
+
+
+class Tests(saliweb.test.TestCase):
+
+    def test_load_profiles(self):
+        """Test load_profiles()"""
+        q = numpy.linspace(0., 0.5, 11)
+        with saliweb.test.temporary_working_directory():
+            write_profile('1.dat', q, numpy.exp(-q))
+            # Differs only by scale
+            write_profile('2.dat', q, 5. * numpy.exp(-q))
+            # Different q values, so interpolated
+            write_profile('3.dat', q[::2], numpy.exp(-q[::2]))
+            # No hydration layer partials
+            write_profile('4.dat', q, 2. * numpy.exp(-q), hlayer=False)
+            with open('empty.dat', 'w') as fh:
+                fh.write("# no intensities\n")
+            # A profile, not a partial profile
+            with open('profile.dat', 'w') as fh:
+                for qi in q:
+                    fh.write("%f %g\n" % (qi, numpy.exp(-qi)))
+            m = profile_clusters.load_profiles(['1.dat', '2.dat', '3.dat',
+                                                '4.dat'])
+            self.assertEqual(m.shape, (4, 11))
+            self.assertAlmostEqual(m[0].mean(), 0., delta=1e-6)
+            numpy.testing.assert_allclose(m[0], -q + q.mean(), atol=1e-4)
+            numpy.testing.assert_allclose(m[1], m[0], atol=1e-4)
+            numpy.testing.assert_allclose(m[2], m[0], atol=1e-2)
+            numpy.testing.assert_allclose(m[3], m[0], atol=1e-4)
+            for bad in ('empty.dat', 'profile.dat'):
+                self.assertRaises(ValueError, profile_clusters.load_profiles,
+                                  ['1.dat', bad])
+
+    def test_kmedoids(self):
+        """Test kmedoids()"""
+        rng = numpy.random.default_rng(0)
+        centers = numpy.array([[0., 0.], [10., 0.], [0., 10.]])
+        x = numpy.vstack([c + rng.normal(size=(20, 2)) for c in centers])
+        medoids, labels = profile_clusters.kmedoids(x, 3)
+        self.assertEqual(len(medoids), 3)
+        # Each cluster should contain exactly one of the original groups
+        self.assertEqual(sorted(labels[medoids]), [0, 1, 2])
+        for group in range(3):
+            self.assertEqual(len(set(labels[group * 20:(group + 1) * 20])),
+                             1)
+        self.assertEqual(len(set(labels)), 3)
+        # Medoids are members of the data
+        for c, medoid in enumerate(medoids):
+            self.assertEqual(labels[medoid], c)
+
+    def test_kmedoids_duplicates(self):
+        """Test kmedoids() with fewer distinct rows than clusters"""
+        x = numpy.array([[0., 0.], [0., 0.], [1., 1.], [1., 1.]])
+        medoids, labels = profile_clusters.kmedoids(x, 3)
+        self.assertEqual(len(medoids), 2)
+        self.assertEqual(labels[0], labels[1])
+        self.assertEqual(labels[2], labels[3])
+        self.assertNotEqual(labels[0], labels[2])
+
+    def test_cluster_profiles(self):
+        """Test cluster_profiles() and write_clusters()"""
+        q = numpy.linspace(0.01, 0.5, 20)
+        with saliweb.test.temporary_working_directory():
+            dat_files = []
+            for i, rg in enumerate((20., 10., 20.5, 10.5, 9.5, 19.5)):
+                dat_files.append('%d.dat' % i)
+                write_profile(dat_files[-1], q, numpy.exp(-(q * rg) ** 2 / 3.))
+            clusters = profile_clusters.cluster_profiles(dat_files, 2)
+            self.assertEqual(clusters, [('0.dat', ['0.dat', '2.dat', '5.dat']),
+                                        ('1.dat', ['1.dat', '3.dat',
+                                                   '4.dat'])])
+            profile_clusters.write_clusters('clusters.txt', clusters, True)
+            with open('clusters.txt') as fh:
+                self.assertEqual(fh.read(),
+                                 "# k-medoids clusters 2 refine 1\n"
+                                 "0.dat 2.dat 5.dat\n1.dat 3.dat 4.dat\n")
+
+
+if __name__ == '__main__':
+    unittest.main()
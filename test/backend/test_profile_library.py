@@ -0,0 +1,107 @@
+import unittest
+from foxs import profile_library
+import saliweb.test
+import os
+
+
+PRESETS = """[default]
+
+[residue]
+q: 0.3
+psize: 200
+ihydrogens: on
+residue: on
+model_option: 1
+"""
+
+
+class MockComputeProfiles(object):
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, structures, options, cwd):
+        self.calls.append((structures, options))
+        for s in structures:
+            with open(os.path.join(cwd, s + '.dat'), 'w') as fh:
+                fh.write("profile of %s %s\n" % (s, " ".join(options)))
+
+
+class Tests(saliweb.test.TestCase):
+
+    def test_read_presets(self):
+        """Test read_presets()"""
+        with saliweb.test.temporary_working_directory():
+            with open('presets.conf', 'w') as fh:
+                fh.write(PRESETS)
+            self.assertEqual(
+                profile_library.read_presets('presets.conf'),
+                [('default', ['-m', '3', '-q', '0.5', '-s', '500']),
+                 ('residue', ['-m', '1', '-q', '0.3', '-s', '200', '-r'])])
+            # Implicit hydrogens are the default, as in the web interface
+            with open('presets.conf', 'w') as fh:
+                fh.write("[explicit]\nihydrogens: off\n")
+            self.assertEqual(
+                profile_library.read_presets('presets.conf'),
+                [('explicit', ['-m', '3', '-q', '0.5', '-s', '500', '-h'])])
+            with open('presets.conf', 'w') as fh:
+                fh.write("[multi]\nmodel_option: 2\n")
+            self.assertRaises(ValueError, profile_library.read_presets,
+                              'presets.conf')
+
+    def test_build_fetch(self):
+        """Test building a library and fetching profiles from it"""
+        with saliweb.test.temporary_working_directory():
+            os.mkdir('a')
+            os.mkdir('b')
+            # Same file name, different contents
+            for fname in ('a/1abc.pdb', 'b/1abc.pdb', 'b/2xyz.pdb'):
+                with open(fname, 'w') as fh:
+                    fh.write("ATOM %s\n" % fname)
+            with open('presets.conf', 'w') as fh:
+                fh.write(PRESETS)
+            with open('entries.txt', 'w') as fh:
+                fh.write("a/1abc.pdb\nb/1abc.pdb\n")
+            old_compute = profile_library.compute_profiles
+            profile_library.compute_profiles = mock = MockComputeProfiles()
+            try:
+                profile_library.main(['--presets', 'presets.conf', 'lib',
+                                      '@entries.txt'])
+                self.assertEqual(len(mock.calls), 2)
+                self.assertEqual(sorted(mock.calls[0][0]),
+                                 ['0/1abc.pdb', '1/1abc.pdb'])
+                # Existing profiles are not computed again
+                self.assertEqual(profile_library.build(
+                    'lib', profile_library.read_presets('presets.conf'),
+                    ['a/1abc.pdb', 'b/2xyz.pdb']), 2)
+                self.assertEqual(len(mock.calls), 4)
+                self.assertEqual(mock.calls[2][0], ['0/2xyz.pdb'])
+            finally:
+                profile_library.compute_profiles = old_compute
+            index = profile_library.read_index('lib')
+            self.assertEqual(len(index), 6)
+            self.assertEqual(sorted(set(index.values())),
+                             [('default', '1abc.pdb'),
+                              ('default', '2xyz.pdb'),
+                              ('residue', '1abc.pdb'),
+                              ('residue', '2xyz.pdb')])
+            # Temporary directories should be cleaned up
+            self.assertEqual(
+                [f for f in os.listdir('lib') if len(f) != 2],
+                ['index.txt'])
+
+            lib = profile_library.ProfileLibrary('lib')
+            opts = ['-m', '1', '-q', '0.3', '-s', '200', '-r']
+            self.assertTrue(lib.fetch('b/1abc.pdb', opts, 'out.dat'))
+            with open('out.dat') as fh:
+                self.assertEqual(fh.read(), "profile of 1/1abc.pdb %s\n"
+                                 % " ".join(opts))
+            self.assertFalse(lib.fetch('b/1abc.pdb', ['-q', '0.1'],
+                                       'out2.dat'))
+            self.assertFalse(os.path.exists('out2.dat'))
+            # Empty library
+            lib = profile_library.ProfileLibrary('nolib')
+            self.assertFalse(lib.fetch('b/1abc.pdb', opts, 'out2.dat'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+from foxs import profile_store
+import saliweb.test
+import os
+import time
+
+
+class Tests(saliweb.test.TestCase):
+
+    def test_get_key(self):
+        """Test ProfileStore.get_key()"""
+        with saliweb.test.temporary_working_directory():
+            s = profile_store.ProfileStore('store')
+            for fname, contents in (('a.pdb', 'ATOM 1\n'),
+                                    ('b.pdb', 'ATOM 1\n'),
+                                    ('c.pdb', 'ATOM 2\n')):
+                with open(fname, 'w') as fh:
+                    fh.write(contents)
+            # Key depends only on the file contents and options
+            self.assertEqual(s.get_key('a.pdb', ['-q', '0.5']),
+                             s.get_key('b.pdb', ['-q', '0.5']))
+            self.assertNotEqual(s.get_key('a.pdb', ['-q', '0.5']),
+                                s.get_key('c.pdb', ['-q', '0.5']))
+            self.assertNotEqual(s.get_key('a.pdb', ['-q', '0.5']),
+                                s.get_key('a.pdb', ['-q', '0.4']))
+
+    def test_claim_put_fetch(self):
+        """Test claiming, adding and fetching profiles"""
+        with saliweb.test.temporary_working_directory():
+            s = profile_store.ProfileStore('store', poll_interval=0)
+            key = 'abcdef'
+            self.assertFalse(s.fetch(key, 'out.dat'))
+            self.assertTrue(s.claim(key))
+            # Another job cannot claim the same profile
+            self.assertFalse(s.claim(key))
+            with open('in.dat', 'w') as fh:
+                fh.write('profile\n')
+            s.put(key, 'in.dat')
+            self.assertTrue(s.fetch(key, 'out.dat'))
+            with open('out.dat') as fh:
+                self.assertEqual(fh.read(), 'profile\n')
+            self.assertEqual(sorted(os.listdir('store/ab')), ['abcdef.dat'])
+            self.assertTrue(s.wait_fetch(key, 'out2.dat'))
+
+    def test_stale_claim(self):
+        """Test handling of claims by failed jobs"""
+        with saliweb.test.temporary_working_directory():
+            s = profile_store.ProfileStore('store', wait_time=60,
+                                           poll_interval=0)
+            key = 'abcdef'
+            self.assertTrue(s.claim(key))
+            # Claim released without adding the profile
+            s.release(key)
+            self.assertFalse(s.wait_fetch(key, 'out.dat'))
+            # Old claims are ignored
+            self.assertTrue(s.claim(key))
+            old = time.time() - 120
+            os.utime('store/ab/abcdef.lock', (old, old))
+            self.assertTrue(s.claim(key))
+            # Give up waiting eventually
+            s.wait_time = 0
+            self.assertFalse(s.wait_fetch(key, 'out.dat'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,16 @@
 import unittest
 import foxs
-from foxs import run_foxs
+from foxs import run_foxs, profile_store, profile_library
 import saliweb.test
 import saliweb.backend
 import os
+import glob
 import tempfile
 import contextlib
+import json
+import sys
+from unittest import mock
+import numpy
 
 
 _ATOM_SITE = "loop_\n" + "\n".join("_atom_site.%s" % x for x in [
@@ -16,13 +21,55 @@ _ATOM_SITE = "loop_\n" + "\n".join("_atom_site.%s" % x for x in [
     'pdbx_PDB_model_num'])
 
 
+ATOM_LINE = ("ATOM      1  CA  ALA A   1       0.000   0.000   0.000"
+             "  1.00  0.00           C\n")
+
+
+def make_multimodel_pdb(fname, nmodels=2):
+    """Make a multi-model PDB file, plus the index of its submodels that
+       setup_multimodel would write (without writing the submodels)"""
+    stem = os.path.splitext(fname)[0]
+    with open(fname, 'w') as fh:
+        for i in range(nmodels):
+            fh.write("MODEL %8d\n" % (i + 1))
+            # Alternate carbon and nitrogen, to give different radii
+            fh.write(ATOM_LINE if i % 2 == 0
+                     else ATOM_LINE.replace(' CA ', ' N  ')[:-2] + 'N\n')
+            fh.write("ENDMDL\n")
+    submodels = run_foxs.find_pdb_submodels(fname)
+    with open(run_foxs.SUBMODEL_INDEX_FILE, 'w') as fh:
+        for submodel in submodels:
+            fh.write("%s %s %d %d\n" % submodel)
+    return ["%s_m%d.pdb" % (stem, i + 1) for i in range(nmodels)]
+
+
+def write_partial_profile(fname):
+    with open(fname, 'w') as fh:
+        for i in range(20):
+            fh.write("%f 10.0 2.0 3.0 1.0 1.0 0.5\n" % (i * 0.02))
+
+
 class MockParameters(object):
     model_option = 3
+    batch = False
+    batch_shard_size = 100
+    batch_pool_size = 100
+    multifoxs_shard_size = 0
+    share = False
+    refit = False
+    continue_size = None
+    dedup_rmsd = 0.
+    profile_clusters = 0
+    cluster_refine = False
+    scan = False
+    profile_store = None
+    profile_library = None
     unit_option = 1
     q = 1.0
     psize = 10
     pdb_file_names = ['1.pdb', '2.pdb']
     profile_file_name = None
+    profile_file_names = []
     hlayer = True
     exvolume = True
     ihydrogens = True
@@ -32,22 +79,31 @@ class MockParameters(object):
 
 
 class MockRunSubprocess(object):
-    def __init__(self, make_files):
+    def __init__(self, make_files, output):
         self.cmds = []
+        self.cwds = []
         self.make_files = make_files
+        self.output = output
 
-    def __call__(self, cmd):
+    def __call__(self, cmd, stdout=None, cwd=None):
         self.cmds.append(cmd)
+        self.cwds.append(cwd)
         for fname, contents in self.make_files.items():
             with open(fname, 'w') as fh:
                 fh.write(contents)
+        if self.output:
+            output = self.output(cmd)
+            if stdout is not None:
+                stdout.write(output)
 
 
 @contextlib.contextmanager
-def mocked_run_subprocess(make_files=None):
-    """Temporarily replace run_foxs.run_subprocess with a mock"""
+def mocked_run_subprocess(make_files=None, output=None):
+    """Temporarily replace run_foxs.run_subprocess with a mock.
+       If given, output(cmd) is called to get the subprocess's output."""
     old_rs = run_foxs.run_subprocess
-    run_foxs.run_subprocess = mock_rs = MockRunSubprocess(make_files or {})
+    run_foxs.run_subprocess = mock_rs = MockRunSubprocess(make_files or {},
+                                                          output)
     yield mock_rs
     run_foxs.run_subprocess = old_rs
 
@@ -79,6 +135,12 @@ class Tests(saliweb.test.TestCase):
                 fh.write("file1\nfile2\n")
             p = run_foxs.JobParameters()
             self.assertEqual(p.profile_file_name, 'PROF')
+            self.assertEqual(p.profile_file_names, ['PROF'])
+            with open('profiles.txt', 'w') as fh:
+                fh.write("PROF\nPROF2\n")
+            p = run_foxs.JobParameters()
+            self.assertEqual(p.profile_file_names, ['PROF', 'PROF2'])
+            self.assertFalse(p.refit)
 
     def test_get_command_options(self):
         """Test get_command_options()"""
@@ -157,19 +219,16 @@ class Tests(saliweb.test.TestCase):
                 contents = fh.read()
             self.assertEqual(contents, 'DONE\n')
 
-    def test_make_gnuplot_canvas_plot(self):
-        """Test make_gnuplot_canvas_plot()"""
+    def test_is_canvas_script(self):
+        """Test is_canvas_script()"""
         with saliweb.test.temporary_working_directory():
-            with mocked_run_subprocess() as mock:
-                run_foxs.make_gnuplot_canvas_plot(max_states=5, profile='PROF')
-                self.assertEqual(
-                    mock.cmds, [['gnuplot', 'canvas_ensemble.plt']])
-            with open('canvas_ensemble.plt') as fh:
-                contents = fh.read()
-            self.assertIn("set output 'jsoutput.3.js'", contents)
-            self.assertIn('multi_state_model_1_1_1.fit', contents)
-            self.assertIn('multi_state_model_5_1_1.fit', contents)
-            self.assertIn("plot 'PROF'", contents)
+            with open('canvas.plt', 'w') as fh:
+                fh.write("set terminal canvas solid butt size 400,350\n"
+                         "set output 'jsoutput.1.js'\n")
+            with open('png.plt', 'w') as fh:
+                fh.write("set terminal png enhanced\n")
+            self.assertTrue(run_foxs.is_canvas_script('canvas.plt'))
+            self.assertFalse(run_foxs.is_canvas_script('png.plt'))
 
     def test_get_min_max_score(self):
         """Test get_min_max_score()"""
@@ -219,6 +278,7 @@ garbage |  0.06 | x1 0.06 (1.03, 1.66)
                 contents = fh.read()
             self.assertIn('set output "chis.png"', contents)
             self.assertIn("plot 'chis' u 1:2:3", contents)
+            self.assertIn("set xrange [0.5:5.5]", contents)
 
     def test_plot_states_histogram_big_diff(self):
         """Test plot_states_histogram() with diff larger than score"""
@@ -246,10 +306,14 @@ garbage |  0.06 | x1 0.06 (1.03, 1.66)
         """Test run_job success with one PDB"""
         p = MockParameters()
         with saliweb.test.temporary_working_directory():
-            # Simulate production of plot png
+            # Simulate production of plot png and gnuplot scripts
             with mocked_run_subprocess(
-                    make_files={'pdb6lyt_lyzexp.png': '\n'}):
+                    make_files={'pdb6lyt_lyzexp.png': '\n',
+                                'pdb6lyt.plt': 'set terminal png\n',
+                                'canvas.plt': 'set terminal canvas\n'}) as m:
                 run_foxs.run_job(p)
+            # Canvas output is not needed
+            self.assertEqual(m.cmds[1], ['gnuplot', 'pdb6lyt.plt'])
 
     def test_run_job_ok_multimodel_pdb(self):
         """Test run_job success with multimodel PDB"""
@@ -276,15 +340,25 @@ garbage |  0.06 | x1 0.06 (1.03, 1.66)
             with mocked_run_subprocess(
                     make_files={'pdb6lyt_lyzexp.png': '\n'}):
                 run_foxs.run_job(p)
-            # Should have made multimodel list and files
-            os.unlink("1_m1.pdb")
-            os.unlink("1_m2.pdb")
-            os.unlink("4_m1.pdb")
-            os.unlink("4_m2.pdb")
-            self.assertFalse(os.path.exists("1_m3.pdb"))
-            self.assertFalse(os.path.exists("2_m1.pdb"))
-            self.assertFalse(os.path.exists("3_m1.pdb"))
-            os.unlink("multi-model-files.txt")
+            # Should have made multimodel list and index, but not files
+            with open("multi-model-files.txt") as fh:
+                self.assertEqual(fh.read(), "1_m1.pdb\n1_m2.pdb\n2.pdb\n"
+                                            "4_m1.pdb\n4_m2.pdb")
+            with open(run_foxs.SUBMODEL_INDEX_FILE) as fh:
+                self.assertEqual(fh.read(),
+                                 "1_m1.pdb 1.pdb 15 39\n"
+                                 "1_m2.pdb 1.pdb 62 86\n"
+                                 "4_m1.pdb 4.pdb 15 32\n"
+                                 "4_m2.pdb 4.pdb 40 63\n")
+            self.assertEqual(glob.glob("*_m*.pdb"), [])
+            # Submodels are only written when needed
+            run_foxs.write_submodels(['1_m2.pdb', '4_m2.pdb', '2.pdb'])
+            with open("1_m2.pdb") as fh:
+                self.assertEqual(fh.read(), "ATOM line3\nline4\n")
+            with open("4_m2.pdb") as fh:
+                self.assertEqual(fh.read(), "HETATM line3\nline4\nEND\n")
+            self.assertEqual(sorted(glob.glob("*_m*.pdb")),
+                             ['1_m2.pdb', '4_m2.pdb'])
 
     def test_run_job_ok_multimodel_cif(self):
         """Test run_job success with multimodel mmCIF"""
@@ -326,6 +400,858 @@ ATOM C CA . VAL A A 2 2 ? 2.396 13.826 7.425 1.000 9.160 1 1003 9
             self.assertFalse(os.path.exists("3_m3.cif"))
             os.unlink("multi-model-files.txt")
 
+    def test_job_parameters_batch(self):
+        """Test JobParameters class with batch mode"""
+        j = self.make_test_job(foxs.Job, 'RUNNING')
+        with saliweb.test.working_directory(j.directory):
+            with open('data.txt', 'w') as fh:
+                fh.write("PDB PROF EMAIL 0.50 500 1 1 1 0 0 0 0.00 1.00 3 1 "
+                         "1\n")
+            with open('inputFiles.txt', 'w') as fh:
+                fh.write("file1\nfile2\n")
+            p = run_foxs.JobParameters(batch_shard_size=10)
+            self.assertTrue(p.batch)
+            self.assertEqual(p.batch_shard_size, 10)
+            self.assertEqual(p.batch_pool_size, 100)
+            self.assertFalse(p.share)
+
+    def test_job_parameters_share(self):
+        """Test JobParameters class with profile sharing"""
+        j = self.make_test_job(foxs.Job, 'RUNNING')
+        with saliweb.test.working_directory(j.directory):
+            with open('data.txt', 'w') as fh:
+                fh.write("PDB PROF EMAIL 0.50 500 1 1 1 0 0 0 0.00 1.00 3 1 "
+                         "0 1\n")
+            with open('inputFiles.txt', 'w') as fh:
+                fh.write("file1\n")
+            p = run_foxs.JobParameters(profile_store='/store')
+            self.assertFalse(p.batch)
+            self.assertTrue(p.share)
+            self.assertFalse(p.scan)
+            self.assertEqual(p.profile_store, '/store')
+            with open('data.txt', 'w') as fh:
+                fh.write("PDB PROF EMAIL 0.50 500 1 1 1 0 0 0 0.00 1.00 3 1 "
+                         "0 0 1\n")
+            p = run_foxs.JobParameters()
+            self.assertFalse(p.share)
+            self.assertTrue(p.scan)
+            self.assertEqual(p.dedup_rmsd, 0.)
+            with open('data.txt', 'w') as fh:
+                fh.write("PDB PROF EMAIL 0.50 500 1 1 1 0 0 0 0.00 1.00 3 1 "
+                         "0 0 0 1.50\n")
+            p = run_foxs.JobParameters()
+            self.assertAlmostEqual(p.dedup_rmsd, 1.5, delta=1e-6)
+            self.assertEqual(p.profile_clusters, 0)
+            self.assertFalse(p.cluster_refine)
+            with open('data.txt', 'w') as fh:
+                fh.write("PDB PROF EMAIL 0.50 500 1 1 1 0 0 0 0.00 1.00 3 1 "
+                         "0 0 0 0.00 20 1\n")
+            p = run_foxs.JobParameters()
+            self.assertEqual(p.profile_clusters, 20)
+            self.assertTrue(p.cluster_refine)
+
+    def test_parse_args(self):
+        """Test parse_args()"""
+        args = run_foxs.parse_args(['--batch-shard-size', '42'])
+        self.assertEqual(args.batch_shard_size, 42)
+        self.assertEqual(args.batch_pool_size, 100)
+        self.assertIsNone(args.profile_store)
+        self.assertEqual(args.multifoxs_shard_size, 0)
+        args = run_foxs.parse_args(['--profile-store', '/store',
+                                    '--multifoxs-shard-size', '200'])
+        self.assertEqual(args.profile_store, '/store')
+        self.assertEqual(args.multifoxs_shard_size, 200)
+        self.assertIsNone(args.scratch)
+        args = run_foxs.parse_args(['--scratch', '/tmp'])
+        self.assertEqual(args.scratch, '/tmp')
+        self.assertIsNone(args.profile_library)
+        args = run_foxs.parse_args(['--profile-library', '/lib'])
+        self.assertEqual(args.profile_library, '/lib')
+
+    def test_run_logged_scratch(self):
+        """Test that run_logged writes foxs.log to the job directory"""
+        def run_job(params):
+            # The job runs in scratch, but logs to the job directory
+            self.assertTrue(os.getcwd().startswith(scratch))
+            print("progress")
+            sys.stdout.flush()
+            with open(os.path.join(jobdir, 'foxs.log')) as fh:
+                self.assertEqual(fh.read(), "progress\n")
+            with open('out.dat', 'w') as fh:
+                fh.write("output\n")
+
+        def run_logged(scratch):
+            with contextlib.ExitStack() as stack:
+                stack.enter_context(mock.patch('sys.stdout'))
+                stack.enter_context(mock.patch('sys.stderr'))
+                stack.enter_context(
+                    mock.patch.object(run_foxs, 'setup_environment'))
+                stack.enter_context(
+                    mock.patch.object(run_foxs, 'JobParameters'))
+                stack.enter_context(
+                    mock.patch.object(run_foxs, 'run_job', run_job))
+                run_foxs.run_logged(run_foxs.parse_args(
+                    ['--scratch', scratch]))
+                sys.stdout.close()  # the log file
+            with open('foxs.log') as fh:
+                return fh.read()
+
+        with tempfile.TemporaryDirectory() as scratch:
+            with saliweb.test.temporary_working_directory() as jobdir:
+                self.assertEqual(run_logged(scratch), "progress\n")
+                with open('out.dat') as fh:
+                    self.assertEqual(fh.read(), "output\n")
+                # Failure to make the scratch directory is logged
+                log = run_logged(os.path.join(scratch, 'missing'))
+                self.assertIn('FileNotFoundError', log)
+                self.assertNotIn('progress', log)
+                # Failure to stage out is logged, after the job's output
+                with mock.patch.object(run_foxs, 'stage_out',
+                                       side_effect=OSError('disk full')):
+                    log = run_logged(scratch)
+                self.assertTrue(log.startswith('progress\n'))
+                self.assertIn('OSError: disk full', log)
+
+    def test_scratch_directory(self):
+        """Test running a job in a scratch directory"""
+        with tempfile.TemporaryDirectory() as scratch:
+            with saliweb.test.temporary_working_directory() as jobdir:
+                # Input hard linked from another job
+                os.mkdir('otherjob')
+                with open('otherjob/linked.dat', 'w') as fh:
+                    fh.write("original\n")
+                os.mkdir('job')
+                os.link('otherjob/linked.dat', 'job/linked.dat')
+                for fname in ('inputFiles.txt', 'old.png'):
+                    with open(os.path.join('job', fname), 'w') as fh:
+                        fh.write("input\n")
+                os.chdir('job')
+
+                class TestError(Exception):
+                    pass
+
+                with self.assertRaises(TestError):
+                    with run_foxs.scratch_directory(scratch):
+                        self.assertNotEqual(os.getcwd(),
+                                            os.path.join(jobdir, 'job'))
+                        self.assertTrue(os.getcwd().startswith(scratch))
+                        with open('linked.dat', 'w') as fh:
+                            fh.write("changed\n")
+                        os.unlink('old.png')
+                        os.mkdir('sub')
+                        os.mkdir('multifoxs-shard0')
+                        for fname in ('new.png', 'sub/new.dat', 'plot.plt',
+                                      'multifoxs-shard0/x.txt', 'y.tmp'):
+                            with open(fname, 'w') as fh:
+                                fh.write("output\n")
+                        # Outputs are copied back even on error
+                        raise TestError()
+                self.assertEqual(os.getcwd(), os.path.join(jobdir, 'job'))
+                self.assertEqual(sorted(glob.glob('**', recursive=True)),
+                                 ['inputFiles.txt', 'linked.dat', 'new.png',
+                                  'sub', 'sub/new.dat'])
+                with open('linked.dat') as fh:
+                    self.assertEqual(fh.read(), "changed\n")
+                # The other job's file should not be changed
+                with open('../otherjob/linked.dat') as fh:
+                    self.assertEqual(fh.read(), "original\n")
+                # Scratch should be cleaned up
+                self.assertEqual(os.listdir(scratch), [])
+
+                # Without scratch, run in the job directory
+                with run_foxs.scratch_directory(None):
+                    self.assertEqual(os.getcwd(),
+                                     os.path.join(jobdir, 'job'))
+
+    def test_use_profile_store(self):
+        """Test use_profile_store()"""
+        p = MockParameters()
+        p.share = True
+        p.profile_store = '/store'
+        p.profile_file_name = 'PROF'
+        self.assertTrue(run_foxs.use_profile_store(p))
+        p.background = True
+        self.assertFalse(run_foxs.use_profile_store(p))
+        p.background = False
+        p.model_option = 2
+        self.assertFalse(run_foxs.use_profile_store(p))
+        p.model_option = 3
+        p.profile_store = None
+        self.assertFalse(run_foxs.use_profile_store(p))
+
+    def test_dat_files_for_pdb(self):
+        """Test dat_files_for_pdb()"""
+        with saliweb.test.temporary_working_directory():
+            for fname in ('single.pdb.dat', 'multi_m1.pdb.dat',
+                          'multi_m2.cif.dat', 'multi_m10.pdb.dat',
+                          'multi_m200.pdb.dat', 'multi_m3_PROF.dat',
+                          'multi_mx.pdb.dat'):
+                with open(fname, 'w') as fh:
+                    fh.write('\n')
+            self.assertEqual(list(run_foxs.dat_files_for_pdb('single.pdb')),
+                             ['single.pdb.dat'])
+            self.assertEqual(list(run_foxs.dat_files_for_pdb('multi.pdb')),
+                             ['multi_m1.pdb.dat', 'multi_m2.cif.dat',
+                              'multi_m10.pdb.dat', 'multi_m200.pdb.dat'])
+
+    def test_run_job_batch(self):
+        """Test run_job in batch mode"""
+        p = MockParameters()
+        p.batch = True
+        p.batch_shard_size = 2
+        p.batch_pool_size = 2
+        p.profile_file_name = 'PROF.dat'
+        p.pdb_file_names = ['%d.pdb' % i for i in range(5)]
+        chis = [4., 1., 5., 2., 3.]
+
+        def foxs_output(cmd):
+            if cmd[0] != 'foxs':
+                return ''
+            self.assertNotIn('-g', cmd)
+            out = []
+            for pdb in cmd[cmd.index('--') + 1:-1]:
+                stem = os.path.splitext(pdb)[0]
+                for fname in (pdb + '.dat', stem + '_PROF.dat'):
+                    with open(fname, 'w') as fh:
+                        fh.write('\n')
+                out.append("%s PROF.dat Chi^2 = %.1f c1 = 1.0 c2 = 0.5 "
+                           "default chi^2 = 9.0\n"
+                           % (pdb, chis[int(stem)]))
+            return "".join(out)
+        with saliweb.test.temporary_working_directory():
+            with mocked_run_subprocess(output=foxs_output) as mock:
+                # No MultiFoXS ensembles produced by the mock
+                self.assertRaises(RuntimeError, run_foxs.run_job, p)
+            foxs_cmds = [c for c in mock.cmds if c[0] == 'foxs']
+            self.assertEqual(len(foxs_cmds), 3)
+            with open('filenames2.txt') as fh:
+                self.assertEqual(fh.read(), '1.pdb.dat\n3.pdb.dat\n')
+            # Only files for the best-fitting structures should be kept
+            self.assertEqual(sorted(glob.glob('*.dat')),
+                             ['1.pdb.dat', '1_PROF.dat', '3.pdb.dat',
+                              '3_PROF.dat'])
+            with open('batch-summary.txt') as fh:
+                lines = fh.readlines()
+            self.assertEqual(len(lines), 5)
+            # Index should list structures in order of increasing chi
+            with open('batch-summary.idx') as fh:
+                offsets = [int(x) for x in fh]
+            with open('batch-summary.txt', 'rb') as fh:
+                names = []
+                for offset in offsets:
+                    fh.seek(offset)
+                    names.append(fh.readline().split()[0])
+            self.assertEqual(names, [b'1.pdb', b'3.pdb', b'4.pdb', b'0.pdb',
+                                     b'2.pdb'])
+
+    def test_run_job_shared(self):
+        """Test run_job sharing profiles between jobs"""
+        q = numpy.linspace(0., 0.5, 20)
+        decay = numpy.exp(-q * q * 400.)
+
+        def foxs_output(cmd):
+            if cmd[0] == 'foxs':
+                for pdb in cmd[cmd.index('--') + 1:]:
+                    with open(pdb + '.dat', 'w') as fh:
+                        for qval, d in zip(q, decay):
+                            fh.write("%f %f %f %f\n"
+                                     % (qval, 100. * d + 1., 30. * d,
+                                        50. * d))
+            return ''
+
+        def run_job(pdbs, profile):
+            p = MockParameters()
+            p.share = True
+            p.profile_store = store
+            p.profile_file_name = profile
+            p.pdb_file_names = pdbs
+            with open(profile, 'w') as fh:
+                for qval, d in zip(q[1:], decay[1:]):
+                    fh.write("%f %f\n" % (qval, 50. * d + 1.))
+            for pdb in pdbs:
+                with open(pdb, 'w') as fh:
+                    fh.write("ATOM %s\n" % pdb)
+            with mocked_run_subprocess(output=foxs_output) as mock:
+                run_foxs.run_job(p)
+            return mock.cmds
+
+        with saliweb.test.temporary_working_directory() as tmpdir:
+            store = os.path.join(tmpdir, 'store')
+            os.mkdir('job1')
+            os.chdir('job1')
+            cmds = run_job(['1.pdb'], 'exp1.profile')
+            # Profile computed with FoXS, fit done by us
+            self.assertEqual(cmds[0], ['foxs', '-m', '3', '-q', '1.0',
+                                       '-s', '10', '-p', '--', '1.pdb'])
+            self.assertEqual(cmds[1], ['gnuplot', 'shared_plots.plt'])
+            with open('shared_plots.plt') as fh:
+                plt = fh.read()
+            self.assertIn("set output '1_exp1.png'", plt)
+            self.assertIn("set output '1.png'", plt)
+            self.assertTrue(os.path.exists('1_exp1.dat'))
+
+            # Second job with the same structure should not run FoXS
+            os.mkdir('../job2')
+            os.chdir('../job2')
+            cmds = run_job(['1.pdb'], 'exp2.profile')
+            self.assertEqual(cmds, [['gnuplot', 'shared_plots.plt']])
+            self.assertTrue(os.path.exists('1.pdb.dat'))
+            self.assertTrue(os.path.exists('1_exp2.dat'))
+
+            # Only new structures are given to FoXS; with more than one
+            # structure, MultiFoXS is run too
+            os.mkdir('../job3')
+            os.chdir('../job3')
+            # (No MultiFoXS ensembles are produced by the mock)
+            self.assertRaises(RuntimeError, run_job, ['1.pdb', '2.pdb'],
+                              'exp3.profile')
+            self.assertTrue(os.path.exists('2_exp3.dat'))
+
+    def test_run_job_profile_library(self):
+        """Test run_job using precomputed profiles from the library"""
+        q = numpy.linspace(0., 0.5, 20)
+        decay = numpy.exp(-q * q * 400.)
+
+        def write_profile(fname):
+            with open(fname, 'w') as fh:
+                for qval, d in zip(q, decay):
+                    fh.write("%f %f %f %f\n"
+                             % (qval, 100. * d + 1., 30. * d, 50. * d))
+
+        def foxs_output(cmd):
+            if cmd[0] == 'foxs':
+                for pdb in cmd[cmd.index('--') + 1:]:
+                    write_profile(pdb + '.dat')
+            return ''
+
+        with saliweb.test.temporary_working_directory() as tmpdir:
+            library = os.path.join(tmpdir, 'library')
+            os.mkdir('job')
+            os.chdir('job')
+            p = MockParameters()
+            p.profile_library = library
+            p.profile_file_name = 'exp.profile'
+            p.profile_file_names = ['exp.profile']
+            with open('exp.profile', 'w') as fh:
+                for qval, d in zip(q[1:], decay[1:]):
+                    fh.write("%f %f\n" % (qval, 50. * d + 1.))
+            for pdb in p.pdb_file_names:
+                with open(pdb, 'w') as fh:
+                    fh.write("ATOM %s\n" % pdb)
+            opts = run_foxs.get_profile_options(p)
+            store = profile_store.ProfileStore(library)
+            key = store.get_key('1.pdb', opts)
+            write_profile('lib.dat')
+            store.put(key, 'lib.dat')
+            profile_library.write_index(
+                library, {key: ('default', '1.pdb')})
+            # Jobs fit by FoXS itself don't use the library
+            self.assertFalse(run_foxs.use_profile_library(p))
+            self.assertEqual(run_foxs.fetch_library_profiles(p),
+                             ['1.pdb', '2.pdb'])
+            self.assertFalse(os.path.exists('1.pdb.dat'))
+            # Multi-profile jobs do
+            p.profile_file_names = ['exp.profile', 'exp2.profile']
+            self.assertTrue(run_foxs.use_profile_library(p))
+            p.profile_file_names = ['exp.profile']
+
+            # Jobs sharing profiles do, even without a profile store
+            p.share = True
+            with mocked_run_subprocess(output=foxs_output) as mock:
+                # (No MultiFoXS ensembles are produced by the mock)
+                self.assertRaises(RuntimeError, run_foxs.run_job, p)
+            # Only the structure not in the library is given to FoXS
+            self.assertEqual(mock.cmds[0], ['foxs'] + opts
+                             + ['-p', '--', '2.pdb'])
+            self.assertTrue(os.path.exists('1.pdb.dat'))
+            self.assertTrue(os.path.exists('1_exp.dat'))
+            self.assertTrue(os.path.exists('2_exp.dat'))
+
+            # Without a profile, the library is not used
+            p.profile_file_name = None
+            self.assertEqual(run_foxs.fetch_library_profiles(p),
+                             ['1.pdb', '2.pdb'])
+
+    def test_run_job_multi_profile(self):
+        """Test run_job with multiple profiles"""
+        q = numpy.linspace(0., 0.5, 20)
+        decay = numpy.exp(-q * q * 400.)
+
+        def foxs_output(cmd):
+            if cmd[0] == 'foxs':
+                for pdb in cmd[cmd.index('--') + 1:]:
+                    with open(pdb + '.dat', 'w') as fh:
+                        for qval, d in zip(q, decay):
+                            fh.write("%f %f %f %f\n"
+                                     % (qval, 100. * d + 1., 30. * d,
+                                        50. * d))
+            elif cmd[0] == 'multi_foxs':
+                # Only make ensembles for the first profile
+                if cmd[1] == 'exp1_v.dat':
+                    with open('exp1_multifoxs/ensembles_size_1.txt',
+                              'w') as fh:
+                        fh.write("1 |  2.50 | x1 2.50 (1.00, 0.50)\n")
+            return ''
+
+        p = MockParameters()
+        p.profile_file_name = 'exp1.profile'
+        p.profile_file_names = ['exp1.profile', 'exp2.profile']
+        with saliweb.test.temporary_working_directory():
+            for i, prof in enumerate(p.profile_file_names):
+                with open(prof, 'w') as fh:
+                    for qval, d in zip(q[1:], decay[1:]):
+                        fh.write("%f %f\n" % (qval, (i + 50.) * d + 1.))
+            for pdb in p.pdb_file_names:
+                with open(pdb, 'w') as fh:
+                    fh.write("ATOM\n")
+            with mocked_run_subprocess(output=foxs_output) as m:
+                run_foxs.run_job(p)
+            # Profiles should be computed only once
+            self.assertEqual([c for c in m.cmds if c[0] == 'foxs'],
+                             [['foxs', '-m', '3', '-q', '1.0', '-s', '10',
+                               '-p', '--', '1.pdb', '2.pdb']])
+            # MultiFoXS should be run for each profile in its own directory
+            self.assertEqual(
+                sorted(cwd for cmd, cwd in zip(m.cmds, m.cwds)
+                       if cmd[0] == 'multi_foxs'),
+                ['exp1_multifoxs', 'exp2_multifoxs'])
+            with open('exp2_multifoxs/filenames2.txt') as fh:
+                self.assertEqual(fh.read(), '../1.pdb.dat\n../2.pdb.dat\n')
+            for fit in ('1_exp1.dat', '2_exp1.dat', '1_exp2.dat',
+                        '2_exp2.dat'):
+                self.assertTrue(os.path.exists(fit))
+            with open(run_foxs.CHI_MATRIX_FILE) as fh:
+                matrix = json.load(fh)
+            self.assertEqual(matrix['profiles'],
+                             ['exp1.profile', 'exp2.profile'])
+            self.assertEqual(matrix['structures'], ['1.pdb', '2.pdb'])
+            self.assertEqual(len(matrix['fits']), 2)
+            self.assertEqual(len(matrix['fits'][0]), 2)
+            self.assertEqual(len(matrix['fits'][0][0]), 3)
+            self.assertEqual(matrix['ensembles'], [{'1': 2.5}, {}])
+
+    def test_run_job_refit(self):
+        """Test run_job refitting partial profiles from an earlier job"""
+        p = MockParameters()
+        p.refit = True
+        p.profile_file_name = 'exp.profile'
+        p.profile_file_names = ['exp.profile']
+        p.pdb_file_names = ['1.pdb']
+        p.hlayer = False
+        p.hlayer_value = 0.5
+        with saliweb.test.temporary_working_directory():
+            with open(run_foxs.REFIT_FILE, 'w') as fh:
+                fh.write('oldjob\n')
+            with open('1.pdb', 'w') as fh:
+                fh.write(ATOM_LINE)
+            with open('1.pdb.dat', 'w') as fh:
+                for i in range(20):
+                    fh.write("%f 10.0 2.0 3.0 1.0 1.0 0.5\n" % (i * 0.02))
+            with open('exp.profile', 'w') as fh:
+                for i in range(1, 20):
+                    fh.write("%f 5.0 0.1\n" % (i * 0.02))
+            with mocked_run_subprocess() as m:
+                run_foxs.run_job(p)
+            # Only the plots need to be made
+            self.assertEqual(m.cmds, [['gnuplot', 'shared_plots.plt']])
+            with open('1_exp.dat') as fh:
+                self.assertIn('c2 = 0.5 ', fh.readline())
+
+    def test_run_job_refit_multimodel(self):
+        """Test run_job refit of a job with submodels of a multi-model PDB"""
+        p = MockParameters()
+        p.refit = True
+        p.model_option = 2
+        p.profile_file_name = 'exp.profile'
+        p.profile_file_names = ['exp.profile']
+        p.pdb_file_names = ['multi_m1.pdb', 'multi_m2.pdb']
+        ensemble = ("1 |  0.04 | x1 0.05 (1.02, 1.66)\n"
+                    "    2   | 1.000 (0.698, 0.077) | multi_m1.pdb.dat "
+                    "(0.058)\n")
+        rg_inputs = []
+
+        def check_rg_inputs(cmd):
+            if cmd[0] == 'compute_rg':
+                for pdb in cmd[3:]:
+                    with open(pdb) as fh:
+                        rg_inputs.append((pdb, fh.read()))
+            return ''
+
+        with saliweb.test.temporary_working_directory():
+            with open(run_foxs.REFIT_FILE, 'w') as fh:
+                fh.write('oldjob\n')
+            # Only the multi-model file and submodel index were copied
+            with open('multi.pdb', 'w') as fh:
+                fh.write("MODEL 1\nATOM 1\nENDMDL\nMODEL 2\nATOM 2\n"
+                         "ENDMDL\n")
+            with open(run_foxs.SUBMODEL_INDEX_FILE, 'w') as fh:
+                fh.write("multi_m1.pdb multi.pdb 8 22\n"
+                         "multi_m2.pdb multi.pdb 30 44\n")
+            for pdb in p.pdb_file_names:
+                with open(pdb + '.dat', 'w') as fh:
+                    for i in range(20):
+                        fh.write("%f 10.0 2.0 3.0 1.0 1.0 0.5\n"
+                                 % (i * 0.02))
+            with open('exp.profile', 'w') as fh:
+                for i in range(1, 20):
+                    fh.write("%f 5.0 0.1\n" % (i * 0.02))
+            with mocked_run_subprocess(
+                    make_files={'ensembles_size_1.txt': ensemble},
+                    output=check_rg_inputs):
+                run_foxs.run_job(p)
+            self.assertEqual(rg_inputs, [('multi_m1.pdb', "ATOM 1\n"),
+                                         ('multi_m2.pdb', "ATOM 2\n")])
+
+    def test_run_job_refit_scan(self):
+        """Test run_job refit with a c1/c2 parameter scan"""
+        p = MockParameters()
+        p.refit = True
+        p.scan = True
+        p.profile_file_name = 'exp.profile'
+        p.profile_file_names = ['exp.profile']
+        p.pdb_file_names = ['1.pdb', '2.pdb']
+        p.hlayer = False
+        p.hlayer_value = 0.5
+        with saliweb.test.temporary_working_directory():
+            with open(run_foxs.REFIT_FILE, 'w') as fh:
+                fh.write('oldjob\n')
+            for pdb in ('1.pdb', '2.pdb'):
+                with open(pdb, 'w') as fh:
+                    fh.write(ATOM_LINE)
+                with open(pdb + '.dat', 'w') as fh:
+                    for i in range(20):
+                        fh.write("%f 10.0 2.0 3.0 1.0 1.0 0.5\n" % (i * 0.02))
+            with open('exp.profile', 'w') as fh:
+                for i in range(1, 20):
+                    fh.write("%f 5.0 0.1\n" % (i * 0.02))
+            with mocked_run_subprocess():
+                # (No MultiFoXS ensembles are produced by the mock)
+                self.assertRaises(RuntimeError, run_foxs.run_job, p)
+            # The landscape covers all c2, even though c2 was fixed
+            with numpy.load(run_foxs.CHI_LANDSCAPE_FILE) as data:
+                self.assertEqual(data['chi2'].shape, (2, 21, 61))
+                self.assertEqual(list(data['structures']),
+                                 ['1.pdb', '2.pdb'])
+                self.assertAlmostEqual(data['c1'][0], 0.95, delta=1e-6)
+                self.assertAlmostEqual(data['c2'][-1], 4.0, delta=1e-6)
+
+    def test_get_average_radii(self):
+        """Test get_average_radii()"""
+        p = MockParameters()
+        with saliweb.test.temporary_working_directory():
+            with open('1.pdb', 'w') as fh:
+                fh.write(ATOM_LINE.replace(' CA ', ' CB '))
+            # By default, FoXS is run without -h, so the hydrogens of the
+            # alanine CB (CH3 group) are included in its volume
+            self.assertTrue(p.ihydrogens)
+            self.assertAlmostEqual(run_foxs.get_average_radii(p, ['1.pdb'])[0],
+                                   1.96, delta=0.01)
+            # With explicit hydrogens (-h), only the carbon itself
+            p.ihydrogens = False
+            self.assertAlmostEqual(run_foxs.get_average_radii(p, ['1.pdb'])[0],
+                                   1.58, delta=0.01)
+
+    def test_get_average_radii_submodels(self):
+        """Test get_average_radii() with submodels not written out"""
+        p = MockParameters()
+        p.model_option = 2
+        with saliweb.test.temporary_working_directory():
+            submodels = make_multimodel_pdb('mm.pdb')
+            radii = run_foxs.get_average_radii(p, submodels)
+            self.assertEqual(glob.glob('*_m*.pdb'), [])
+            # Should match the radii of the written-out submodels
+            run_foxs.write_submodels(submodels)
+            for submodel, radius in zip(submodels, radii):
+                self.assertAlmostEqual(
+                    run_foxs.get_average_radii(p, [submodel])[0], radius,
+                    delta=1e-6)
+            self.assertLess(radii[1], radii[0])
+
+    def test_write_chi_landscape_submodels(self):
+        """Test write_chi_landscape() with submodels of a multi-model PDB"""
+        p = MockParameters()
+        p.model_option = 2
+        p.scan = True
+        p.profile_file_name = 'exp.profile'
+        p.pdb_file_names = ['mm.pdb']
+        with saliweb.test.temporary_working_directory():
+            submodels = make_multimodel_pdb('mm.pdb')
+            for submodel in submodels:
+                write_partial_profile(submodel + '.dat')
+            with open('exp.profile', 'w') as fh:
+                for i in range(1, 20):
+                    fh.write("%f 5.0 0.1\n" % (i * 0.02))
+            run_foxs.write_chi_landscape(p)
+            with numpy.load(run_foxs.CHI_LANDSCAPE_FILE) as data:
+                self.assertEqual(list(data['structures']), submodels)
+                self.assertEqual(data['chi2'].shape[0], 2)
+            self.assertEqual(glob.glob('*_m*.pdb'), [])
+
+    def test_run_multi_profile_submodels(self):
+        """Test run_multi_profile() with submodels of a multi-model PDB"""
+        def foxs_output(cmd):
+            if cmd[0] == 'foxs':
+                # FoXS computes a profile for each submodel
+                for submodel in ('mm_m1.pdb', 'mm_m2.pdb'):
+                    write_partial_profile(submodel + '.dat')
+            return ''
+
+        p = MockParameters()
+        p.model_option = 2
+        p.profile_file_name = 'exp1.profile'
+        p.profile_file_names = ['exp1.profile', 'exp2.profile']
+        p.pdb_file_names = ['mm.pdb']
+        with saliweb.test.temporary_working_directory():
+            submodels = make_multimodel_pdb('mm.pdb')
+            for i, prof in enumerate(p.profile_file_names):
+                with open(prof, 'w') as fh:
+                    for j in range(1, 20):
+                        fh.write("%f %f 0.1\n" % (j * 0.02, 5.0 + i))
+            with mocked_run_subprocess(output=foxs_output):
+                run_foxs.run_multi_profile(p, [])
+            with open(run_foxs.CHI_MATRIX_FILE) as fh:
+                matrix = json.load(fh)
+            self.assertEqual(matrix['structures'], submodels)
+            for fit in ('mm_m1_exp1.dat', 'mm_m2_exp1.dat', 'mm_m1_exp2.dat',
+                        'mm_m2_exp2.dat'):
+                self.assertTrue(os.path.exists(fit))
+            self.assertEqual(glob.glob('*_m*.pdb'), [])
+
+    def test_write_ensemble_profiles(self):
+        """Test write_ensemble_profiles()"""
+        p = MockParameters()
+        p.profile_file_name = 'exp.profile'
+        p.hlayer = False
+        p.hlayer_value = 0.5
+        p.offset = True
+        dat_files = ['1.pdb.dat', '2.pdb.dat']
+        with saliweb.test.temporary_working_directory():
+            with open('1.pdb', 'w') as fh:
+                fh.write(ATOM_LINE)
+            # Nitrogen has a smaller radius than carbon
+            with open('2.pdb', 'w') as fh:
+                fh.write(ATOM_LINE.replace(' CA ', ' N  ')[:-2] + 'N\n')
+            for dat_file in dat_files:
+                with open(dat_file, 'w') as fh:
+                    for i in range(20):
+                        fh.write("%f 10.0 2.0 3.0 1.0 1.0 0.5\n" % (i * 0.02))
+            with open('exp.profile', 'w') as fh:
+                for i in range(1, 30):
+                    fh.write("%f 5.0 0.1\n" % (i * 0.02))
+            run_foxs.write_ensemble_profiles(p, dat_files)
+            with numpy.load(run_foxs.ENSEMBLE_PROFILES_FILE) as data:
+                self.assertEqual(list(data['structures']),
+                                 ['1.pdb', '2.pdb'])
+                # Only experimental points within the profile q range
+                self.assertEqual(len(data['q']), 19)
+                self.assertEqual(data['partials'].shape, (2, 19, 6))
+                self.assertEqual(data['intensity'].shape, (19,))
+                self.assertEqual(data['error'].shape, (19,))
+                # c2 is fixed; c1 is scanned
+                numpy.testing.assert_allclose(data['c2'], [0.5])
+                self.assertEqual(len(data['c1']), 13)
+                # Excluded volume factor depends on each structure's radius
+                self.assertEqual(data['g'].shape, (2, 13, 19))
+                self.assertTrue(numpy.all(data['g'][0, -1, 1:]
+                                          < data['g'][1, -1, 1:]))
+                self.assertTrue(data['offset'])
+            os.unlink(run_foxs.ENSEMBLE_PROFILES_FILE)
+
+            # Profiles that are not partial profiles can't be refit
+            with open('1.pdb.dat', 'w') as fh:
+                fh.write("0.1 10.0 0.5\n")
+            run_foxs.write_ensemble_profiles(p, dat_files)
+            self.assertFalse(os.path.exists(run_foxs.ENSEMBLE_PROFILES_FILE))
+
+    def test_run_job_continue(self):
+        """Test run_job continuing an earlier job's ensemble search"""
+        p = MockParameters()
+        p.continue_size = 7
+        p.profile_file_name = 'exp.profile'
+        with saliweb.test.temporary_working_directory():
+            with open(run_foxs.CONTINUE_FILE, 'w') as fh:
+                fh.write('oldjob 7\n')
+            with open('filenames2.txt', 'w') as fh:
+                fh.write("".join("%d.pdb.dat\n" % i for i in range(6)))
+            ensemble = ("1 |  0.04 | x1 0.05 (1.02, 1.66)\n"
+                        "    2   | 0.521 (0.698, 0.077) | 1.pdb.dat (0.058)\n")
+            with mocked_run_subprocess(
+                    make_files={'ensembles_size_1.txt': ensemble}) as m:
+                run_foxs.run_job(p)
+            # Only MultiFoXS is rerun; ensembles can be no larger than the
+            # number of profiles
+            self.assertEqual(m.cmds, [
+                ['multi_foxs', 'exp_v.dat', 'filenames2.txt', '-s', '6',
+                 '-u', '1', '-q', '1.0'],
+                ['gnuplot', 'plotbar3.plt']])
+            with open('plotbar3.plt') as fh:
+                self.assertIn("set xrange [0.5:6.5]", fh.read())
+
+    def test_select_conformers(self):
+        """Test select_conformers()"""
+        p = MockParameters()
+        dat_files = ['1.pdb.dat', '2.pdb.dat', '3.pdb.dat']
+        with saliweb.test.temporary_working_directory():
+            for i, offset in enumerate((0., 0.01, 5.)):
+                with open('%d.pdb' % (i + 1), 'w') as fh:
+                    for j in range(4):
+                        fh.write("ATOM  %5d  CA  ALA A%4d    %8.3f%8.3f%8.3f"
+                                 "\n" % (j + 1, j + 1, j * 3.8,
+                                         offset * j * j, 0.))
+            # By default all conformers are used
+            self.assertEqual(run_foxs.select_conformers(p, dat_files),
+                             dat_files)
+            self.assertFalse(os.path.exists(run_foxs.CONFORMER_GROUPS_FILE))
+            p.dedup_rmsd = 0.5
+            self.assertEqual(run_foxs.select_conformers(p, dat_files),
+                             ['1.pdb.dat', '3.pdb.dat'])
+            with open(run_foxs.CONFORMER_GROUPS_FILE) as fh:
+                self.assertEqual(fh.read(), "# RMSD threshold 0.50\n"
+                                            "1.pdb 2.pdb\n3.pdb\n")
+
+    def test_ensemble_inputs_submodels(self):
+        """Test ensemble inputs don't need submodels to be written out"""
+        p = MockParameters()
+        p.model_option = 2
+        p.profile_file_name = 'exp.profile'
+        p.dedup_rmsd = 0.5
+        with saliweb.test.temporary_working_directory():
+            submodels = make_multimodel_pdb('mm.pdb', nmodels=3)
+            dat_files = [s + '.dat' for s in submodels]
+            for dat_file in dat_files:
+                write_partial_profile(dat_file)
+            with open('exp.profile', 'w') as fh:
+                for i in range(1, 20):
+                    fh.write("%f 5.0 0.1\n" % (i * 0.02))
+            run_foxs.write_ensemble_profiles(p, dat_files)
+            with numpy.load(run_foxs.ENSEMBLE_PROFILES_FILE) as data:
+                self.assertEqual(list(data['structures']), submodels)
+            # All submodels have a single atom at the same position
+            self.assertEqual(run_foxs.select_conformers(p, dat_files),
+                             ['mm_m1.pdb.dat'])
+            self.assertEqual(glob.glob('*_m*.pdb'), [])
+
+    def test_run_multifoxs_clusters(self):
+        """Test run_multifoxs() with clustered profiles"""
+        p = MockParameters()
+        p.profile_file_name = 'exp.profile'
+        p.profile_clusters = 2
+        dat_files = ['a1.pdb.dat', 'b1.pdb.dat', 'a2.pdb.dat', 'b2.pdb.dat',
+                     'a3.pdb.dat', 'b3.pdb.dat']
+        ensemble = ("1 |  0.04 | x1 0.05 (1.02, 1.66)\n"
+                    "    2   | 1.000 (0.698, 0.077) | a2.pdb.dat (0.058)\n")
+        inputs = []
+
+        def get_inputs(cmd):
+            if cmd[0] == 'multi_foxs':
+                with open(cmd[2]) as fh:
+                    inputs.append(fh.read().split())
+            return ''
+
+        for refine in (False, True):
+            p.cluster_refine = refine
+            del inputs[:]
+            with saliweb.test.temporary_working_directory():
+                with open('exp.profile', 'w') as fh:
+                    fh.write("0.05 1.0\n")
+                for i, dat_file in enumerate(dat_files):
+                    with open(dat_file[:-4], 'w') as fh:
+                        fh.write(ATOM_LINE)
+                    with open(dat_file, 'w') as fh:
+                        # Partial profiles, as written by FoXS -p
+                        fh.write("# partial profile\n")
+                        for q in range(1, 11):
+                            q *= 0.05
+                            rg = 10. if dat_file.startswith('a') else 20.
+                            d = (numpy.exp(-(q * rg) ** 2 / 3.)
+                                 * (1. + 0.01 * i * q))
+                            fh.write("%f %g %g %g %g %g %g\n"
+                                     % (q, 1.2 * d, 0.4 * d, 0.3 * d,
+                                        0.05 * d, 0.02 * d, 0.01 * d))
+                with mocked_run_subprocess(
+                        make_files={'ensembles_size_1.txt': ensemble},
+                        output=get_inputs):
+                    run_foxs.run_multifoxs(p, [], dat_files=dat_files)
+                with open(run_foxs.PROFILE_CLUSTERS_FILE) as fh:
+                    self.assertEqual(
+                        fh.read(), "# k-medoids clusters 2 refine %d\n"
+                        "a2.pdb.dat a1.pdb.dat a3.pdb.dat\n"
+                        "b2.pdb.dat b1.pdb.dat b3.pdb.dat\n" % refine)
+            # First search uses only the medoids; the refinement uses every
+            # member of the cluster in the best ensemble
+            self.assertEqual(inputs[0], ['a2.pdb.dat', 'b2.pdb.dat'])
+            if refine:
+                self.assertEqual(inputs[1:], [['a1.pdb.dat', 'a2.pdb.dat',
+                                               'a3.pdb.dat']])
+            else:
+                self.assertEqual(len(inputs), 1)
+
+    def test_run_ensemble_search_shards(self):
+        """Test run_ensemble_search() screening profiles in shards"""
+        p = MockParameters()
+        p.profile_file_name = 'exp.profile'
+        p.multifoxs_shard_size = 2
+        dat_files = ['%d.pdb.dat' % i for i in range(5)]
+        cmds = []
+
+        def mock_run_subprocess(cmd, stdout=None, cwd=None):
+            # Each search finds only ensembles of its first profile
+            cwd = cwd or '.'
+            cmds.append((cmd, cwd))
+            with open(os.path.join(cwd, cmd[2])) as fh:
+                first = fh.readline().strip()
+            with open(os.path.join(cwd, 'ensembles_size_1.txt'), 'w') as fh:
+                fh.write("1 |  0.04 | x1 0.05 (1.02, 1.66)\n"
+                         "    2   | 1.000 (0.698, 0.077) | %s (0.058)\n"
+                         % first)
+
+        old_rs = run_foxs.run_subprocess
+        run_foxs.run_subprocess = mock_run_subprocess
+        try:
+            with saliweb.test.temporary_working_directory():
+                run_foxs.write_multifoxs_input(dat_files)
+                run_foxs.run_ensemble_search(p, [], 2)
+                # Shard directories are cleaned up
+                self.assertEqual(glob.glob('multifoxs-shard*'), [])
+                # Full pool is kept for continued searches
+                with open('filenames2.txt') as fh:
+                    self.assertEqual(fh.read().split(), dat_files)
+                with open(run_foxs.MERGED_POOL_FILE) as fh:
+                    self.assertEqual(fh.read(), '0.pdb.dat\n1.pdb.dat\n')
+        finally:
+            run_foxs.run_subprocess = old_rs
+        # First round: three shards of interleaved profiles; second round:
+        # the three first profiles in two shards; then the final search
+        self.assertEqual(sorted(cwd for _, cwd in cmds[:3]),
+                         ['multifoxs-shard0', 'multifoxs-shard1',
+                          'multifoxs-shard2'])
+        self.assertEqual(sorted(cwd for _, cwd in cmds[3:5]),
+                         ['multifoxs-shard0', 'multifoxs-shard1'])
+        for cmd, _ in cmds[:5]:
+            self.assertEqual(cmd[:3], ['multi_foxs', '../exp_v.dat',
+                                       'filenames2.txt'])
+        self.assertEqual(cmds[5:], [(['multi_foxs', 'exp_v.dat',
+                                      'filenames-merged.txt', '-s', '2'],
+                                     '.')])
+
+    def test_get_ensemble_profiles(self):
+        """Test get_ensemble_profiles()"""
+        with saliweb.test.temporary_working_directory():
+            with open('ensembles_size_2.txt', 'w') as fh:
+                fh.write("""
+1 |  0.04 | x1 0.05 (1.02, 1.66)
+    2   | 0.521 (0.698, 0.077) | nodes98_m49.pdb.dat (0.058)
+    3   | 0.479 (0.612, 0.113) | nodes18_m33.pdb.dat (0.035)
+2 |  0.07 | x1 0.05 (1.02, 1.84)
+    2   | 0.559 (0.698, 0.077) | nodes98_m49.pdb.dat (0.058)
+   10   | 0.441 (0.481, 0.108) | nodes63_m9.pdb.dat (0.018)
+""")
+            self.assertEqual(run_foxs.get_ensemble_profiles(3, 1),
+                             {'nodes98_m49.pdb.dat', 'nodes18_m33.pdb.dat'})
+            self.assertEqual(run_foxs.get_ensemble_profiles(3, 10),
+                             {'nodes98_m49.pdb.dat', 'nodes18_m33.pdb.dat',
+                              'nodes63_m9.pdb.dat'})
+
     def test_run_job_no_ensemble(self):
         """Test run_job failure (no MultiFoXS ensemble produced)"""
         p = MockParameters()
@@ -0,0 +1,96 @@
+import unittest
+from foxs import summary
+import saliweb.test
+import os
+import json
+
+
+class Tests(saliweb.test.TestCase):
+
+    def test_write_summary(self):
+        """Test write_summary()"""
+        with saliweb.test.temporary_working_directory():
+            with open('data.txt', 'w') as fh:
+                fh.write("1abc.pdb test.profile EMAIL 0.50 500 "
+                         "1 1 1 0 0 0 0.00 1.00 3 1\n")
+            with open('inputFiles.txt', 'w') as fh:
+                fh.write("1abc.pdb\n1xyz.pdb\n")
+            with open('foxs.log', 'w') as fh:
+                fh.write("1abc.pdb test.profile Chi^2 = 0.202144 "
+                         "c1 = 1.01131 c2 = 0.5872 default chi^2 = 0.28\n"
+                         "other line\n")
+            os.mkdir('subdir')
+            for png in ('1abc_test.png', 'subdir/1xyz_test.png'):
+                with open(png, 'w') as fh:
+                    fh.write('\n')
+            summary.write_summary()
+            with open(summary.SUMMARY_FILE) as fh:
+                s = json.load(fh)
+            self.assertEqual(s['pdb'], '1abc.pdb')
+            self.assertEqual(s['profile'], 'test.profile')
+            self.assertIsNone(s['error'])
+            self.assertEqual(s['pdb_files'], ['1abc.pdb', '1xyz.pdb'])
+            self.assertEqual(s['fits'],
+                             {'1abc.pdb': ['0.202144', '1.01131', '0.5872']})
+            self.assertEqual(s['pngs'],
+                             ['1abc_test.png', 'subdir/1xyz_test.png'])
+
+    def test_summary_multi_profile(self):
+        """Test make_summary() of a job with two profiles"""
+        with saliweb.test.temporary_working_directory():
+            with open('data.txt', 'w') as fh:
+                fh.write("1abc.pdb p1.dat EMAIL 0.50 500 "
+                         "1 1 1 0 0 0 0.00 1.00 3 1\n")
+            with open('profiles.txt', 'w') as fh:
+                fh.write("p1.dat\np2.dat\n")
+            with open('inputFiles.txt', 'w') as fh:
+                fh.write("1abc.pdb\n")
+            with open('foxs.log', 'w') as fh:
+                fh.write("1abc.pdb p1.dat Chi^2 = 1.5 c1 = 1.01 c2 = 0.5 "
+                         "default chi^2 = 2.0\n"
+                         "1abc.pdb p2.dat Chi^2 = 3.0 c1 = 1.02 c2 = 0.3 "
+                         "default chi^2 = 4.0\n")
+            s = summary.make_summary()
+            # Fits should be to the job's (first) profile
+            self.assertEqual(s['fits'], {'1abc.pdb': ['1.5', '1.01', '0.5']})
+            self.assertEqual(summary.parse_log(profile='p2.dat'),
+                             {'1abc.pdb': ['3.0', '1.02', '0.3']})
+
+    def test_summary_validation_error(self):
+        """Test make_summary() for a job that failed validation"""
+        with saliweb.test.temporary_working_directory():
+            with open('data.txt', 'w') as fh:
+                fh.write("1abc.pdb - EMAIL 0.50 500 "
+                         "1 1 1 0 0 0 0.00 1.00 3 1\n")
+            with open('validation-error.txt', 'w') as fh:
+                fh.write("bad input\n")
+            s = summary.make_summary()
+            self.assertEqual(s['error'], 'bad input')
+            self.assertEqual(s['pdb_files'], [])
+            self.assertEqual(s['fits'], {})
+
+    def test_make_summary_directory(self):
+        """Test make_summary() of a job in another directory"""
+        with saliweb.test.temporary_working_directory():
+            os.mkdir('job')
+            with open('job/data.txt', 'w') as fh:
+                fh.write("1abc.pdb test.profile EMAIL 0.50 500 "
+                         "1 1 1 0 0 0 0.00 1.00 3 1\n")
+            with open('job/multi-model-files.txt', 'w') as fh:
+                fh.write("1abc_m1.pdb\n")
+            with open('job/foxs.log', 'w') as fh:
+                fh.write("1abc_m1.pdb test.profile Chi^2 = 0.2 "
+                         "c1 = 1.01 c2 = 0.5 default chi^2 = 0.28\n")
+            with open('job/1abc_m1.png', 'w') as fh:
+                fh.write('\n')
+            s = summary.make_summary('job')
+            self.assertEqual(s['pdb'], '1abc.pdb')
+            self.assertEqual(s['pdb_files'], ['1abc_m1.pdb'])
+            self.assertEqual(s['fits'],
+                             {'1abc_m1.pdb': ['0.2', '1.01', '0.5']})
+            self.assertEqual(s['pngs'], ['1abc_m1.png'])
+            self.assertEqual(summary.get_pdb_files('job'), ['1abc_m1.pdb'])
+
+
+if __name__ == '__main__':
+    unittest.main()
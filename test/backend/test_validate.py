@@ -0,0 +1,33 @@
+import unittest
+from foxs import validate
+import saliweb.test
+import os
+import json
+
+
+class Tests(saliweb.test.TestCase):
+
+    def test_validate_job(self):
+        """Test validate_job()"""
+        with saliweb.test.temporary_working_directory():
+            with open('test.pdb', 'w') as fh:
+                fh.write("ATOM  \n")
+            with open('test.profile', 'w') as fh:
+                fh.write("garbage\n")
+            with open(validate.REQUEST_FILE, 'w') as fh:
+                json.dump({'structures': 'test.pdb',
+                           'show_filename': 'orig.pdb',
+                           'profile': 'test.profile', 'local': False}, fh)
+            self.assertFalse(validate.validate_job())
+            with open(validate.ERROR_FILE) as fh:
+                self.assertIn('Invalid profile uploaded', fh.read())
+
+            os.unlink(validate.ERROR_FILE)
+            with open('test.profile', 'w') as fh:
+                fh.write("0.1 0.5\n")
+            self.assertTrue(validate.validate_job())
+            self.assertFalse(os.path.exists(validate.ERROR_FILE))
+
+
+if __name__ == '__main__':
+    unittest.main()
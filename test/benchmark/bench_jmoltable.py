@@ -0,0 +1,91 @@
+"""Benchmark of the rendering of the Jmol table on the results page.
+
+   Compares rewriting the raw jmoltable.html written by FoXS on every
+   request (as is still done for older jobs) with filling in the template
+   made once at postprocess time (see backend/foxs/jmoltable.py), for a
+   large synthetic table. Run from the top-level directory with
+   `python3 test/benchmark/bench_jmoltable.py`."""
+
+import importlib.util
+import os
+import shutil
+import tempfile
+import timeit
+import saliweb.test
+import flask
+
+TOPDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+# Import the foxs frontend with mocks
+foxs = saliweb.test.import_mocked_frontend("foxs", __file__,
+                                           '../../frontend')
+
+# The backend package has the same name as the frontend, so load
+# just the (dependency-free) jmoltable module from it
+spec = importlib.util.spec_from_file_location(
+    'jmoltable', os.path.join(TOPDIR, 'backend', 'foxs', 'jmoltable.py'))
+jmoltable = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(jmoltable)
+
+
+def make_table(nrows=100, ncopies=4):
+    """Make a jmoltable.html in the style of that written by FoXS"""
+    rows = "".join(
+        '<tr><td><input type="checkbox" onclick="jmolScript(\'frame %d\')">'
+        '<a href="dirname/m%d.pdb">m%d.pdb</a></td>'
+        '<td><a href="https://modbase.compbio.ucsf.edu/foxs/help.html#chi">'
+        '%.2f</a></td><td><a href="https://modbase.compbio.ucsf.edu/foxs/'
+        'help.html#c1c2">1.01</a></td><td>0.5</td>'
+        '<td><a href="dirname/m%d_exp.dat">fit</a>'
+        '<a href="dirname/m%d.pdb.dat">profile</a></td></tr>\n'
+        % (i, i, i, i / 10., i, i) for i in range(nrows))
+    return ('<script src="/foxs/jsmol/JSmol.min.js"></script>'
+            '<script>Jmol.script(jmolApplet0, "load jmoltable.pdb");'
+            'jmolSetCheckboxGroup(0,' + ','.join(str(i) for i in range(nrows))
+            + ')</script><table border=1>\n' + rows + '</table>\n') * ncopies
+
+
+class Job(object):
+    """Minimal completed job, with URLs built as in saliweb"""
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get_path(self, fname):
+        return os.path.join(self.directory, fname)
+
+    def get_results_file_url(self, fname):
+        return flask.url_for('results_file', name='testjob', fp=fname,
+                             passwd='abcdefg', _external=True)
+
+
+def main(number=200):
+    directory = tempfile.mkdtemp()
+    try:
+        contents = make_table()
+        with open(os.path.join(directory, 'jmoltable.html'), 'w') as fh:
+            fh.write(contents)
+        reader = foxs.results_page.JMolTableReader(Job(directory))
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            with foxs.app.test_request_context():
+                old_html = reader()
+                old = timeit.timeit(reader, number=number) / number
+                post = timeit.timeit(jmoltable.write_template,
+                                     number=number) / number
+                new_html = reader()
+                new = timeit.timeit(reader, number=number) / number
+        finally:
+            os.chdir(cwd)
+    finally:
+        shutil.rmtree(directory)
+    print("Table of %d bytes; mean time per call:" % len(contents))
+    print("  per-request rewrite:  %.2f ms" % (old * 1e3))
+    print("  template fill:        %.2f ms" % (new * 1e3))
+    print("  one-off postprocess:  %.2f ms" % (post * 1e3))
+    print("Output is %s" % ("identical" if old_html == new_html
+                            else "DIFFERENT"))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,6 @@
 import unittest
+import subprocess
+import sys
 import saliweb.test
 
 # Import the foxs frontend with mocks
@@ -6,8 +8,31 @@ foxs = saliweb.test.import_mocked_frontend("foxs", __file__,
                                            '../../frontend')
 
 
+# Run in a fresh interpreter, so we can see what importing the frontend
+# and showing a static page pulls in
+LAZY_IMPORT_SCRIPT = """
+import sys, socket, saliweb.test
+
+def no_dns(*args):
+    raise AssertionError("DNS lookup")
+socket.gethostbyname = no_dns
+
+foxs = saliweb.test.import_mocked_frontend("foxs", %r, '../../frontend')
+for page in ('/', '/about', '/faq', '/help'):
+    assert foxs.app.test_client().get(page).status_code == 200
+print(sorted(m for m in sys.modules if m.split('.')[0] == 'bokeh'))
+"""
+
+
 class Tests(saliweb.test.TestCase):
 
+    def test_lazy_imports(self):
+        """Test that static pages don't need Bokeh or a DNS lookup"""
+        out = subprocess.check_output(
+            [sys.executable, '-c', LAZY_IMPORT_SCRIPT % __file__],
+            universal_newlines=True)
+        self.assertEqual(out.strip(), '[]')
+
     def test_index(self):
         """Test index page"""
         c = foxs.app.test_client()
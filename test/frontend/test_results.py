@@ -1,12 +1,44 @@
 import unittest
 import saliweb.test
 import re
+import os
+import json
+import tempfile
+import importlib
+import struct
+import numpy
 
 # Import the foxs frontend with mocks
 foxs = saliweb.test.import_mocked_frontend("foxs", __file__,
                                            '../../frontend')
 
 
+def make_ensemble_profiles(directory, offset=False):
+    """Make the profiles for fitting ensembles of three structures. The
+       experimental profile is best fit by the first two, at c2 = 1."""
+    q = numpy.linspace(0.01, 0.5, 40)
+    decay = numpy.exp(-q * q * 400.)
+    slow = numpy.exp(-q * q * 100.)
+    hydration = q * numpy.exp(-q * q * 40.)
+    partials = numpy.array([
+        numpy.column_stack([100. * d + 1., 30. * d + 0.1, 50. * d + 0.2,
+                            5. * hydration, 10. * hydration, 8. * hydration])
+        for d in (decay, slow, numpy.exp(-q * 5.))])
+    # Profile of each structure at c1 = 1 (so g = 1), c2 = 1
+    models = (partials[:, :, 0] + partials[:, :, 1] - 2. * partials[:, :, 2]
+              + partials[:, :, 3] + 2. * partials[:, :, 4]
+              - 2. * partials[:, :, 5])
+    intensity = 2. * (0.3 * models[0] + 0.7 * models[1]) + 5.
+    if not offset:
+        intensity -= 5.
+    numpy.savez(os.path.join(directory, 'ensemble-profiles.npz'),
+                structures=numpy.array(['1.pdb', '2.pdb', '3.pdb']),
+                partials=partials, q=q, intensity=intensity,
+                error=0.01 * intensity, c1=numpy.array([1.0]),
+                c2=numpy.array([0., 1., 2.]), g=numpy.ones((3, 1, len(q))),
+                offset=offset)
+
+
 class Tests(saliweb.test.TestCase):
     """Check results page"""
 
@@ -18,6 +50,357 @@ class Tests(saliweb.test.TestCase):
             rv = c.get('/job/testjob/output.pdb?passwd=%s' % j.passwd)
             self.assertEqual(rv.status_code, 200)
 
+    def test_results_file_submodel(self):
+        """Test download of submodels of multi-model PDB files"""
+        with saliweb.test.make_frontend_job('testsubmodel') as j:
+            j.make_file('multi.pdb', "HEADER\nMODEL 1\nATOM 1\nENDMDL\n"
+                                     "MODEL 2\nATOM 2\nENDMDL\nEND\n")
+            j.make_file('submodel-ranges.txt',
+                        "multi_m1.pdb multi.pdb 15 29\n"
+                        "multi_m2.pdb multi.pdb 37 55\n")
+            c = foxs.app.test_client()
+            url = '/job/testsubmodel/%s?passwd=' + j.passwd
+            rv = c.get(url % 'multi_m2.pdb')
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.data, b"ATOM 2\nEND\n")
+            # File should now be written out
+            fname = os.path.join(j.directory, 'multi_m2.pdb')
+            with open(fname, 'rb') as fh:
+                self.assertEqual(fh.read(), b"ATOM 2\nEND\n")
+            rv = c.get(url % 'multi_m3.pdb')
+            self.assertEqual(rv.status_code, 404)
+            # If the file cannot be written, the submodel is still sent
+            os.mkdir(os.path.join(j.directory,
+                                  'multi_m1.pdb.%d.tmp' % os.getpid()))
+            rv = c.get(url % 'multi_m1.pdb')
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.data, b"ATOM 1\n")
+            self.assertFalse(os.path.exists(
+                os.path.join(j.directory, 'multi_m1.pdb')))
+
+    def test_results_file_caching(self):
+        """Test caching, range and gzip support for results files"""
+        with saliweb.test.make_frontend_job('testjob17') as j:
+            j.make_file('output.dat', '0123456789')
+            j.make_file('output.dat.gz', 'compressed')
+            c = foxs.app.test_client()
+            url = '/job/testjob17/output.dat?passwd=%s' % j.passwd
+            rv = c.get(url)
+            self.assertEqual(rv.data, b'0123456789')
+            self.assertIsNone(rv.headers.get('Content-Encoding'))
+            self.assertTrue(rv.cache_control.immutable)
+            self.assertTrue(rv.cache_control.private)
+            self.assertIn('Accept-Encoding', rv.vary)
+            etag = rv.headers['ETag']
+            rv = c.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(rv.status_code, 304)
+            rv = c.get(url, headers={'Range': 'bytes=2-4'})
+            self.assertEqual(rv.status_code, 206)
+            self.assertEqual(rv.data, b'234')
+            # Compressed copy should be sent only to clients that accept it
+            rv = c.get(url, headers={'Accept-Encoding': 'gzip, deflate'})
+            self.assertEqual(rv.data, b'compressed')
+            self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+            self.assertNotEqual(rv.headers['ETag'], etag)
+            # Byte ranges refer to the original, so send that
+            rv = c.get(url, headers={'Accept-Encoding': 'gzip',
+                                     'Range': 'bytes=2-4'})
+            self.assertEqual(rv.status_code, 206)
+            self.assertEqual(rv.data, b'234')
+            self.assertIsNone(rv.headers.get('Content-Encoding'))
+            self.assertIn('Accept-Encoding', rv.vary)
+            rv = c.get('/job/testjob17/other.dat.gz?passwd=%s' % j.passwd,
+                       headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(rv.status_code, 404)
+
+    def test_plot_data(self):
+        """Test compact profile data for client-side plotting"""
+        with saliweb.test.make_frontend_job('testjob18') as j:
+            j.make_file('test.fit', "# q exp err fit\n"
+                        + "".join("%f %f 0.1 %f\n" % (0.01 * i, 100. - i, 99.)
+                                  for i in range(40)))
+            j.make_file('test.pdb')
+            c = foxs.app.test_client()
+            rv = c.get('/job/testjob18/plotdata/test.fit?passwd=%s'
+                       % j.passwd)
+            self.assertEqual(rv.status_code, 200)
+            self.assertTrue(rv.cache_control.immutable)
+            nrow, ncol = struct.unpack('<II', rv.data[:8])
+            self.assertEqual((nrow, ncol), (40, 4))
+            self.assertEqual(len(rv.data), 8 + 40 * 4 * 4)
+            self.assertAlmostEqual(
+                struct.unpack('<f', rv.data[8 + 17 * 4:8 + 18 * 4])[0],
+                96.0)
+            # Profile should be decimated to requested number of points
+            rv = c.get('/job/testjob18/plotdata/test.fit?passwd=%s&points=10'
+                       % j.passwd)
+            nrow, ncol = struct.unpack('<II', rv.data[:8])
+            self.assertEqual((nrow, ncol), (10, 4))
+            # Experimental profiles are read from their binary form
+            j.make_file('exp.dat', "# profile\n0.1 2.0 x\n")
+            numpy.save(os.path.join(j.directory, 'exp.dat.npy'),
+                       numpy.array([[0.1, 2.0, numpy.nan],
+                                    [0.2, 3.0, numpy.nan]]))
+            rv = c.get('/job/testjob18/plotdata/exp.dat?passwd=%s'
+                       % j.passwd)
+            nrow, ncol = struct.unpack('<II', rv.data[:8])
+            self.assertEqual((nrow, ncol), (2, 2))
+            for fname in ('test.pdb', 'missing.dat', '../test.dat'):
+                rv = c.get('/job/testjob18/plotdata/%s?passwd=%s'
+                           % (fname, j.passwd))
+                self.assertEqual(rv.status_code, 404)
+
+    def test_job_no_jmoltable(self):
+        """Test display of job with no Jmol table (shared profiles)"""
+        with saliweb.test.make_frontend_job('testjobnojmol') as j:
+            j.make_file(
+                'data.txt',
+                "1abc.pdb - EMAIL 0.50 500 1 1 1 0 0 0 0.00 1.00 3 1 0 1\n")
+            j.make_file('inputFiles.txt', "1abc.pdb\n")
+            j.make_file('1abc.png')
+            j.make_file('foxs.log', "\n")
+
+            c = foxs.app.test_client()
+            rv = c.get('/job/testjobnojmol?passwd=%s' % j.passwd)
+            self.assertEqual(rv.status_code, 200)
+            self.assertIn(b'plot of profile', rv.data)
+
+    def test_job_landscape(self):
+        """Test display of job with a c1/c2 parameter scan"""
+        with saliweb.test.make_frontend_job('testjobscan') as j:
+            j.make_file(
+                'data.txt',
+                "1abc.pdb p1.dat EMAIL 0.50 500 1 1 1 0 0 0 0.00 1.00 3 1 "
+                "0 0 1\n")
+            j.make_file('inputFiles.txt', "1abc.pdb\n2xyz.pdb\n")
+            j.make_file('1abc_p1.png')
+            j.make_file(
+                'foxs.log',
+                "1abc.pdb p1.dat Chi^2 = 0.2 c1 = 1.01 c2 = 0.58 "
+                "default chi^2 = 0.3\n"
+                "2xyz.pdb p1.dat Chi^2 = 0.4 c1 = 1.0 c2 = 0.5 "
+                "default chi^2 = 0.5\n")
+            numpy.savez(os.path.join(j.directory, 'chi-landscape.npz'),
+                        c1=numpy.array([0.95, 1.0, 1.05]),
+                        c2=numpy.array([0.0, 2.0]),
+                        chi2=numpy.arange(12.).reshape((2, 3, 2)),
+                        structures=numpy.array(['1abc.pdb', '2xyz.pdb']))
+            c = foxs.app.test_client()
+            rv = c.get('/job/testjobscan/old?passwd=%s' % j.passwd)
+            self.assertEqual(rv.status_code, 200)
+            self.assertIn(b'new FoxsHeatmap("landscapeplot", '
+                          b'[0.95, 1.0, 1.05]', rv.data)
+            self.assertIn(b'<option value="/job/testjobscan/landscape/1?',
+                          rv.data)
+            # Reported fits, from the log, are marked on the landscape
+            self.assertIn(b'var landscapeFits = [[0.2, 1.01, 0.58], '
+                          b'[0.4, 1.0, 0.5]];', rv.data)
+
+            rv = c.get('/job/testjobscan/landscape/1?passwd=%s' % j.passwd)
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(struct.unpack('<II', rv.data[:8]), (3, 2))
+            self.assertEqual(
+                struct.unpack('<6f', rv.data[8:]),
+                (6., 7., 8., 9., 10., 11.))
+            rv = c.get('/job/testjobscan/landscape/2?passwd=%s' % j.passwd)
+            self.assertEqual(rv.status_code, 404)
+
+    def test_job_multi_profile(self):
+        """Test display of job with multiple profiles"""
+        with saliweb.test.make_frontend_job('testjobmultiprof') as j:
+            j.make_file(
+                'data.txt',
+                "1abc.pdb p1.dat EMAIL 0.50 500 1 1 1 0 0 0 0.00 1.00 3 1\n")
+            j.make_file('inputFiles.txt', "1abc.pdb\n2xyz.pdb\n")
+            j.make_file('foxs.log', "\n")
+            j.make_file('chi-matrix.json', json.dumps(
+                {'profiles': ['p1.dat', 'p2.dat'],
+                 'structures': ['1abc.pdb', '2xyz.pdb'],
+                 'fits': [[[1.5, 1.0, 0.5], [0.9, 1.01, 0.2]],
+                          [[2.25, 1.0, 0.5], [3.0, 1.02, 0.3]]],
+                 'ensembles': [{'1': 0.8, '2': 0.7}, {'1': 2.1}]}))
+            c = foxs.app.test_client()
+            rv = c.get('/job/testjobmultiprof?passwd=%s' % j.passwd)
+            self.assertEqual(rv.status_code, 200)
+            r = re.compile(rb'p1\.dat.*p2\.dat.*1abc\.pdb.*1\.500.*'
+                           rb'<b>2\.250</b>.*2xyz\.pdb.*<b>0\.900</b>.*'
+                           rb'3\.000.*2xyz_p2\.dat.*'
+                           rb'MultiFoXS, 1 state.*0\.800.*2\.100.*'
+                           rb'MultiFoXS, 2 states.*'
+                           rb'p1_multifoxs/ensembles_size_2\.txt.*0\.700',
+                           re.DOTALL | re.MULTILINE)
+            self.assertRegex(rv.data, r)
+            self.assertIn(b'/job/testjobmultiprof/refit', rv.data)
+
+    def test_refit(self):
+        """Test refit of a completed job"""
+        partial = "# partial\n0.0 1.0 2.0 3.0 4.0 5.0 6.0\n"
+        with tempfile.TemporaryDirectory() as incoming:
+            foxs.app.config['DIRECTORIES_INCOMING'] = incoming
+            with saliweb.test.make_frontend_job('testrefit') as j:
+                j.make_file('data.txt',
+                            "1abc.pdb test.profile EMAIL 0.50 500 1 1 1 0 0 "
+                            "0 0.00 1.00 3 1\n")
+                j.make_file('inputFiles.txt', "1abc.pdb\n2xyz.pdb\n")
+                for fname in ('1abc.pdb', '2xyz.pdb', 'test.profile',
+                              'test.profile.npy'):
+                    j.make_file(fname)
+                j.make_file('1abc.pdb.dat', partial)
+                c = foxs.app.test_client()
+                url = '/job/testrefit/refit?passwd=%s' % j.passwd
+                # Partial profile missing
+                rv = c.post(url, data={})
+                self.assertEqual(rv.status_code, 400)
+                self.assertIn(b'cannot be refit', rv.data)
+                self.assertEqual(os.listdir(incoming), [])
+
+                j.make_file('2xyz.pdb.dat', partial)
+                rv = c.post(url, data={'hlayer': 'on', 'c1': '1.02',
+                                       'offset': 'on'})
+                self.assertEqual(rv.status_code, 503)
+                newjob, = os.listdir(incoming)
+                newdir = os.path.join(incoming, newjob)
+                self.assertEqual(sorted(os.listdir(newdir)),
+                                 ['1abc.pdb', '1abc.pdb.dat', '2xyz.pdb',
+                                  '2xyz.pdb.dat', 'data.txt',
+                                  'inputFiles.txt', 'refit-from.txt',
+                                  'test.profile', 'test.profile.npy'])
+                with open(os.path.join(newdir, 'data.txt')) as fh:
+                    self.assertEqual(
+                        fh.read(), "1abc.pdb test.profile - 0.50 500 1 0 1 "
+                        "0 1 0 0.00 1.02 3 1 0\n")
+                with open(os.path.join(newdir, 'refit-from.txt')) as fh:
+                    self.assertEqual(fh.read(), 'testrefit\n')
+
+    def test_refit_submodels(self):
+        """Test refit of a job with submodels of a multi-model PDB file"""
+        partial = "# partial\n0.0 1.0 2.0 3.0 4.0 5.0 6.0\n"
+        with tempfile.TemporaryDirectory() as incoming:
+            foxs.app.config['DIRECTORIES_INCOMING'] = incoming
+            with saliweb.test.make_frontend_job('testrefitsub') as j:
+                j.make_file('data.txt',
+                            "multi.pdb test.profile EMAIL 0.50 500 1 1 1 0 0 "
+                            "0 0.00 1.00 2 1\n")
+                j.make_file('inputFiles.txt', "multi.pdb\n")
+                j.make_file('multi-model-files.txt',
+                            "multi_m1.pdb\nmulti_m2.pdb")
+                j.make_file('submodel-ranges.txt',
+                            "multi_m1.pdb multi.pdb 15 29\n"
+                            "multi_m2.pdb multi.pdb 37 55\n")
+                for fname in ('multi.pdb', 'test.profile'):
+                    j.make_file(fname)
+                for fname in ('multi_m1.pdb.dat', 'multi_m2.pdb.dat'):
+                    j.make_file(fname, partial)
+                c = foxs.app.test_client()
+                rv = c.post('/job/testrefitsub/refit?passwd=%s' % j.passwd,
+                            data={})
+                self.assertEqual(rv.status_code, 503)
+                newjob, = os.listdir(incoming)
+                # Submodels can be written out from the new job's copy of
+                # the multi-model file
+                self.assertEqual(
+                    sorted(os.listdir(os.path.join(incoming, newjob))),
+                    ['data.txt', 'inputFiles.txt', 'multi.pdb',
+                     'multi_m1.pdb.dat', 'multi_m2.pdb.dat', 'refit-from.txt',
+                     'submodel-ranges.txt', 'test.profile'])
+
+    def test_refit_pool_options(self):
+        """Test that refit keeps the options for the MultiFoXS pool"""
+        partial = "# partial\n0.0 1.0 2.0 3.0 4.0 5.0 6.0\n"
+        with tempfile.TemporaryDirectory() as incoming:
+            foxs.app.config['DIRECTORIES_INCOMING'] = incoming
+            with saliweb.test.make_frontend_job('testrefitpool') as j:
+                j.make_file('data.txt',
+                            "1abc.pdb test.profile EMAIL 0.50 500 1 1 1 0 0 "
+                            "0 0.00 1.00 3 1 0 0 0 1.50 20 1\n")
+                j.make_file('inputFiles.txt', "1abc.pdb\n2xyz.pdb\n")
+                for fname in ('1abc.pdb', '2xyz.pdb', 'test.profile'):
+                    j.make_file(fname)
+                for fname in ('1abc.pdb.dat', '2xyz.pdb.dat'):
+                    j.make_file(fname, partial)
+                c = foxs.app.test_client()
+                rv = c.post('/job/testrefitpool/refit?passwd=%s' % j.passwd,
+                            data={})
+                self.assertEqual(rv.status_code, 503)
+                newjob, = os.listdir(incoming)
+                with open(os.path.join(incoming, newjob, 'data.txt')) as fh:
+                    self.assertEqual(fh.read().split()[15:],
+                                     ['0', '0', '0', '1.50', '20', '1'])
+
+    def test_refit_fail(self):
+        """Test refit of jobs that can't be refit"""
+        with tempfile.TemporaryDirectory() as incoming:
+            foxs.app.config['DIRECTORIES_INCOMING'] = incoming
+            for data, msg in (("1abc.pdb - EMAIL 0.50 500 1 1 1 0 0 0 0.00 "
+                               "1.00 3 1\n", b'Only jobs with an'),
+                              ("1abc.pdb p EMAIL 0.50 500 1 1 1 0 0 0 0.00 "
+                               "1.00 3 1 1\n", b'Batch mode jobs cannot'),
+                              ("1abc.pdb p EMAIL 0.50 500 1 1 1 0 0 1 0.00 "
+                               "1.00 3 1\n", b'background adjustment')):
+                with saliweb.test.make_frontend_job('testrefitfail') as j:
+                    j.make_file('data.txt', data)
+                    c = foxs.app.test_client()
+                    rv = c.post('/job/testrefitfail/refit?passwd=%s'
+                                % j.passwd)
+                    self.assertEqual(rv.status_code, 400)
+                    self.assertIn(msg, rv.data)
+
+    def test_continue(self):
+        """Test continuing the ensemble search of a completed job"""
+        with tempfile.TemporaryDirectory() as incoming:
+            foxs.app.config['DIRECTORIES_INCOMING'] = incoming
+            with saliweb.test.make_frontend_job('testcont') as j:
+                c = foxs.app.test_client()
+                url = '/job/testcont/continue?passwd=%s' % j.passwd
+                rv = c.post(url, data={'size': '6'})
+                self.assertEqual(rv.status_code, 400)
+                self.assertIn(b'no MultiFoXS ensembles', rv.data)
+
+                j.make_file('data.txt',
+                            "1abc.pdb test.profile EMAIL 0.50 500 1 1 1 0 0 "
+                            "0 0.00 1.00 3 1\n")
+                j.make_file('foxs.log', 'fits\n')
+                j.make_file('filenames2.txt', "".join(
+                    "%d.pdb.dat\n" % i for i in range(8)))
+                for i in range(8):
+                    j.make_file('%d.pdb.dat' % i)
+                for size in range(1, 6):
+                    j.make_file('ensembles_size_%d.txt' % size)
+                for fname in ('test_v.dat', 'chis', 'chis.png',
+                              'multi_state_model_1_1_1.fit', 'rg',
+                              'foxs.log.gz', 'job-state',
+                              'filenames-merged.txt'):
+                    j.make_file(fname)
+                os.mkdir(os.path.join(j.directory, 'sub'))
+                j.make_file('sub/foo.dat')
+
+                rv = c.post(url, data={'size': '5'})
+                self.assertEqual(rv.status_code, 400)
+                self.assertIn(b'up to 5 structures were already', rv.data)
+                rv = c.post(url, data={'size': '9'})
+                self.assertEqual(rv.status_code, 400)
+                self.assertIn(b'at most 8 structures', rv.data)
+                self.assertEqual(os.listdir(incoming), [])
+
+                rv = c.post(url, data={'size': '7'})
+                self.assertEqual(rv.status_code, 503)
+                newjob, = os.listdir(incoming)
+                newdir = os.path.join(incoming, newjob)
+                self.assertEqual(
+                    sorted(os.listdir(newdir)),
+                    ['%d.pdb.dat' % i for i in range(8)]
+                    + ['continue-from.txt', 'data.txt', 'filenames2.txt',
+                       'foxs.log', 'rg', 'sub', 'test_v.dat'])
+                self.assertTrue(os.path.exists(
+                    os.path.join(newdir, 'sub', 'foo.dat')))
+                # The log is written to by the backend, so is not linked
+                self.assertEqual(os.stat(j.directory + '/0.pdb.dat').st_nlink,
+                                 2)
+                self.assertEqual(os.stat(j.directory + '/foxs.log').st_nlink,
+                                 1)
+                with open(os.path.join(newdir, 'continue-from.txt')) as fh:
+                    self.assertEqual(fh.read(), 'testcont 7\n')
+
     def test_job_one_pdb_old(self):
         """Test display of job with one PDB, no profile (old view)"""
         with saliweb.test.make_frontend_job('testjob2') as j:
@@ -38,6 +421,22 @@ class Tests(saliweb.test.TestCase):
                            re.DOTALL | re.MULTILINE)
             self.assertRegex(rv.data, r)
 
+            # Page should not be sent again if the client has it cached
+            etag = rv.headers['ETag']
+            self.assertTrue(rv.cache_control.no_cache)
+            rv = c.get('/job/testjob2/old?passwd=%s' % j.passwd,
+                       headers={'If-None-Match': etag})
+            self.assertEqual(rv.status_code, 304)
+            self.assertEqual(rv.data, b'')
+            # Different page, or logged-in user, should have a different tag
+            rv = c.get('/job/testjob2/old?passwd=%s&page=2' % j.passwd,
+                       headers={'If-None-Match': etag})
+            self.assertEqual(rv.status_code, 200)
+            c.set_cookie('session', 'foo')
+            rv = c.get('/job/testjob2/old?passwd=%s' % j.passwd,
+                       headers={'If-None-Match': etag})
+            self.assertEqual(rv.status_code, 200)
+
     def test_job_failed_no_pngs(self):
         """Test display of job that failed to produce any .png files"""
         with saliweb.test.make_frontend_job('testjob10') as j:
@@ -57,6 +456,24 @@ class Tests(saliweb.test.TestCase):
                            re.DOTALL | re.MULTILINE)
             self.assertRegex(rv.data, r)
 
+    def test_job_failed_validation(self):
+        """Test display of job with inputs rejected by the backend"""
+        with saliweb.test.make_frontend_job('testjob13') as j:
+            j.make_file(
+                'data.txt',
+                "1abc.pdb - EMAIL 0.50 500 1 1 1 0 0 0 0.00 1.00 3 1\n")
+            j.make_file('validation-error.txt',
+                        "PDB file 1abc.pdb contains no ATOM or HETATM "
+                        "records\n")
+
+            c = foxs.app.test_client()
+            rv = c.get('/job/testjob13?passwd=%s' % j.passwd)
+            r = re.compile(b'PDB files.*Profile file.*User e-mail.*'
+                           b'problem with the inputs to your job.*'
+                           rb'PDB file 1abc\.pdb contains no ATOM',
+                           re.DOTALL | re.MULTILINE)
+            self.assertRegex(rv.data, r)
+
     def test_job_failed(self):
         """Test display of job that failed to plot"""
         with saliweb.test.make_frontend_job('testjob11') as j:
@@ -105,6 +522,92 @@ class Tests(saliweb.test.TestCase):
                            re.DOTALL | re.MULTILINE)
             self.assertRegex(rv.data, r)
 
+    def test_job_unfitted_structure(self):
+        """Test display of job with a structure that was not fit"""
+        with saliweb.test.make_frontend_job('testjobnofit') as j:
+            j.make_file(
+                'data.txt',
+                "in.zip test.profile EMAIL 0.50 500 1 1 1 0 0 0 0.00 1.00 "
+                "3 1\n")
+            j.make_file('inputFiles.txt', "1abc.pdb\n1xyz.pdb\n")
+            j.make_file('1abc.png')
+            j.make_file('1xyz_test.png')
+            # FoXS failed on 1abc.pdb, so there is no fit line for it
+            j.make_file('foxs.log',
+                        "1xyz.pdb test.profile Chi^2 = 0.3 c1 = 1.02 "
+                        "c2 = 0.6 default chi^2 = 0.28\n")
+            j.make_file('jmoltable.html', "\n")
+            c = foxs.app.test_client()
+            url = '/job/testjobnofit/old?passwd=%s' % j.passwd
+            for sort in ('', '&sort=chi', '&sort=name'):
+                rv = c.get(url + sort)
+                self.assertEqual(rv.status_code, 200)
+                self.assertIn(b'<td colspan="4">not fit</td>', rv.data)
+                self.assertIn(b'<b>1abc</b> could not be fit', rv.data)
+                self.assertIn(b'1xyz Fit to experimental profile', rv.data)
+            rv = c.get('/job/testjobnofit?passwd=%s' % j.passwd)
+            self.assertEqual(rv.status_code, 200)
+            # Experimental profile is taken from the first fit
+            self.assertRegex(rv.data, re.compile(
+                rb'1xyz_test\.dat[^\n]*\n *y: 1, points: true', re.DOTALL))
+
+    def test_job_jmol_template(self):
+        """Test display of job with a preprocessed Jmol table"""
+        with saliweb.test.make_frontend_job('testjob16') as j:
+            j.make_file(
+                'data.txt',
+                "1abc.pdb - EMAIL 0.50 500 1 1 1 0 0 0 0.00 1.00 3 1\n")
+            j.make_file('inputFiles.txt', "1abc.pdb\n")
+            j.make_file('1abc.png')
+            j.make_file('foxs.log', "\n")
+            j.make_file('jmoltable.html', "\n")
+            j.make_file('jmoltable.tmpl',
+                        'load "{{file:jmoltable.pdb}}"\n'
+                        '<a href="{{file:foo.dat}}">foo</a>\n'
+                        '<a href="{{help:c1c2}}">\n')
+
+            c = foxs.app.test_client()
+            rv = c.get('/job/testjob16?passwd=%s' % j.passwd)
+            r = re.compile(rb'load "[^"]*testjob16\/jmoltable\.pdb.*'
+                           rb'testjob16\/foo\.dat.*'
+                           rb'help.*#c1c2" title="'
+                           b'This value may indicate data overfitting',
+                           re.DOTALL | re.MULTILINE)
+            self.assertRegex(rv.data, r)
+
+    def test_job_batch(self):
+        """Test display of batch mode job"""
+        with saliweb.test.make_frontend_job('testjob14') as j:
+            j.make_file('data.txt',
+                        "in.zip test.profile EMAIL 0.50 "
+                        "500 1 1 1 0 0 0 0.00 1.00 3 1 1\n")
+            lines = ["s%d.pdb %d.0 1.01 0.50\n" % (i, 200 - i)
+                     for i in range(120)]
+            j.make_file('batch-summary.txt', "".join(lines))
+            offsets = [sum(len(x) for x in lines[:i]) for i in range(120)]
+            j.make_file('batch-summary.idx',
+                        "".join("%012d\n" % x for x in reversed(offsets)))
+            j.make_file('s119_test.dat')
+
+            c = foxs.app.test_client()
+            rv = c.get('/job/testjob14?passwd=%s' % j.passwd)
+            r = re.compile(b'120 structures were fit.*'
+                           rb'Page 1 of 3.*next.*'
+                           rb'<td>1</td>\s*<td>s119\.pdb</td>\s*'
+                           rb'<td>81\.0</td>.*s119_test\.dat.*'
+                           rb'<td>50</td>\s*<td>s70\.pdb</td>',
+                           re.DOTALL | re.MULTILINE)
+            self.assertRegex(rv.data, r)
+            self.assertNotIn(b's69.pdb', rv.data)
+
+            rv = c.get('/job/testjob14?passwd=%s&page=3' % j.passwd)
+            r = re.compile(rb'previous.*Page 3 of 3.*'
+                           rb'<td>101</td>\s*<td>s19\.pdb</td>.*'
+                           rb'<td>120</td>\s*<td>s0\.pdb</td>',
+                           re.DOTALL | re.MULTILINE)
+            self.assertRegex(rv.data, r)
+            self.assertNotIn(b'next', rv.data)
+
     def test_job_one_pdb_profile_old(self):
         """Test display of job with one PDB, fit to a profile (old view)"""
         with saliweb.test.make_frontend_job('testjob4') as j:
@@ -177,6 +680,34 @@ class Tests(saliweb.test.TestCase):
                            re.DOTALL | re.MULTILINE)
             self.assertRegex(rv.data, r)
 
+    def test_job_summary(self):
+        """Test display of job using the backend-generated summary"""
+        with saliweb.test.make_frontend_job('testjob15') as j:
+            # Summary should be used in preference to the output files
+            j.make_file('data.txt',
+                        "1abc.pdb test.profile EMAIL 0.50 "
+                        "500 1 1 1 0 0 0 0.00 1.00 3 1\n")
+            summary = {'pdb': '1abc.pdb', 'profile': 'test.profile',
+                       'error': None, 'pdb_files': ['1abc.pdb'],
+                       'fits': {'1abc.pdb': ['0.5', '1.02', '0.6']},
+                       'pngs': ['1abc_test.png']}
+            j.make_file('summary.json', json.dumps(summary))
+
+            c = foxs.app.test_client()
+            rv = c.get('/job/testjob15/old?passwd=%s' % j.passwd)
+            self.assertIn(b'&chi;<sup>2</sup> = 0.5 c1 = 1.02 c2 = 0.6',
+                          rv.data)
+
+            # Updated summary should not be served from the cache
+            summary['fits']['1abc.pdb'] = ['0.7', '1.03', '0.8']
+            j.make_file('summary.json', json.dumps(summary))
+            fname = os.path.join(j.directory, 'summary.json')
+            st = os.stat(fname)
+            os.utime(fname, (st.st_atime, st.st_mtime + 10))
+            rv = c.get('/job/testjob15/old?passwd=%s' % j.passwd)
+            self.assertIn(b'&chi;<sup>2</sup> = 0.7 c1 = 1.03 c2 = 0.8',
+                          rv.data)
+
     def test_job_two_pdbs_old(self):
         """Test display of job with two PDBs, no profile (old view)"""
         with saliweb.test.make_frontend_job('testjob6') as j:
@@ -236,6 +767,186 @@ class Tests(saliweb.test.TestCase):
                            re.DOTALL | re.MULTILINE)
             self.assertRegex(rv.data, r)
 
+    def test_job_many_pdbs_profile_old(self):
+        """Test paginated, sorted display of job with many PDBs"""
+        with saliweb.test.make_frontend_job('testjob19') as j:
+            j.make_file('data.txt',
+                        "in.zip test.profile EMAIL 0.50 500 "
+                        "1 1 1 0 0 0 0.00 1.00 3 1\n")
+            pdbs = ["s%02d.pdb" % i for i in range(25)]
+            j.make_file('inputFiles.txt', "\n".join(pdbs))
+            j.make_file('s00_test.png')
+            # Best fit (lowest chi) is the last structure
+            j.make_file('foxs.log', "".join(
+                "%s test.profile Chi^2 = %d.5 c1 = 1.0%d c2 = 0.5 "
+                "default chi^2 = 1.0\n" % (pdb, 30 - i, i % 10)
+                for i, pdb in enumerate(pdbs)))
+            c = foxs.app.test_client()
+            url = '/job/testjob19/old?passwd=%s' % j.passwd
+            rv = c.get(url)
+            self.assertIn(b'25 structures were fit', rv.data)
+            self.assertIn(b'Page 1 of 2', rv.data)
+            self.assertEqual(rv.data.count(b'plot of fit'), 20)
+            self.assertIn(b'loading="lazy"', rv.data)
+            r = re.compile(b's24 Fit.*s23 Fit.*s05 Fit', re.DOTALL)
+            self.assertRegex(rv.data, r)
+            self.assertNotIn(b's04 Fit', rv.data)
+
+            rv = c.get(url + '&page=2')
+            self.assertIn(b'Page 2 of 2', rv.data)
+            self.assertEqual(rv.data.count(b'plot of fit'), 5)
+            self.assertRegex(rv.data,
+                             re.compile(b's04 Fit.*s00 Fit', re.DOTALL))
+
+            rv = c.get(url + '&sort=name')
+            self.assertRegex(rv.data,
+                             re.compile(b's00 Fit.*s19 Fit', re.DOTALL))
+            self.assertNotIn(b's20 Fit', rv.data)
+
+            rv = c.get(url + '&sort=c1')
+            self.assertRegex(rv.data,
+                             re.compile(b's00 Fit.*s10 Fit.*s20 Fit.*s01 Fit',
+                                        re.DOTALL))
+
+            # Unknown sort key or page should show the default
+            rv = c.get(url + '&sort=garbage&page=100')
+            self.assertIn(b'Page 2 of 2', rv.data)
+            self.assertIn(b's00 Fit', rv.data)
+
+    def test_sort_pdb_files(self):
+        """Test sort_pdb_files with structures that have no fit"""
+        summary = {'pdb_files': ['a.pdb', 'b.pdb', 'c.pdb', 'd.pdb'],
+                   'fits': {'b.pdb': ['2.0', '1.01', '0.5'],
+                            'd.pdb': ['1.0', '1.02', '0.1']}}
+        sort = foxs.results_page.sort_pdb_files
+        self.assertEqual(sort(summary, None),
+                         ['a.pdb', 'b.pdb', 'c.pdb', 'd.pdb'])
+        self.assertEqual(sort(summary, 'name'),
+                         ['a.pdb', 'b.pdb', 'c.pdb', 'd.pdb'])
+        self.assertEqual(sort(summary, 'chi'),
+                         ['d.pdb', 'b.pdb', 'a.pdb', 'c.pdb'])
+        self.assertEqual(sort(summary, 'c2'),
+                         ['d.pdb', 'b.pdb', 'a.pdb', 'c.pdb'])
+        self.assertEqual(sort(summary, 'c1'),
+                         ['b.pdb', 'd.pdb', 'a.pdb', 'c.pdb'])
+
+    def test_results_json(self):
+        """Test machine-readable results"""
+        with saliweb.test.make_frontend_job('testjob20') as j:
+            j.make_file('data.txt',
+                        "1abc.pdb test.profile EMAIL 0.50 500 "
+                        "1 1 1 0 0 0 0.00 1.00 3 1\n")
+            j.make_file('inputFiles.txt', "1abc.pdb\n1xyz.pdb")
+            j.make_file(
+                'foxs.log',
+                "1abc.pdb test.profile Chi^2 = 0.202144 c1 = 1.01131 "
+                "c2 = 0.5872 default chi^2 = 0.289123\n"
+                "1xyz.pdb test.profile Chi^2 = 0.302144 c1 = 1.02131 "
+                "c2 = 0.5972 default chi^2 = 0.279123\n")
+            j.make_file(
+                "ensembles_size_2.txt",
+                "1 |  6.37 | x1 6.37 (1.04, 0.50)\n"
+                "    0   | 0.497 (0.477, 0.029) | 1abc.pdb.dat (0.417)\n"
+                "    3   | 0.503 (0.504, 0.188) | 1xyz.pdb.dat (0.417)\n")
+            j.make_file('rg', '1abc.pdb Rg= 10.000\n')
+            c = foxs.app.test_client()
+            rv = c.get('/job/testjob20/results.json?passwd=%s' % j.passwd)
+            d = json.loads(rv.data)
+            self.assertEqual(d['profile'], 'test.profile')
+            self.assertFalse(d['batch'])
+            s1, s2 = d['structures']
+            self.assertEqual(s1['pdb_file'], '1abc.pdb')
+            self.assertAlmostEqual(s1['chi'], 0.202144, delta=1e-6)
+            self.assertAlmostEqual(s2['c2'], 0.5972, delta=1e-6)
+            self.assertTrue(s1['fit_url'].endswith('testjob20/1abc_test.dat'
+                                                   '?passwd=%s' % j.passwd))
+            self.assertAlmostEqual(s1['rg'], 10.0, delta=1e-6)
+            self.assertIsNone(s2['rg'])
+            e, = d['ensembles']
+            self.assertEqual(e['size'], 2)
+            self.assertAlmostEqual(e['score'], 6.37, delta=1e-6)
+            self.assertEqual([m['pdb_file'] for m in e['members']],
+                             ['1abc.pdb', '1xyz.pdb'])
+            self.assertAlmostEqual(e['members'][1]['weight'], 0.503,
+                                   delta=1e-6)
+
+            rv = c.get('/job/testjob20/results.ndjson?passwd=%s' % j.passwd)
+            self.assertEqual(rv.mimetype, 'application/x-ndjson')
+            recs = [json.loads(line) for line in rv.data.splitlines()]
+            self.assertEqual([r['type'] for r in recs],
+                             ['job', 'structure', 'structure', 'ensemble'])
+            self.assertEqual(recs[2]['pdb_file'], '1xyz.pdb')
+
+    def test_results_json_multi_profile(self):
+        """Test machine-readable results of a job with two profiles"""
+        with saliweb.test.make_frontend_job('testjobjsonmulti') as j:
+            j.make_file(
+                'data.txt',
+                "1abc.pdb p1.dat EMAIL 0.50 500 1 1 1 0 0 0 0.00 1.00 3 1\n")
+            j.make_file('profiles.txt', "p1.dat\np2.dat\n")
+            j.make_file('inputFiles.txt', "1abc.pdb\n2xyz.pdb\n")
+            j.make_file(
+                'foxs.log',
+                "1abc.pdb p1.dat Chi^2 = 1.5 c1 = 1.0 c2 = 0.5 x\n"
+                "2xyz.pdb p1.dat Chi^2 = 0.9 c1 = 1.01 c2 = 0.2 x\n"
+                "1abc.pdb p2.dat Chi^2 = 2.25 c1 = 1.0 c2 = 0.5 x\n"
+                "2xyz.pdb p2.dat Chi^2 = 3.0 c1 = 1.02 c2 = 0.3 x\n")
+            j.make_file('chi-matrix.json', json.dumps(
+                {'profiles': ['p1.dat', 'p2.dat'],
+                 'structures': ['1abc.pdb', '2xyz.pdb'],
+                 'fits': [[[1.5, 1.0, 0.5], [0.9, 1.01, 0.2]],
+                          [[2.25, 1.0, 0.5], [3.0, 1.02, 0.3]]],
+                 'ensembles': [{}, {}]}))
+            c = foxs.app.test_client()
+            rv = c.get('/job/testjobjsonmulti/results.json?passwd=%s'
+                       % j.passwd)
+            s1, s2 = json.loads(rv.data)['structures']
+            # The main fit is to the first profile, as is its fit file
+            self.assertAlmostEqual(s2['chi'], 0.9, delta=1e-6)
+            self.assertIn('/2xyz_p1.dat?', s2['fit_url'])
+            self.assertEqual([p['profile'] for p in s2['profiles']],
+                             ['p1.dat', 'p2.dat'])
+            self.assertAlmostEqual(s1['profiles'][0]['chi'], 1.5, delta=1e-6)
+            self.assertAlmostEqual(s1['profiles'][1]['chi'], 2.25,
+                                   delta=1e-6)
+            self.assertAlmostEqual(s2['profiles'][1]['chi'], 3.0, delta=1e-6)
+            self.assertAlmostEqual(s2['profiles'][1]['c1'], 1.02, delta=1e-6)
+            self.assertIn('/2xyz_p2.dat?', s2['profiles'][1]['fit_url'])
+
+    def test_results_ndjson_batch(self):
+        """Test machine-readable results of batch mode job"""
+        with saliweb.test.make_frontend_job('testjob21') as j:
+            j.make_file('data.txt',
+                        "in.zip test.profile EMAIL 0.50 "
+                        "500 1 1 1 0 0 0 0.00 1.00 3 1 1\n")
+            lines = ["s1.pdb 2.0 1.01 0.50\n", "s2.pdb 1.0 1.02 0.60\n"]
+            j.make_file('batch-summary.txt', "".join(lines))
+            j.make_file('batch-summary.idx',
+                        "%012d\n%012d\n" % (len(lines[0]), 0))
+            j.make_file('s2_test.dat')
+            c = foxs.app.test_client()
+            rv = c.get('/job/testjob21/results.ndjson?passwd=%s' % j.passwd)
+            recs = [json.loads(line) for line in rv.data.splitlines()]
+            self.assertTrue(recs[0]['batch'])
+            self.assertEqual([r['pdb_file'] for r in recs[1:]],
+                             ['s2.pdb', 's1.pdb'])
+            self.assertIsNotNone(recs[1]['fit_url'])
+            self.assertIsNone(recs[2]['fit_url'])
+            self.assertIsNone(recs[2]['profile_url'])
+
+    def test_results_json_validation_failed(self):
+        """Test machine-readable results of job that failed validation"""
+        with saliweb.test.make_frontend_job('testjob22') as j:
+            j.make_file(
+                'data.txt',
+                "1abc.pdb - EMAIL 0.50 500 1 1 1 0 0 0 0.00 1.00 3 1\n")
+            j.make_file('validation-error.txt', "bad PDB\n")
+            c = foxs.app.test_client()
+            rv = c.get('/job/testjob22/results.json?passwd=%s' % j.passwd)
+            d = json.loads(rv.data)
+            self.assertEqual(d['error'], 'bad PDB')
+            self.assertEqual(d['structures'], [])
+
     def test_job_two_pdbs_profile_ensemble(self):
         """Test display of ensemble with two PDBs, fit to profile"""
         with saliweb.test.make_frontend_job('testjob8') as j:
@@ -255,16 +966,130 @@ class Tests(saliweb.test.TestCase):
             j.make_file('rg', '1abc.pdb Rg= 10.000\n'
                               '1xyz.pdb Rg= 20.000\n')
             j.make_file("chis", "1 1.16 1.58\n2 1.08 0.14\ngarbage\n\n")
+            j.make_file("filenames2.txt",
+                        "1abc.pdb.dat\n1xyz.pdb.dat\n2xyz.pdb.dat\n")
             c = foxs.app.test_client()
             rv = c.get('/job/testjob8/ensemble?passwd=%s' % j.passwd)
             r = re.compile(b'PDB files.*Profile file.*User e-mail.*'
                            rb'1abc\.pdb.*test\.profile.*test@test\.com.*'
                            b'models from MultiFoXS.*'
-                           rb'jsoutput\.3\.js.*'
-                           b'<canvas',
+                           b'<canvas.*'
+                           rb'plotdata/multi_state_model_1_1_1\.fit.*'
+                           rb'/job/testjob8/continue.*value="3".*at most 3',
                            re.DOTALL | re.MULTILINE)
             self.assertRegex(rv.data, r)
 
+            # Rendered chi plot should be cached in the job directory
+            cache = os.path.join(j.directory, 'chiplot.json')
+            with open(cache) as fh:
+                cached = json.load(fh)
+            cached['plot']['div'] = '<div id="cached-chi-plot"></div>'
+            with open(cache, 'w') as fh:
+                json.dump(cached, fh)
+            ensemble = importlib.import_module(foxs.__name__ + '.ensemble')
+            ensemble._get_cached_chi_plot.cache_clear()
+            rv = c.get('/job/testjob8/ensemble?passwd=%s' % j.passwd)
+            self.assertIn(b'cached-chi-plot', rv.data)
+
+    def test_job_continued_ensemble(self):
+        """Test display of ensembles of a continued search"""
+        with saliweb.test.make_frontend_job('testjobcont') as j:
+            j.make_file('data.txt',
+                        "1abc.pdb test.profile EMAIL 0.50 500 "
+                        "1 1 1 0 0 0 0.00 1.00 3 1\n")
+            j.make_file('continue-from.txt', "testjob8 6\n")
+            j.make_file(
+                "ensembles_size_6.txt",
+                "1 |  6.37 | x1 6.37 (1.04, 0.50)\n"
+                + "".join("    %d   | 0.1 (0.1, 0.1) | %d.pdb.dat (0.4)\n"
+                          % (i, i) for i in range(6)))
+            j.make_file('rg', "".join("%d.pdb Rg= 10.000\n" % i
+                                      for i in range(6)))
+            j.make_file("chis", "1 1.16 1.58\n6 1.08 0.14\n")
+            c = foxs.app.test_client()
+            rv = c.get('/job/testjobcont/ensemble?passwd=%s' % j.passwd)
+            self.assertIn(b'Best scoring 6-state model', rv.data)
+            self.assertIn(b'multi_state_model_6_1_1.fit', rv.data)
+            self.assertNotIn(b'Near-identical conformers', rv.data)
+
+            # Show conformers represented by others in MultiFoXS
+            j.make_file('conformer-groups.txt',
+                        "# RMSD threshold 1.50\n0.pdb 6.pdb 7.pdb\n"
+                        "1.pdb\n2.pdb 8.pdb\n")
+            rv = c.get('/job/testjobcont/ensemble?passwd=%s' % j.passwd)
+            r = re.compile(rb'Of the 6 conformers.*1\.50 &Aring;.*'
+                           rb'<td>0\.pdb</td><td>6\.pdb, 7\.pdb</td>.*'
+                           rb'<td>2\.pdb</td><td>8\.pdb</td>',
+                           re.DOTALL | re.MULTILINE)
+            self.assertRegex(rv.data, r)
+            self.assertNotIn(b'Profile clusters', rv.data)
+
+            # Show clusters of similar profiles
+            for refine in (0, 1):
+                j.make_file('profile-clusters.txt',
+                            "# k-medoids clusters 2 refine %d\n"
+                            "1.pdb.dat 0.pdb.dat\n2.pdb.dat\n" % refine)
+                rv = c.get('/job/testjobcont/ensemble?passwd=%s' % j.passwd)
+                r = re.compile(rb'profiles of 3 conformers.*into 2 clusters.*'
+                               rb'<td>1\.pdb</td><td>0\.pdb</td>.*'
+                               rb'<td>2\.pdb</td><td></td>',
+                               re.DOTALL | re.MULTILINE)
+                self.assertRegex(rv.data, r)
+                if refine:
+                    self.assertIn(b'second search', rv.data)
+                else:
+                    self.assertNotIn(b'second search', rv.data)
+            self.assertNotIn(b'Fit your own ensemble', rv.data)
+
+            # Fit user-chosen ensembles
+            make_ensemble_profiles(j.directory)
+            rv = c.get('/job/testjobcont/ensemble?passwd=%s' % j.passwd)
+            self.assertIn(b'Fit your own ensemble', rv.data)
+            self.assertIn(b'<option value="3.pdb">3.pdb</option>', rv.data)
+
+    def test_ensemble_fit(self):
+        """Test fit of user-chosen ensembles"""
+        for offset in (False, True):
+            with saliweb.test.make_frontend_job('testjobfit') as j:
+                c = foxs.app.test_client()
+                url = '/job/testjobfit/ensemble/fit?passwd=%s' % j.passwd
+                rv = c.get(url + '&structure=1.pdb')
+                self.assertEqual(rv.status_code, 400)
+                self.assertIn(b'cannot be fit for this job', rv.data)
+
+                make_ensemble_profiles(j.directory, offset)
+                for query, err in (
+                        ('', b'choose between 1 and 10 structures'),
+                        ('&structure=1.pdb' * 11,
+                         b'choose between 1 and 10 structures'),
+                        ('&structure=1.pdb&structure=1.pdb',
+                         b'can only be chosen once'),
+                        ('&structure=garbage', b'Unknown structure garbage')):
+                    rv = c.get(url + query)
+                    self.assertEqual(rv.status_code, 400)
+                    self.assertIn(err, rv.data)
+
+                rv = c.get(url + '&structure=2.pdb&structure=3.pdb'
+                           '&structure=1.pdb')
+                self.assertEqual(rv.status_code, 200)
+                fit = json.loads(rv.data)
+                self.assertEqual(fit['structures'],
+                                 ['2.pdb', '3.pdb', '1.pdb'])
+                self.assertAlmostEqual(fit['chi2'], 0., delta=1e-6)
+                self.assertAlmostEqual(fit['c1'], 1., delta=1e-6)
+                self.assertAlmostEqual(fit['c2'], 1., delta=1e-6)
+                self.assertAlmostEqual(fit['scale'], 2., delta=1e-4)
+                self.assertAlmostEqual(fit['offset'], 5. if offset else 0.,
+                                       delta=1e-3)
+                for weight, expected in zip(fit['weights'], [0.7, 0., 0.3]):
+                    self.assertAlmostEqual(weight, expected, delta=1e-4)
+
+                # A single structure fits less well
+                rv = c.get(url + '&structure=3.pdb')
+                fit = json.loads(rv.data)
+                self.assertGreater(fit['chi2'], 1.)
+                self.assertEqual(fit['weights'], [1.])
+
     def test_job_two_pdbs_profile_ensemble_bad(self):
         """Test display of ensemble with two PDBs, bad ensemble file"""
         with saliweb.test.make_frontend_job('testjob9') as j:
@@ -1,10 +1,15 @@
 import unittest
 import saliweb.test
+from saliweb.frontend import InputValidationError
 import tempfile
 import os
 import re
+import json
 import gzip
+import glob
 import zipfile
+import shutil
+from unittest import mock
 from flask import request, request_started
 import contextlib
 from werkzeug.datastructures import FileStorage
@@ -194,6 +199,52 @@ class Tests(saliweb.test.TestCase):
                            re.MULTILINE | re.DOTALL)
             self.assertRegex(rv.data, r)
 
+    def test_submit_deferred_validation(self):
+        """Test submit with validation deferred to the backend"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            incoming = os.path.join(tmpdir, 'incoming')
+            os.mkdir(incoming)
+            foxs.app.config['DIRECTORIES_INCOMING'] = incoming
+            foxs.app.config['FOXS_DEFERRED_VALIDATION'] = 'true'
+            try:
+                badf = os.path.join(tmpdir, 'bad.pdb')
+                with open(badf, 'w') as fh:
+                    fh.write("not a PDB")
+                # Invalid inputs are accepted; the backend will check them
+                c = foxs.app.test_client()
+                data = {'pdbfile': open(badf, 'rb'),
+                        'profile': open(badf, 'rb')}
+                rv = c.post('/job', data=data, follow_redirects=True)
+                self.assertEqual(rv.status_code, 503)
+                self.assertIn(b'Your job has been submitted', rv.data)
+                jobdir, = os.listdir(incoming)
+                with open(os.path.join(incoming, jobdir,
+                                       'validate.json')) as fh:
+                    req = json.load(fh)
+                self.assertTrue(req['structures'].endswith('bad.pdb'))
+                self.assertEqual(req['show_filename'], 'bad.pdb')
+                self.assertTrue(req['profile'].endswith('bad.pdb'))
+                self.assertEqual(req['max_structures'], 100)
+            finally:
+                del foxs.app.config['FOXS_DEFERRED_VALIDATION']
+
+    def test_check_profile(self):
+        """Test check_profile()"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'test.profile')
+            with open(fname, 'w', newline='') as fh:
+                fh.write("# sample profile\rgarbage\r0.1 -0.5 0.01 1 2\r"
+                         "0.2 0.5 x\r")
+            foxs.submit_page.check_profile(fname)
+            # Only line endings are changed in the text profile
+            with open(fname, newline='') as fh:
+                self.assertEqual(fh.read(), "# sample profile\ngarbage\n"
+                                 "0.1 -0.5 0.01 1 2\n0.2 0.5 x\n")
+            p = foxs.exp_profile.load_profile(fname)
+            self.assertEqual(p.shape, (2, 3))
+            self.assertAlmostEqual(p[0, 2], 0.01, delta=1e-6)
+            self.assertAlmostEqual(p[1, 1], 0.5, delta=1e-6)
+
     def test_submit_pdb_code_pdb(self):
         """Test submit with a PDB code (PDB format)"""
         with tempfile.TemporaryDirectory() as incoming:
@@ -248,6 +299,88 @@ class Tests(saliweb.test.TestCase):
                 self.assertEqual(rv.status_code, 503)
                 self.assertIn(b'Your job has been submitted', rv.data)
 
+    def test_submit_pdb_code_cached(self):
+        """Test submit with a PDB code using the PDB cache"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            incoming = os.path.join(tmpdir, 'incoming')
+            pdb_root = os.path.join(tmpdir, 'pdb')
+            cache = os.path.join(tmpdir, 'cache')
+            os.mkdir(incoming)
+            os.mkdir(pdb_root)
+            foxs.app.config['DIRECTORIES_INCOMING'] = incoming
+            foxs.app.config['PDB_ROOT'] = pdb_root
+            foxs.app.config['MMCIF_ROOT'] = pdb_root
+            foxs.app.config['IHM_ROOT'] = pdb_root
+            foxs.app.config['FOXS_PDB_CACHE'] = cache
+            try:
+                make_test_pdb(pdb_root)
+                c = foxs.app.test_client()
+                for i in range(2):
+                    rv = c.post('/job', data={'pdb': '1xyz:C'})
+                    self.assertEqual(rv.status_code, 503)
+                    # Cached copy should be used the second time
+                    shutil.rmtree(os.path.join(pdb_root, 'xy'))
+                    os.mkdir(os.path.join(pdb_root, 'xy'))
+                jobs = [os.path.join(incoming, d)
+                        for d in os.listdir(incoming)]
+                self.assertEqual(len(jobs), 2)
+                for job in jobs:
+                    with open(os.path.join(job, 'inputFiles.txt')) as fh:
+                        self.assertEqual(fh.read().strip(), '1xyzC.pdb')
+                    with open(os.path.join(job, '1xyzC.pdb')) as fh:
+                        self.assertIn('ATOM', fh.read())
+                    # Should be linked to the cached copy
+                    self.assertEqual(
+                        os.stat(os.path.join(job, '1xyzC.pdb')).st_nlink, 3)
+            finally:
+                del foxs.app.config['FOXS_PDB_CACHE']
+
+    def test_pdb_cache_evict(self):
+        """Test removal of least recently used PDB cache entries"""
+        with tempfile.TemporaryDirectory() as cache:
+            entries = []
+            for i, name in enumerate(('old', 'mid', 'new')):
+                entries.append(os.path.join(cache, 'ab', name))
+                os.makedirs(entries[-1])
+                with open(os.path.join(entries[-1], 'x.pdb'), 'w') as fh:
+                    fh.write('x' * 100)
+                os.utime(entries[-1], (i, i))
+            # Incomplete entries are ignored
+            os.mkdir(os.path.join(cache, 'ab', '.tmpfoo'))
+            foxs.pdb_cache.evict(cache, 300)
+            self.assertEqual(len(os.listdir(os.path.join(cache, 'ab'))), 4)
+            foxs.pdb_cache.evict(cache, 250, keep=entries[0])
+            self.assertEqual(sorted(os.listdir(os.path.join(cache, 'ab'))),
+                             ['.tmpfoo', 'new', 'old'])
+
+    def test_warm_pdb_cache(self):
+        """Test the warm-pdb-cache command"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            pdb_root = os.path.join(tmpdir, 'pdb')
+            cache = os.path.join(tmpdir, 'cache')
+            os.mkdir(pdb_root)
+            make_test_pdb(pdb_root)
+            codes = os.path.join(tmpdir, 'codes.txt')
+            with open(codes, 'w') as fh:
+                fh.write("# popular entries\n1xyz:C\n\n1xyz:D\n2bad:A\n")
+            foxs.app.config['PDB_ROOT'] = pdb_root
+            runner = foxs.app.test_cli_runner()
+            # No cache configured
+            result = runner.invoke(args=['warm-pdb-cache', codes])
+            self.assertNotEqual(result.exit_code, 0)
+            self.assertIn('No PDB cache is configured', result.output)
+
+            foxs.app.config['FOXS_PDB_CACHE'] = cache
+            try:
+                result = runner.invoke(args=['warm-pdb-cache', codes])
+            finally:
+                del foxs.app.config['FOXS_PDB_CACHE']
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn('Could not fetch 2bad:A', result.output)
+            self.assertIn('Cached 2 of 3 PDB codes', result.output)
+            self.assertEqual(len(glob.glob(os.path.join(cache, '*', '*'))),
+                             2)
+
     def test_submit_zip_file(self):
         """Test submit with zip file"""
         with tempfile.TemporaryDirectory() as incoming:
@@ -302,6 +435,288 @@ class Tests(saliweb.test.TestCase):
                         re.MULTILINE | re.DOTALL)
                     self.assertRegex(rv.data, r)
 
+    def test_submit_batch(self):
+        """Test submit in batch mode"""
+        with tempfile.TemporaryDirectory() as incoming:
+            with tempfile.TemporaryDirectory() as zip_root:
+                foxs.app.config['DIRECTORIES_INCOMING'] = incoming
+                foxs.app.config['FOXS_BATCH_MAX_STRUCTURES'] = '150'
+
+                zip_name = os.path.join(zip_root, 'input.zip')
+                z = zipfile.ZipFile(zip_name, 'w')
+                for i in range(151):
+                    z.writestr("%d.pdb" % i, "ATOM  \n")
+                z.close()
+                proff = os.path.join(zip_root, 'test.profile')
+                with open(proff, 'w') as fh:
+                    fh.write("0.1 0.5\n")
+
+                with mock_ip(foxs.app, '1.2.3.4'):
+                    c = foxs.app.test_client()
+                    # A profile is required
+                    rv = c.post('/job', data={'pdbfile': open(zip_name, 'rb'),
+                                              'batch': 'on'})
+                    self.assertEqual(rv.status_code, 400)
+                    self.assertIn(b'Batch mode requires an experimental',
+                                  rv.data)
+
+                    # Batch mode has a higher limit
+                    rv = c.post('/job', data={'pdbfile': open(zip_name, 'rb'),
+                                              'profile': open(proff, 'rb'),
+                                              'batch': 'on'})
+                    self.assertEqual(rv.status_code, 400)
+                    self.assertIn(
+                        b'Only 150 PDB/mmCIF files can run on the server',
+                        rv.data)
+
+                    z = zipfile.ZipFile(zip_name, 'w')
+                    for i in range(120):
+                        z.writestr("%d.pdb" % i, "ATOM  \n")
+                    z.close()
+                    rv = c.post('/job', data={'pdbfile': open(zip_name, 'rb'),
+                                              'profile': open(proff, 'rb'),
+                                              'batch': 'on'},
+                                follow_redirects=True)
+                    self.assertEqual(rv.status_code, 503)
+                    data, = [os.path.join(incoming, d, 'data.txt')
+                             for d in os.listdir(incoming)
+                             if os.path.exists(os.path.join(incoming, d,
+                                                            'data.txt'))]
+                    with open(data) as fh:
+                        self.assertEqual(fh.read().split()[15], '1')
+                del foxs.app.config['FOXS_BATCH_MAX_STRUCTURES']
+
+    def test_submit_multi_profile(self):
+        """Test submit with multiple profiles"""
+        with tempfile.TemporaryDirectory() as incoming:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                foxs.app.config['DIRECTORIES_INCOMING'] = incoming
+                foxs.app.config['FOXS_MAX_PROFILES'] = '2'
+                pdbf = os.path.join(tmpdir, 'test.pdb')
+                with open(pdbf, 'w') as fh:
+                    fh.write("ATOM  \n")
+                proffs = []
+                for i in range(3):
+                    proffs.append(os.path.join(tmpdir, 'prof%d.dat' % i))
+                    with open(proffs[-1], 'w') as fh:
+                        fh.write("0.1 %d\n" % (i + 1))
+
+                def submit(profiles, **kwargs):
+                    with mock_ip(foxs.app, '1.2.3.4'):
+                        c = foxs.app.test_client()
+                        data = {'pdbfile': open(pdbf, 'rb'),
+                                'profile': [open(f, 'rb') for f in profiles]}
+                        data.update(kwargs)
+                        return c.post('/job', data=data)
+                try:
+                    rv = submit(proffs)
+                    self.assertEqual(rv.status_code, 400)
+                    self.assertIn(b'Only 2 profiles can be fit', rv.data)
+                    rv = submit(proffs[:2], batch='on')
+                    self.assertEqual(rv.status_code, 400)
+                    self.assertIn(b'Batch mode can only be used', rv.data)
+                    rv = submit(proffs[:2], background='on')
+                    self.assertEqual(rv.status_code, 400)
+                    self.assertIn(b'Background adjustment can only', rv.data)
+                    rv = submit([proffs[0], proffs[0]])
+                    self.assertEqual(rv.status_code, 400)
+                    self.assertIn(b'must have a different file name',
+                                  rv.data)
+                    for d in os.listdir(incoming):
+                        shutil.rmtree(os.path.join(incoming, d))
+
+                    rv = submit(proffs[:2])
+                    self.assertEqual(rv.status_code, 503)
+                    jobdir, = os.listdir(incoming)
+                    with open(os.path.join(incoming, jobdir,
+                                           'profiles.txt')) as fh:
+                        profiles = fh.read().split('\n')
+                    self.assertEqual([p[-9:] for p in profiles],
+                                     ['prof0.dat', 'prof1.dat'])
+                    with open(os.path.join(incoming, jobdir,
+                                           'data.txt')) as fh:
+                        self.assertEqual(fh.read().split()[1], profiles[0])
+                finally:
+                    del foxs.app.config['FOXS_MAX_PROFILES']
+
+    def test_submit_scan(self):
+        """Test submit with a c1/c2 parameter scan and conformer RMSD"""
+        with tempfile.TemporaryDirectory() as incoming:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                foxs.app.config['DIRECTORIES_INCOMING'] = incoming
+                pdbf = os.path.join(tmpdir, 'test.pdb')
+                with open(pdbf, 'w') as fh:
+                    fh.write("ATOM  \n")
+                proff = os.path.join(tmpdir, 'prof.dat')
+                with open(proff, 'w') as fh:
+                    fh.write("0.1 1.0\n")
+
+                def submit(profile=True, **kwargs):
+                    c = foxs.app.test_client()
+                    data = {'pdbfile': open(pdbf, 'rb'), 'scan': 'on'}
+                    if profile:
+                        data['profile'] = open(proff, 'rb')
+                    data.update(kwargs)
+                    return c.post('/job', data=data)
+
+                rv = submit(profile=False)
+                self.assertEqual(rv.status_code, 400)
+                self.assertIn(b'requires a single experimental profile',
+                              rv.data)
+                rv = submit(batch='on')
+                self.assertEqual(rv.status_code, 400)
+                self.assertIn(b'cannot be used in batch mode', rv.data)
+                rv = submit(background='on')
+                self.assertEqual(rv.status_code, 400)
+                self.assertIn(b'cannot be used with background', rv.data)
+
+                rv = submit(dedup_rmsd='-1')
+                self.assertEqual(rv.status_code, 400)
+                self.assertIn(b'Invalid conformer RMSD threshold', rv.data)
+                for nclusters in ('-1', '1', '101'):
+                    rv = submit(profile_clusters=nclusters)
+                    self.assertEqual(rv.status_code, 400)
+                    self.assertIn(b'Invalid number of profile clusters',
+                                  rv.data)
+                rv = submit(cluster_refine='on')
+                self.assertEqual(rv.status_code, 400)
+                self.assertIn(b'requires profile clustering', rv.data)
+
+                rv = submit()
+                self.assertEqual(rv.status_code, 503)
+                jobdir, = os.listdir(incoming)
+                with open(os.path.join(incoming, jobdir, 'data.txt')) as fh:
+                    # batch and share are off; scan is on
+                    self.assertEqual(fh.read().split()[15:], ['0', '0', '1'])
+                shutil.rmtree(os.path.join(incoming, jobdir))
+
+                rv = submit(profile=True, scan='', dedup_rmsd='1.5')
+                self.assertEqual(rv.status_code, 503)
+                jobdir, = os.listdir(incoming)
+                with open(os.path.join(incoming, jobdir, 'data.txt')) as fh:
+                    self.assertEqual(fh.read().split()[15:],
+                                     ['0', '0', '0', '1.50'])
+                shutil.rmtree(os.path.join(incoming, jobdir))
+
+                rv = submit(profile=True, scan='', profile_clusters='20',
+                            cluster_refine='on')
+                self.assertEqual(rv.status_code, 503)
+                jobdir, = os.listdir(incoming)
+                with open(os.path.join(incoming, jobdir, 'data.txt')) as fh:
+                    self.assertEqual(fh.read().split()[15:],
+                                     ['0', '0', '0', '0.00', '20', '1'])
+
+    def test_batch_submit_profiles(self):
+        """Test batch submission of one structure with many profiles"""
+        with tempfile.TemporaryDirectory() as incoming:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                foxs.app.config['DIRECTORIES_INCOMING'] = incoming
+                pdbf = os.path.join(tmpdir, 'test.pdb')
+                with open(pdbf, 'w') as fh:
+                    fh.write("ATOM  \n")
+                proffs = []
+                for i in range(3):
+                    proffs.append(os.path.join(tmpdir, 'prof%d.dat' % i))
+                    with open(proffs[-1], 'w') as fh:
+                        fh.write("0.1 %d\n" % (i + 1))
+                c = foxs.app.test_client()
+                rv = c.post('/batch', data={
+                    'pdbfile': open(pdbf, 'rb'), 'jobname': 'myjob',
+                    'profile': [open(f, 'rb') for f in proffs]})
+                self.assertEqual(rv.status_code, 200)
+                jobs = rv.get_json()['jobs']
+                self.assertEqual([j['name'] for j in jobs],
+                                 ['myjob_1', 'myjob_2', 'myjob_3'])
+                self.assertIn('/job/myjob_2', jobs[1]['results_url'])
+                jobdirs = sorted(os.listdir(incoming))
+                self.assertEqual(len(jobdirs), 3)
+                profiles = []
+                for d in jobdirs:
+                    with open(os.path.join(incoming, d, 'data.txt')) as fh:
+                        fields = fh.read().split()
+                    # Structure is copied to every job; profiles are shared
+                    self.assertTrue(fields[0].endswith('test.pdb'))
+                    self.assertTrue(os.path.exists(
+                        os.path.join(incoming, d, fields[0])))
+                    self.assertEqual(fields[16], '1')
+                    profiles.append(fields[1][-9:])
+                self.assertEqual(sorted(profiles),
+                                 ['prof0.dat', 'prof1.dat', 'prof2.dat'])
+
+    def test_batch_submit_structures(self):
+        """Test batch submission of many structures with one profile"""
+        with tempfile.TemporaryDirectory() as incoming:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                foxs.app.config['DIRECTORIES_INCOMING'] = incoming
+                pdbfs = []
+                for i in range(2):
+                    pdbfs.append(os.path.join(tmpdir, 'test%d.pdb' % i))
+                    with open(pdbfs[-1], 'w') as fh:
+                        fh.write("ATOM  \n")
+                proff = os.path.join(tmpdir, 'test.profile')
+                with open(proff, 'w') as fh:
+                    fh.write("0.1 0.5\n")
+                c = foxs.app.test_client()
+                rv = c.post('/batch', data={
+                    'pdbfile': [open(f, 'rb') for f in pdbfs],
+                    'profile': open(proff, 'rb')})
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(len(rv.get_json()['jobs']), 2)
+                structures = []
+                for d in os.listdir(incoming):
+                    with open(os.path.join(incoming, d, 'data.txt')) as fh:
+                        fields = fh.read().split()
+                    structures.append(fields[0][-9:])
+                    self.assertTrue(fields[1].endswith('test.profile'))
+                    # Canonical form of the profile is copied too
+                    self.assertTrue(os.path.exists(
+                        os.path.join(incoming, d, fields[1] + '.npy')))
+                self.assertEqual(sorted(structures),
+                                 ['test0.pdb', 'test1.pdb'])
+
+    def test_batch_submit_errors(self):
+        """Test batch submission with invalid inputs"""
+        with tempfile.TemporaryDirectory() as incoming:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                foxs.app.config['DIRECTORIES_INCOMING'] = incoming
+                foxs.app.config['FOXS_BATCH_SUBMIT_MAX_JOBS'] = '2'
+                pdbf = os.path.join(tmpdir, 'test.pdb')
+                with open(pdbf, 'w') as fh:
+                    fh.write("ATOM  \n")
+                proff = os.path.join(tmpdir, 'test.profile')
+                with open(proff, 'w') as fh:
+                    fh.write("0.1 0.5\n")
+                badf = os.path.join(tmpdir, 'bad.profile')
+                with open(badf, 'w') as fh:
+                    fh.write("garbage\n")
+
+                def check_error(data, msg):
+                    with mock_ip(foxs.app, '1.2.3.4'):
+                        c = foxs.app.test_client()
+                        rv = c.post('/batch', data=data)
+                    self.assertEqual(rv.status_code, 400)
+                    self.assertIn(msg, rv.get_json()['error'])
+                    # No jobs should have been made
+                    self.assertEqual(os.listdir(incoming), [])
+                try:
+                    check_error({'profile': open(proff, 'rb')},
+                                'Error in protein input')
+                    check_error({'pdbfile': open(pdbf, 'rb')},
+                                'requires at least one experimental profile')
+                    check_error({'pdbfile': [open(pdbf, 'rb')] * 2,
+                                 'profile': [open(proff, 'rb')] * 2},
+                                'either one set of structures')
+                    check_error({'pdbfile': open(pdbf, 'rb'),
+                                 'profile': [open(proff, 'rb')] * 3},
+                                'Only 2 jobs can be submitted')
+                    # Jobs made before an invalid input is found are removed
+                    check_error({'pdbfile': open(pdbf, 'rb'),
+                                 'profile': [open(proff, 'rb'),
+                                             open(badf, 'rb')]},
+                                'Invalid profile uploaded')
+                finally:
+                    del foxs.app.config['FOXS_BATCH_SUBMIT_MAX_JOBS']
+
     def test_submit_zip_file_not_pdb(self):
         """Test submit with zip file containing something not a PDB"""
         with tempfile.TemporaryDirectory() as incoming:
@@ -319,6 +734,52 @@ class Tests(saliweb.test.TestCase):
                 self.assertIn(b'PDB file input/test.pdb contains no '
                               b'ATOM or HETATM records', rv.data)
 
+    def test_submit_zip_file_first_invalid(self):
+        """Test submit with zip file containing several invalid files"""
+        with tempfile.TemporaryDirectory() as incoming:
+            with tempfile.TemporaryDirectory() as zip_root:
+                foxs.app.config['DIRECTORIES_INCOMING'] = incoming
+
+                zip_name = os.path.join(zip_root, 'input.zip')
+                z = zipfile.ZipFile(zip_name, 'w')
+                for i in range(20):
+                    z.writestr("%d.pdb" % i, "ATOM  \n")
+                z.writestr("bad1.pdb", "garbage")
+                z.writestr("bad2.pdb", "garbage")
+                z.writestr("test.notapdb", "ATOM  \n")
+                z.close()
+
+                # Errors should be reported for the first invalid file,
+                # in zip file order
+                c = foxs.app.test_client()
+                rv = c.post('/job', data={'pdbfile': open(zip_name, 'rb')})
+                self.assertEqual(rv.status_code, 400)
+                self.assertIn(b'PDB file bad1.pdb contains no '
+                              b'ATOM or HETATM records', rv.data)
+
+    def test_submit_zip_file_saliweb_check(self):
+        """Test that submit checks structures with saliweb's checker"""
+        with tempfile.TemporaryDirectory() as incoming:
+            with tempfile.TemporaryDirectory() as zip_root:
+                foxs.app.config['DIRECTORIES_INCOMING'] = incoming
+
+                zip_name = os.path.join(zip_root, 'input.zip')
+                z = zipfile.ZipFile(zip_name, 'w')
+                z.writestr("input/test.pdb", "ATOM  \n")
+                z.close()
+
+                c = foxs.app.test_client()
+                with mock.patch('saliweb.frontend.check_pdb_or_mmcif',
+                                side_effect=InputValidationError(
+                                    'bad structure')) as m:
+                    rv = c.post('/job',
+                                data={'pdbfile': open(zip_name, 'rb')})
+                self.assertEqual(rv.status_code, 400)
+                self.assertIn(b'bad structure', rv.data)
+                m.assert_called_once()
+                self.assertEqual(m.call_args[1],
+                                 {'show_filename': 'input/test.pdb'})
+
     def test_submit_zip_file_empty(self):
         """Test submit with zip file containing no PDBs"""
         with tempfile.TemporaryDirectory() as incoming: